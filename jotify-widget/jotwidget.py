@@ -1,13 +1,13 @@
 import signal
 
-from jotify.state_ui import UI
+from jotify.glib_ui import GLibUI
+from jotify.metrics import METRICS_PREFIX
 
 import gi
 gi.require_version( 'Gtk', '3.0' )
 gi.require_version( 'AppIndicator3', '0.1' )
 
 from gi.repository import Gtk as gtk
-from gi.repository import GLib
 from gi.repository import AppIndicator3 as appindicator
 
 APPINDICATOR_ID = 'jotify-widget'
@@ -18,21 +18,35 @@ def _quit(source):
     gtk.main_quit()
 
 
-def _show_jotify_state( indicator, state ):
-    label = ""
-    if state is not None:
-        label += " "
-        for k in sorted(state.stats.keys()):
-            label += " " + str(int(state.stats[k]['count'])) + " |"
-    else:
-        label = "\U0001F618"
-    GLib.idle_add( _update_label, indicator, label )
-    #print( label )
-
-
-def _update_label( indicator, label ):
-    indicator.set_label( label, LABEL_GUIDE )
-    return False
+class _Label( object ):
+    """
+    Shows the count of every key on the indicator.  The UI runs on the
+    GTK main loop, so the label is set directly, and only when the
+    displayed counts changed.
+    """
+
+    def __init__( self, indicator ):
+        self.indicator = indicator
+        self.keys = []
+        self.key_set = set()
+        self.counts = None
+
+    def show( self, state ):
+        if state is None:
+            self._set( None, "\U0001F618" )
+            return
+        stats = state.stats
+        if stats.keys() != self.key_set:
+            self.key_set = set( stats.keys() )
+            self.keys = sorted( k for k in self.key_set
+                                if not k.startswith( METRICS_PREFIX ) )
+        counts = tuple( int( stats[k]['count'] ) for k in self.keys )
+        if counts != self.counts:
+            self._set( counts, "  " + " ".join( "{0} |".format( c ) for c in counts ) )
+
+    def _set( self, counts, label ):
+        self.counts = counts
+        self.indicator.set_label( label, LABEL_GUIDE )
 
 
 def build_menu():
@@ -55,10 +69,11 @@ def main():
     indicator.set_menu( build_menu() )
     indicator.set_label( "*", LABEL_GUIDE )
 
-    # attach to the jotify UI
-    jui = UI( 5.0 )
-    jui.add_state_listener( lambda s: _show_jotify_state( indicator, s ) )
-    _show_jotify_state( indicator, None )
+    # attach to the jotify UI, receiving and syncing on the GTK loop
+    label = _Label( indicator )
+    jui = GLibUI( 5.0 )
+    jui.add_state_listener( label.show )
+    label.show( None )
     jui.start()
 
     # inifninte GTK loop!
@@ -66,4 +81,4 @@ def main():
 
 if __name__ == "__main__":
     main()
-    
+
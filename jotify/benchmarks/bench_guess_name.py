@@ -0,0 +1,84 @@
+"""
+Cost of an unnamed track() call: the old inspect.stack() based name
+guessing versus the memoized frame walk in jotify.progress.
+
+  python benchmarks/bench_guess_name.py [--calls N]
+"""
+import argparse
+import inspect
+import pathlib
+import timeit
+
+from jotify import progress
+from jotify.batch_sender import BatchSender
+
+## ========================================================================
+
+def _guess_name_inspect():
+    """
+    The original (pre-memoization) implementation, kept here for
+    comparison only.
+    """
+    stack = inspect.stack()
+    name = None
+    stack_up_index = 2
+    try:
+        while name is None and len(stack) > stack_up_index:
+            caller_info = stack[ stack_up_index ]
+            stack_up_index += 1
+            if caller_info.filename is None or caller_info.filename == '':
+                continue
+            filename = pathlib.Path( caller_info.filename ).stem
+            if filename == 'progress':
+                continue
+            if caller_info.function is not None and len(filename) > 1:
+                name = "{filename}.{function}.{lineno}".format(
+                    filename = filename,
+                    function = caller_info.function,
+                    lineno = caller_info.lineno )
+    finally:
+        del stack
+    return name
+
+## ========================================================================
+
+def _one_track( sender ):
+    for _ in progress.track( range(1), sender = sender ):
+        pass
+
+
+def _nested( depth, f ):
+    # emulate track() being used a few frames down an application stack
+    if depth == 0:
+        return f()
+    return _nested( depth - 1, f )
+
+
+def run( calls: int, depth: int ) -> dict:
+    sender = BatchSender( 3600.0 )
+    results = {}
+    for label, guess in ( ( 'inspect_stack', _guess_name_inspect ),
+                          ( 'frame_walk_cached', progress._guess_name ) ):
+        original = progress._guess_name
+        progress._guess_name = guess
+        try:
+            seconds = timeit.timeit(
+                lambda: _nested( depth, lambda: _one_track( sender ) ),
+                number = calls )
+        finally:
+            progress._guess_name = original
+        results[ label ] = seconds / calls * 1e6
+    return results
+
+## ========================================================================
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--calls', type=int, default=2000 )
+    parser.add_argument( '--depth', type=int, default=20 )
+    args = parser.parse_args()
+
+    for label, usec in run( args.calls, args.depth ).items():
+        print( "{0:>20} : {1:10.2f} us per track() call".format(
+            label, usec ) )
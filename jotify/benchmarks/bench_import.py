@@ -0,0 +1,63 @@
+"""
+Cost of `import jotify.progress` and latency of the first track() call,
+each measured in a fresh interpreter.
+
+  python benchmarks/bench_import.py [--runs N]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+## ========================================================================
+
+_PROBE = r'''
+import json, threading, time
+t0 = time.perf_counter()
+import jotify.progress
+t1 = time.perf_counter()
+threads_after_import = threading.active_count()
+for _ in jotify.progress.track( range(1) ):
+    pass
+t2 = time.perf_counter()
+jotify.progress.default_batch_sender().pause()
+print( json.dumps( { 'import_seconds' : t1 - t0,
+                     'first_track_seconds' : t2 - t1,
+                     'threads_after_import' : threads_after_import } ) )
+'''
+
+def _package_root() -> str:
+    return os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+
+def _probe() -> dict:
+    env = dict( os.environ )
+    env[ 'PYTHONPATH' ] = os.pathsep.join(
+        p for p in ( _package_root(), env.get( 'PYTHONPATH' ) ) if p )
+    out = subprocess.check_output( [ sys.executable, '-c', _PROBE ],
+                                   env = env )
+    return json.loads( out.decode( 'utf-8' ).strip().splitlines()[-1] )
+
+
+def run( runs: int ) -> dict:
+    probes = [ _probe() for _ in range( runs ) ]
+    return {
+        'import_ms_median' : 1e3 * statistics.median(
+            p[ 'import_seconds' ] for p in probes ),
+        'first_track_ms_median' : 1e3 * statistics.median(
+            p[ 'first_track_seconds' ] for p in probes ),
+        'threads_after_import' : max(
+            p[ 'threads_after_import' ] for p in probes ) }
+
+## ========================================================================
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--runs', type=int, default=10 )
+    args = parser.parse_args()
+
+    for label, value in run( args.runs ).items():
+        print( "{0:>24} : {1:10.3f}".format( label, value ) )
@@ -0,0 +1,285 @@
+"""
+Benchmark suite for jotify's own costs:
+
+  track       per-item overhead of progress.track vs. a bare loop, for
+              one and several threads, plain / sharded / batched
+  codec       time and size of State.representation() and State.load()
+              as the number of keys and max_hist grow, for each wire
+              format
+  receiver    highest datagram rate state_ui.UI and async_ui.AsyncUI
+              ingest over loopback multicast without dropping any
+  naming      unnamed track() cost (see bench_guess_name)
+  startup     import and first track() latency (see bench_import)
+
+Results are written as JSON (to stdout, or --output) so runs can be
+compared across releases:
+
+  python benchmarks/bench_suite.py [--quick] [--only track,codec] [--output f]
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+from typing import Callable, Dict, List
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ) )
+
+from jotify import codec
+from jotify import progress
+from jotify.async_ui import AsyncUI
+from jotify.batch_sender import BatchSender
+from jotify.state import State
+from jotify.state_ui import UI
+
+## ========================================================================
+
+def _best_of( repeats: int, f: Callable[[],None] ) -> float:
+    best = float( 'inf' )
+    for _ in range( repeats ):
+        t0 = time.perf_counter()
+        f()
+        best = min( best, time.perf_counter() - t0 )
+    return best
+
+
+def _in_threads( n_threads: int, f: Callable[[],None] ) -> Callable[[],None]:
+    def run():
+        threads = [ threading.Thread( target = f ) for _ in range( n_threads ) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return run
+
+## ========================================================================
+
+def bench_track( items: int, thread_counts: List[int], repeats: int ) -> List[Dict]:
+    results = []
+    modes = [ ( 'plain', {}, False ),
+              ( 'sharded', {}, True ),
+              ( 'batched', { 'flush_every' : 1024 }, False ) ]
+    for n_threads in thread_counts:
+        def bare():
+            for _ in range( items ):
+                pass
+        bare_s = _best_of( repeats, _in_threads( n_threads, bare ) )
+        for mode, kwargs, sharded in modes:
+            sender = BatchSender( 3600.0, sharded = sharded )
+            def tracked():
+                name = "bench.{0}".format( threading.get_ident() )
+                for _ in progress.track( range( items ), name, sender, **kwargs ):
+                    pass
+            tracked_s = _best_of( repeats, _in_threads( n_threads, tracked ) )
+            total_items = items * n_threads
+            results.append( {
+                'mode' : mode,
+                'threads' : n_threads,
+                'items' : total_items,
+                'bare_ns_per_item' : 1e9 * bare_s / total_items,
+                'track_ns_per_item' : 1e9 * tracked_s / total_items,
+                'overhead_ns_per_item' : 1e9 * ( tracked_s - bare_s ) / total_items } )
+    return results
+
+## ========================================================================
+
+def _filled_state( n_keys: int, max_hist: int ) -> State:
+    s = State( max_hist )
+    for k in range( n_keys ):
+        key = "bench.module.function.{0}".format( k )
+        s.schema( key, 0, 1000 )
+        for _ in range( max_hist ):
+            s.add( key, 1 )
+    return s
+
+
+def bench_codec( key_counts: List[int], hists: List[int], repeats: int ) -> List[Dict]:
+    results = []
+    for n_keys in key_counts:
+        for max_hist in hists:
+            s = _filled_state( n_keys, max_hist )
+            for wire_format in ( codec.WIRE_JSON, codec.WIRE_BINARY ):
+                rep = s.representation( wire_format )
+                encode_s = _best_of( repeats,
+                                     lambda: s.representation( wire_format ) )
+                decode_s = _best_of( repeats, lambda: State( max_hist ).load( rep ) )
+                results.append( {
+                    'wire_format' : wire_format,
+                    'keys' : n_keys,
+                    'max_hist' : max_hist,
+                    'bytes' : len(rep),
+                    'representation_ms' : 1e3 * encode_s,
+                    'load_ms' : 1e3 * decode_s } )
+    return results
+
+## ========================================================================
+
+class _CountingUI( UI ):
+
+    def __init__( self, *args, **kwargs ) -> None:
+        super().__init__( *args, **kwargs )
+        self.ingested = 0
+
+    def _ingest( self, *received ) -> None:
+        super()._ingest( *received )
+        self.ingested += 1
+
+
+class _CountingAsyncUI( AsyncUI ):
+
+    def __init__( self, *args, **kwargs ) -> None:
+        super().__init__( *args, **kwargs )
+        self.ingested = 0
+
+    def _ingest( self, *received ) -> None:
+        super()._ingest( *received )
+        self.ingested += 1
+
+
+def _blast( port: int, rate: float, seconds: float, keys: int ) -> int:
+    """
+    Sends distinct single-datagram states at the given rate; returns
+    how many were sent.
+    """
+    s = _filled_state( keys, 2 )
+    datagrams = [ s.representation( codec.WIRE_BINARY,
+                                    header = { 'seq' : seq, 'sender' : 'bench' } )
+                  for seq in range( int( rate * seconds ) ) ]
+    sender_socket = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+    interval = 1.0 / rate
+    start = time.perf_counter()
+    try:
+        for sent, datagram in enumerate( datagrams ):
+            delay = start + sent * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep( delay )
+            sender_socket.sendto( datagram, ( '224.0.0.1', port ) )
+    finally:
+        sender_socket.close()
+    return len(datagrams)
+
+
+def _receive_ui( port: int, rate: float, seconds: float, keys: int ):
+    """
+    Blasts datagrams at a _CountingUI receiving on its own threads.
+    """
+    ui = _CountingUI( 3600.0, multicast_port = port )
+    ui.start()
+    try:
+        time.sleep( 0.2 )
+        sent = _blast( port, rate, seconds, keys )
+        time.sleep( 0.5 )
+    finally:
+        ui.pause()
+    return sent, ui.ingested
+
+
+def _receive_async_ui( port: int, rate: float, seconds: float, keys: int ):
+    """
+    Blasts datagrams (from an executor thread) at a _CountingAsyncUI
+    receiving on an event loop.
+    """
+    async def run():
+        loop = asyncio.get_event_loop()
+        ui = _CountingAsyncUI( 3600.0, multicast_port = port )
+        await ui.start()
+        try:
+            await asyncio.sleep( 0.2 )
+            sent = await loop.run_in_executor( None, _blast,
+                                               port, rate, seconds, keys )
+            await asyncio.sleep( 0.5 )
+        finally:
+            await ui.pause()
+        return sent, ui.ingested
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete( run() )
+    finally:
+        loop.close()
+
+
+def _receive_steps( receive: Callable, rates: List[float], seconds: float,
+                    keys: int, port: int ) -> Dict:
+    results = []
+    max_clean_rate = 0.0
+    for rate in rates:
+        sent, received = receive( port, rate, seconds, keys )
+        results.append( { 'target_rate' : rate,
+                          'sent' : sent,
+                          'ingested' : received,
+                          'dropped' : sent - received,
+                          'ingest_rate' : received / seconds } )
+        if received >= sent:
+            max_clean_rate = rate
+        else:
+            break
+    return { 'max_rate_without_drops' : max_clean_rate,
+             'steps' : results }
+
+
+def bench_receiver( rates: List[float], seconds: float, keys: int,
+                    port: int ) -> Dict:
+    """
+    The UI results at the top level, the AsyncUI ones under async_ui.
+    """
+    results = { 'keys_per_datagram' : keys }
+    results.update( _receive_steps( _receive_ui, rates, seconds, keys, port ) )
+    results[ 'async_ui' ] = _receive_steps( _receive_async_ui,
+                                            rates, seconds, keys, port )
+    return results
+
+## ========================================================================
+
+def main( argv = None ) -> Dict:
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--quick', action='store_true',
+                         help="smaller sizes, for smoke testing" )
+    parser.add_argument( '--only', default='track,codec,receiver,naming,startup' )
+    parser.add_argument( '--port', type=int, default=10999 )
+    parser.add_argument( '--output', default=None )
+    args = parser.parse_args( argv )
+    only = set( args.only.split( ',' ) )
+
+    quick = args.quick
+    results = {
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'timestamp' : time.time() }
+    if 'track' in only:
+        results[ 'track' ] = bench_track( 20000 if quick else 500000,
+                                          [ 1, 4 ],
+                                          2 if quick else 5 )
+    if 'codec' in only:
+        results[ 'codec' ] = bench_codec( [ 10, 100 ] if quick else [ 10, 100, 1000, 5000 ],
+                                          [ 10 ] if quick else [ 10, 100 ],
+                                          2 if quick else 5 )
+    if 'receiver' in only:
+        results[ 'receiver' ] = bench_receiver(
+            [ 500, 2000 ] if quick else [ 500, 1000, 2000, 5000, 10000, 20000, 50000 ],
+            0.5 if quick else 2.0,
+            10,
+            args.port )
+    if 'naming' in only:
+        import bench_guess_name
+        results[ 'naming' ] = bench_guess_name.run( 200 if quick else 2000, 20 )
+    if 'startup' in only:
+        import bench_import
+        results[ 'startup' ] = bench_import.run( 3 if quick else 10 )
+
+    out = json.dumps( results, indent = 2, sort_keys = True )
+    if args.output:
+        with open( args.output, 'w' ) as f:
+            f.write( out + "\n" )
+    else:
+        print( out )
+    return results
+
+## ========================================================================
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+import logging
+import time
+from typing import Dict, List, Optional, Set
+
+from . import codec
+from .state import State
+from .timering import TimeRing
+
+## ========================================================================
+
+def _log():
+    return logging.getLogger( __name__ )
+
+## ========================================================================
+
+class _Sender( object ):
+
+    def __init__( self, state: State ) -> None:
+        self.state = state
+        self.last_sequence = None
+        self.last_seen = None
+        self.missed = 0
+        self.awaiting_keyframe = False
+
+## ========================================================================
+
+class SenderAggregator( object ):
+    """
+    Keeps the state of each sender separately, keyed by the sender
+    identity carried in the message header, and aggregates them into
+    per-key totals.
+
+    Messages whose sequence number is not newer than the last one seen
+    from their sender are dropped as stale or out of order, and
+    senders not heard from for ttl_seconds are forgotten.  A keyframe
+    replaces its sender's keys, a delta removes the keys listed in its
+    header, and each sender's state applies the given key limits (see
+    State).
+
+    aggregate() returns immutable, versioned snapshots: only the keys
+    changed since the previous call are recomputed, the others are
+    shared with the previous snapshot, and version only moves when
+    something changed.  Not thread-safe; callers serialize access.
+    """
+
+    def __init__( self,
+                  ttl_seconds: float = 60.0,
+                  max_hist: int = 10,
+                  max_keys: Optional[int] = None,
+                  key_ttl_seconds: Optional[float] = None,
+                  finished_ttl_seconds: Optional[float] = None ) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.max_hist = max_hist
+        self.max_keys = max_keys
+        self.key_ttl_seconds = key_ttl_seconds
+        self.finished_ttl_seconds = finished_ttl_seconds
+        self.senders = {} # type: Dict[str,_Sender]
+        self.dropped = 0
+        self.missed = 0
+        self.version = 0
+        self._entries = {} # type: Dict[str,Dict]
+        self._changed = set() # type: Set[str]
+        self._snapshot = None # type: Optional[State]
+
+
+    def apply( self,
+               sender_id: str,
+               header: Dict,
+               state: State,
+               now: Optional[float] = None ) -> bool:
+        """
+        Merges a received state into its sender's state.  Returns False
+        if the message was dropped.
+        """
+        if now is None:
+            now = time.monotonic()
+        sender = self.senders.get( sender_id )
+        if sender is None:
+            sender = _Sender( State( self.max_hist,
+                                     max_keys = self.max_keys,
+                                     key_ttl_seconds = self.key_ttl_seconds,
+                                     finished_ttl_seconds = self.finished_ttl_seconds ) )
+            self.senders[ sender_id ] = sender
+            _log().info( "  new sender {0}".format( sender_id ) )
+        seq = header.get( 'seq' )
+        if seq is not None and sender.last_sequence is not None:
+            if seq <= sender.last_sequence:
+                self.dropped += 1
+                _log().debug( "  dropping stale message {0} from {1}".format(
+                    seq, sender_id ) )
+                return False
+            if header.get( 'kind' ) != codec.KIND_KEYFRAME \
+               and seq > sender.last_sequence + 1:
+                gap = seq - sender.last_sequence - 1
+                sender.missed += gap
+                self.missed += gap
+                sender.awaiting_keyframe = True
+                _log().warning(
+                    "  missed messages {0}..{1} from {2}, waiting for keyframe".format(
+                        sender.last_sequence + 1, seq - 1, sender_id ) )
+        if header.get( 'kind' ) == codec.KIND_KEYFRAME and sender.awaiting_keyframe:
+            # deltas carry whole entries, so a missed delta only leaves
+            # its keys stale until the next keyframe
+            _log().info( "  resynchronized {0} at keyframe {1}".format(
+                sender_id, seq ) )
+            sender.awaiting_keyframe = False
+        if seq is not None:
+            sender.last_sequence = seq
+        sender.last_seen = now
+        if header.get( 'kind' ) == codec.KIND_KEYFRAME:
+            sender.state.replace( state )
+        else:
+            for key in header.get( 'removed', () ):
+                sender.state.remove( key )
+            sender.state.merge( state )
+        return True
+
+
+    def expire( self, now: Optional[float] = None ) -> List[str]:
+        """
+        Forgets senders which have been silent for longer than the
+        TTL, and expires the keys of the others; returns the ids of the
+        forgotten senders.
+        """
+        if now is None:
+            now = time.monotonic()
+        for sender in self.senders.values():
+            sender.state.expire_keys( now )
+        expired = [ sender_id
+                    for sender_id, sender in self.senders.items()
+                    if now - sender.last_seen > self.ttl_seconds ]
+        for sender_id in expired:
+            self._changed.update( self.senders.pop( sender_id ).state.stats )
+            _log().info( "  expired silent sender {0}".format( sender_id ) )
+        return expired
+
+
+    def changed_keys( self ) -> Set[str]:
+        """
+        Returns the keys added, updated or removed by any sender since
+        the previous call, and bumps version if there are any.
+        """
+        changed = self._changed
+        self._changed = set()
+        for sender in self.senders.values():
+            with sender.state.lock:
+                changed.update( sender.state.dirty )
+                changed.update( sender.state.removed )
+                sender.state.dirty = set()
+                sender.state.removed = set()
+        if changed:
+            self.version += 1
+        return changed
+
+
+    def aggregate( self ) -> State:
+        """
+        Returns a State with, for every key, the count and rates
+        summed over senders, the schema widened to cover the combined
+        item ranges of the senders, and the most recent timestamps of
+        any sender.  A key is finished once every sender finished it,
+        and value distributions (see State.record) are merged.
+
+        The result is a snapshot which must not be modified: when
+        nothing changed the previous one is returned as is, and
+        otherwise the entries of unchanged keys are shared with it.
+        """
+        changed = self.changed_keys()
+        if not changed and self._snapshot is not None:
+            return self._snapshot
+        for key in changed:
+            entries = []
+            for sender in self.senders.values():
+                with sender.state.lock:
+                    entry = sender.state.stats.get( key )
+                if entry is not None:
+                    entries.append( entry )
+            if entries:
+                self._entries[ key ] = _aggregate_entries( entries, self.max_hist )
+            else:
+                self._entries.pop( key, None )
+        result = State( self.max_hist )
+        result.stats.update( self._entries )
+        self._snapshot = result
+        return result
+
+## ========================================================================
+
+def _aggregate_entries( entries: List[Dict], max_hist: int ) -> Dict:
+    count = 0.0
+    lo = None
+    span = 0.0
+    has_schema = True
+    for entry in entries:
+        count += entry[ 'count' ]
+        if entry.get( 'min' ) is None or entry.get( 'max' ) is None:
+            has_schema = False
+            continue
+        lo = entry[ 'min' ] if lo is None else min( lo, entry[ 'min' ] )
+        span += entry[ 'max' ] - entry[ 'min' ] + 1
+    rings = [ entry[ 'timehist' ] for entry in entries ]
+    if len(rings) == 1:
+        timehist = rings[0].copy()
+    else:
+        times = sorted( t for ring in rings for t in ring )[ -max_hist: ]
+        timehist = TimeRing.from_values( max_hist,
+                                         times,
+                                         sum( ring.rate for ring in rings ),
+                                         sum( ring.ewma for ring in rings ) )
+    result = { 'count' : count,
+               'min' : lo if has_schema else None,
+               'max' : lo + span - 1 if has_schema and lo is not None else None,
+               'timehist' : timehist }
+    if all( entry.get( 'finished' ) for entry in entries ):
+        result[ 'finished' ] = True
+    histograms = [ entry[ 'values' ] for entry in entries
+                   if entry.get( 'values' ) is not None ]
+    if histograms:
+        values = histograms[0].copy()
+        for h in histograms[ 1: ]:
+            values.merge( h )
+        result[ 'values' ] = values
+    return result
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
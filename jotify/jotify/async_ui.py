@@ -0,0 +1,151 @@
+import asyncio
+import inspect
+import logging
+import time
+from typing import AsyncIterator, List, Optional
+
+from .state import State
+from .state_ui import UI
+
+## ========================================================================
+
+def _log():
+    return logging.getLogger( __name__ )
+
+## ========================================================================
+
+class _Protocol( asyncio.DatagramProtocol ):
+
+    def __init__( self, ui: 'AsyncUI' ) -> None:
+        self.ui = ui
+
+    def datagram_received( self, data: bytes, address ) -> None:
+        self.ui._datagram_received( data, address )
+
+    def error_received( self, exc: Exception ) -> None:
+        _log().warning( "  receive error: {0}".format( exc ) )
+
+## ========================================================================
+
+class AsyncUI( UI ):
+    """
+    A UI which runs entirely on an asyncio event loop.
+
+    Datagrams are ingested by a datagram endpoint as soon as they
+    arrive, syncs run as a task on the loop, and listeners may be
+    plain callables or coroutine functions.  snapshots() offers the
+    synced states as an async iterator.  Takes the same arguments as
+    UI; scheduler is unused.  Transports without a socket (e.g.
+    transport.SharedMemoryTransport) are polled from the loop every
+    receive_sleep_seconds.
+    """
+
+    def __init__( self, *args, **kwargs ) -> None:
+        super().__init__( *args, **kwargs )
+        self.endpoint = None
+        self.sync_future = None # type: Optional[asyncio.Future]
+        self.poll_future = None # type: Optional[asyncio.Future]
+        self._snapshot_queues = [] # type: List[asyncio.Queue]
+
+
+    async def start(self) -> None:
+        _log().info( "start AsyncUI called..." )
+        loop = asyncio.get_event_loop()
+        self.running = True
+        self.transport.open_receiver( 0.0 )
+        if self.transport.socket is not None:
+            self.transport.socket.setblocking( False )
+            self.endpoint, _ = await loop.create_datagram_endpoint(
+                lambda: _Protocol( self ),
+                sock = self.transport.socket )
+        else:
+            self.poll_future = loop.create_task( self._poll_loop() )
+        self.sync_future = loop.create_task( self._sync_loop() )
+        _log().info( "AsyncUI started!" )
+
+
+    async def pause(self) -> None:
+        _log().info( "paused AsyncUI called..." )
+        self.running = False
+        for future in ( self.sync_future, self.poll_future ):
+            if future is not None:
+                future.cancel()
+                try:
+                    await future
+                except asyncio.CancelledError:
+                    pass
+        self.sync_future = None
+        self.poll_future = None
+        if self.endpoint is not None:
+            self.endpoint.close()
+            self.endpoint = None
+        self.transport.close()
+        for queue in self._snapshot_queues:
+            _put_latest( queue, None )
+        _log().info( "AsyncUI paused!" )
+
+
+    def _sync_soon(self) -> None:
+        asyncio.ensure_future( self._sync_state_async() )
+
+
+    async def snapshots(self) -> AsyncIterator[State]:
+        """
+        Yields each synced state until the UI is paused.  A consumer
+        slower than the refresh interval only sees the latest state,
+        and a state is only yielded when it changed.
+        """
+        queue = asyncio.Queue( maxsize = 1 )
+        self._snapshot_queues.append( queue )
+        try:
+            while True:
+                s = await queue.get()
+                if s is None:
+                    return
+                yield s
+        finally:
+            self._snapshot_queues.remove( queue )
+
+
+    async def _poll_loop(self) -> None:
+        while self.running:
+            self._drain()
+            await asyncio.sleep( self.receive_sleep_seconds )
+
+
+    async def _sync_loop(self) -> None:
+        while self.running:
+            await asyncio.sleep( self.refresh_interval_seconds )
+            try:
+                await self._sync_state_async()
+            except Exception:
+                _log().exception( "error syncing: " )
+
+
+    async def _sync_state_async(self) -> None:
+        s = self._changed_snapshot()
+        if s is None:
+            return
+        _log().debug( "syncing state..." )
+        for c in list( self.state_listeners ):
+            started = time.perf_counter()
+            result = c(s)
+            if inspect.isawaitable( result ):
+                await result
+            self.metrics.time( 'ui.listener', time.perf_counter() - started )
+        for queue in self._snapshot_queues:
+            _put_latest( queue, s )
+        _log().debug( "synced state..." )
+
+## ========================================================================
+
+def _put_latest( queue: asyncio.Queue, item ) -> None:
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait( item )
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
@@ -1,19 +1,27 @@
-import atexit
-import datetime
 import logging
+import os
+import random
 import socket
-import struct
 import threading
 import time
-from typing import Optional
+from typing import Optional, TYPE_CHECKING
 
+from . import codec
+from . import fragment
+from .metrics import METRICS_PREFIX, Metrics
+from .scheduler import Scheduler, Task, default_scheduler
 from .state import State
+from .transport import MulticastTransport, Transport
+
+if TYPE_CHECKING:
+    from .shared import SharedCounters
 
 ## ========================================================================
 
 def _log():
     return logging.getLogger( __name__ )
 
+
 ## ========================================================================
 
 class BatchSender( object ):
@@ -22,125 +30,327 @@ class BatchSender( object ):
                   send_interval_seconds: float,
                   multicast_ip: str = '224.0.0.1',
                   multicast_port: int = 10000,
-                  num_retries: int = 3) -> None:
+                  num_retries: int = 3,
+                  sharded: bool = False,
+                  wire_format: str = codec.WIRE_JSON,
+                  keyframe_every: int = 1,
+                  max_datagram_size: int = 1400,
+                  scheduler: Optional[Scheduler] = None,
+                  max_keys: Optional[int] = None,
+                  key_ttl_seconds: Optional[float] = None,
+                  finished_ttl_seconds: Optional[float] = None,
+                  shared_counters: Optional['SharedCounters'] = None,
+                  transport: Optional[Transport] = None,
+                  min_send_interval_seconds: float = 1.0,
+                  adaptive: bool = False,
+                  max_bytes_per_second: float = 256 * 1024,
+                  low_priority_every: int = 4,
+                  publish_metrics: bool = False,
+                  time_state_lock: bool = False,
+                  json_envelope: Optional[bool] = None ) -> None:
         """
+        sharded selects the lock-free per-thread counter mode of
+        State, which is cheaper when many threads call track().
+        wire_format is codec.WIRE_JSON (readable by any receiver) or
+        codec.WIRE_BINARY (smaller and faster to build and parse).
+        keyframe_every sends the full state every that many intervals
+        and only the keys modified since the previous send (a delta)
+        in between; 1 sends the full state every time.
+        JSON states carry the message header (kind, sequence number,
+        sender id) in an envelope (see codec), which receivers predating
+        it would show as keys; json_envelope defaults to using it only
+        when deltas are sent (keyframe_every > 1), which need it, or
+        when the transport's sender addresses are not distinct (see
+        transport.Transport.distinct_addresses).  Without it, receivers
+        tell senders apart by address.
+        States larger than max_datagram_size are split into chunks
+        (see fragment) which the receiver reassembles; the default
+        keeps datagrams under a typical ethernet MTU.
+        Sends are run by scheduler, by default the one shared by the
+        whole process, and a final send happens at interpreter exit.
+        max_keys, key_ttl_seconds and finished_ttl_seconds bound the
+        keys of the state (see State); expired keys are dropped right
+        before each send.
+        shared_counters (see shared.SharedCounters and share_counters)
+        are folded into the state before each send, publishing the
+        progress of pool workers counting into them.
+        transport (see transport) carries the states; by default a
+        transport.MulticastTransport to multicast_ip:multicast_port.
+        Urgent updates (see State.on_urgent: keys finishing, schema
+        changes, PRIORITY_HIGH keys) are sent right away rather than at
+        the next interval, but at most once every
+        min_send_interval_seconds.  Between keyframes, the updates of
+        PRIORITY_LOW keys are only sent every low_priority_every sends.
+        With adaptive, the interval shrinks towards
+        min_send_interval_seconds while the state keeps changing, as
+        far as sending stays under max_bytes_per_second, and grows back
+        to send_interval_seconds while it is idle.
+        self.metrics (see metrics.Metrics) records the sender's own
+        work: send.serialize and send.transmit timings, send.bytes,
+        send.datagrams, send.retries and send.failures, and with
+        time_state_lock the time spent on the state's lock.  With
+        publish_metrics they are sent along with the state, as keys
+        under self.metrics_prefix (metrics.METRICS_PREFIX by default),
+        as are those of any other Metrics appended to
+        self.metrics_sources.
         """
+        self.metrics = Metrics()
+        self.publish_metrics = publish_metrics
+        self.metrics_prefix = METRICS_PREFIX
+        self.metrics_sources = [ self.metrics ]
         self.send_interval_seconds = send_interval_seconds
-        self.state = State()
-        self.timer_thread = None
+        self.state = State( sharded = sharded,
+                            max_keys = max_keys,
+                            key_ttl_seconds = key_ttl_seconds,
+                            finished_ttl_seconds = finished_ttl_seconds,
+                            metrics = self.metrics if time_state_lock else None )
+        self.scheduler = scheduler
+        self.task = None # type: Optional[Task]
         self.running = False
-        self.multicast_group = ( multicast_ip, multicast_port )
-        self.socket = None
+        if transport is None:
+            transport = MulticastTransport( multicast_ip, multicast_port )
+        self.transport = transport
+        self.opened = False
         self.num_retries = num_retries
+        self.wire_format = wire_format
+        self.keyframe_every = max( 1, keyframe_every )
+        if json_envelope is None:
+            json_envelope = self.keyframe_every > 1
+        self.json_envelope = json_envelope
+        self.sequence = 0
+        self.max_datagram_size = max_datagram_size
+        self.message_id = random.getrandbits( 32 )
+        self.sender_id = None
+        self._sender_pid = None
+        self.shared_counters = shared_counters
+        self.min_send_interval_seconds = min( min_send_interval_seconds,
+                                              send_interval_seconds )
+        self.adaptive = adaptive
+        self.max_bytes_per_second = max_bytes_per_second
+        self.low_priority_every = max( 1, low_priority_every )
+        self._last_send = None # type: Optional[float]
+        self._send_lock = threading.Lock()
 
 
     def __del__(self):
-        self.state = None
-        self.running = False
-
-    def _stop(self):
-        self.state = None
         self.running = False
 
     def pause(self) -> None:
         _log().info( "paused called..." )
         self.running = False
-        if self.timer_thread is not None:
-            self.timer_thread.join()
-            del self.timer_thread
-            self.timer_thread = None
-            _log().info( "  joined timer thread" )
-        if self.socket is not None:
-            self.socket.close()
-            _log().info( "  closed socket" )
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+            _log().info( "  cancelled send task" )
+        with self._send_lock:
+            if self.opened:
+                self.transport.close()
+                self.opened = False
+                _log().info( "  closed transport" )
         _log().info( "paused!" )
 
 
     def start(self) -> None:
         _log().info( "start called..." )
         self.running = True
-        self.timer_thread = threading.Thread(
-            target=self._timer_loop,
-            args=(self.send_interval_seconds, self._send_state) )
-        self._open_socket()
-        self.timer_thread.start()
+        with self._send_lock:
+            self.transport.open_sender()
+            self.opened = True
+        self.state.on_urgent = self._urgent
+        if self.scheduler is None:
+            self.scheduler = default_scheduler()
+        self.task = self.scheduler.schedule( self.send_interval_seconds,
+                                             self._send_state,
+                                             flush_at_exit = True )
         _log().info( "started!" )
 
+
+    def flush(self) -> None:
+        """
+        Sends the state right away, on the calling thread.
+        """
+        self._send_state()
+
+
+    def share_counters( self,
+                        slots: int = 4096,
+                        value_slots: int = 256 ) -> 'SharedCounters':
+        """
+        Creates shared counters for the workers of a process pool and
+        publishes them with this sender's state (see shared.attach).
+        Values the workers record (e.g. track(..., timed=True)) take
+        one of value_slots histograms per worker thread and key; those
+        of further keys are dropped with a warning.
+        """
+        from .shared import SharedCounters
+        if self.shared_counters is None:
+            self.shared_counters = SharedCounters( slots, value_slots = value_slots )
+        return self.shared_counters
+
         
-    def _open_socket(self) -> None:
-        self.socket = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
-        self.socket.setsockopt( socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
-                                struct.pack( 'b', 0 ) )
-        _log().info( "Opened multicast socket" )
+    def _urgent( self, id: str ) -> None:
+        task = self.task
+        if task is None or not self.running:
+            return
+        when = time.monotonic()
+        if self._last_send is not None:
+            when = max( when, self._last_send + self.min_send_interval_seconds )
+        task.run_at( when )
 
 
     def _send_state(self) -> None:
         """
         """
-        state_rep = self.state.representation() + b"\n"
+        with self._send_lock:
+            if not self.opened:
+                return
+            self._send_state_locked()
+
+
+    def _send_state_locked(self) -> None:
+        is_keyframe = ( self.sequence % self.keyframe_every == 0 )
+        header = { 'kind' : codec.KIND_KEYFRAME if is_keyframe else codec.KIND_DELTA,
+                   'seq' : self.sequence,
+                   'sender' : self._identity() }
+        self.sequence += 1
+        if self.shared_counters is not None:
+            self.shared_counters.fold_into( self.state )
+        self.state.expire_keys()
+        hold = None
+        if not is_keyframe and header[ 'seq' ] % self.low_priority_every:
+            hold = self.state.low_priority_keys()
+        changed = self.state.modified()
+        if self.publish_metrics:
+            for metrics in self.metrics_sources:
+                metrics.publish( self.state, self.metrics_prefix )
+        if self.wire_format == codec.WIRE_JSON and not self.json_envelope \
+           and self.transport.distinct_addresses:
+            header = None
+        with self.metrics.timed( 'send.serialize' ):
+            state_rep = self.state.representation( self.wire_format,
+                                                   header = header,
+                                                   delta = not is_keyframe,
+                                                   hold = hold )
+        self._last_send = time.monotonic()
+        if self.adaptive:
+            self._adapt( changed, len(state_rep) )
+        if self.wire_format == codec.WIRE_JSON:
+            state_rep += b"\n"
+        if self.transport.fragmented:
+            messages = fragment.fragments( state_rep,
+                                           self.max_datagram_size,
+                                           self.message_id )
+            self.message_id = ( self.message_id + 1 ) & 0xFFFFFFFF
+        else:
+            messages = [ state_rep ]
+        self.metrics.count( 'send.bytes', len(state_rep) )
+        self.metrics.count( 'send.datagrams', len(messages) )
         for i in range(self.num_retries):
+            if i > 0:
+                self.metrics.count( 'send.retries' )
             try:
-                sent = _fully_send( self.socket,
-                                    self.multicast_group,
-                                    state_rep )
+                with self.metrics.timed( 'send.transmit' ):
+                    sent = self.transport.send( messages )
                 _log().debug( "sent {0}".format( sent ) )
                 if sent is not None:
                     return
             except:
-                pass
+                _log().debug( "error sending state: ", exc_info = True )
+        self.metrics.count( 'send.failures' )
         _log().warning( "Unable to send state after retries!" )
             
 
-    def _timer_loop(self, interval_seconds, F) -> None:
+    def _adapt( self, changed: bool, size: int ) -> None:
         """
+        Halves the send interval while the state changes (down to
+        min_send_interval_seconds, or to the interval keeping size
+        bytes per send under max_bytes_per_second) and doubles it back
+        to send_interval_seconds while it does not.
         """
-        start_time = datetime.datetime.now()
-        last_send_time = start_time
-        _log().info( "  loop start at {0}".format( start_time ) )
-        while self.running:
-
-            now = datetime.datetime.now()
-            if ( now - last_send_time ).total_seconds() >= interval_seconds:
-                try:
-                    last_send_time = now
-                    F()
-                except Exception:
-                    raise
-
-            # sleep
-            try:
-                dt = interval_seconds - ( now - last_send_time ).total_seconds()
-                if dt > 0:
-                    time.sleep( dt )
-            except Exception:
-                pass
-        
+        task = self.task
+        if task is None:
+            return
+        if changed:
+            interval = max( self.min_send_interval_seconds,
+                            size / self.max_bytes_per_second,
+                            task.interval_seconds / 2 )
+        else:
+            interval = task.interval_seconds * 2
+        task.interval_seconds = min( interval, self.send_interval_seconds )
+
+
+    def _identity( self ) -> str:
+        """
+        host/pid/instance, so receivers can keep the states of several
+        senders (processes, or senders within a process) apart.  A
+        forked child gets a new identity.
+        """
+        pid = os.getpid()
+        if self._sender_pid != pid:
+            self._sender_pid = pid
+            self.sender_id = "{0}/{1}/{2:08x}".format(
+                socket.gethostname(), pid, random.getrandbits( 32 ) )
+        return self.sender_id
+
                   
 
 ## ========================================================================
 
-def _fully_send( socket,
-                 address,
-                 rep: bytes ) -> Optional[int]:
+class _DefaultBatchSender( BatchSender ):
     """
+    The process wide sender, started the first time its state is used,
+    so code handing DEFAULT_BATCH_SENDER (or its state) around directly
+    still gets its counts sent.
     """
-    total_n = len(rep)
-    sent_n = 0
-    try:
-        while sent_n < total_n:
-            this_sent = socket.sendto( rep[ sent_n: ],
-                                       address )
-            sent_n += this_sent
-        return sent_n
-    except:
-        _log().exception( "error sending socket data: " )
-        return None
 
-## ========================================================================
+    @property
+    def state( self ) -> State:
+        # running is set first thing in start(), which uses the state
+        if not _DEFAULT_STARTED and not self.running:
+            default_batch_sender()
+        return self._state
 
-DEFAULT_BATCH_SENDER = BatchSender( 10.0 )
-DEFAULT_BATCH_SENDER.start()
-atexit.register(lambda: DEFAULT_BATCH_SENDER._stop() )
+
+    @state.setter
+    def state( self, state: State ) -> None:
+        self._state = state
+
+##
+# The process wide sender.  It is only started (transport opened and send
+# task scheduled) when default_batch_sender() is called or its state is
+# first used, so importing jotify stays cheap for processes which never
+# track anything.
+DEFAULT_BATCH_SENDER = _DefaultBatchSender( 10.0 )
+
+_DEFAULT_STARTED = False
+_DEFAULT_STARTED_PID = None
+_DEFAULT_START_LOCK = threading.Lock()
+
+def default_batch_sender() -> BatchSender:
+    """
+    Returns DEFAULT_BATCH_SENDER, starting it on first use.
+
+    In a pool worker attached to shared counters (see shared.attach),
+    or forked from a process whose default sender shares counters,
+    returns a sender counting into those counters instead, since the
+    worker has no send task of its own.
+    """
+    global _DEFAULT_STARTED, _DEFAULT_STARTED_PID
+    from . import shared
+    attached = shared.attached_sender()
+    if attached is not None:
+        return attached
+    if _DEFAULT_STARTED and _DEFAULT_STARTED_PID != os.getpid() \
+       and DEFAULT_BATCH_SENDER.shared_counters is not None:
+        shared.attach( DEFAULT_BATCH_SENDER.shared_counters )
+        return shared.attached_sender()
+    if not _DEFAULT_STARTED:
+        with _DEFAULT_START_LOCK:
+            if not _DEFAULT_STARTED:
+                DEFAULT_BATCH_SENDER.start()
+                _DEFAULT_STARTED_PID = os.getpid()
+                _DEFAULT_STARTED = True
+    return DEFAULT_BATCH_SENDER
 
 ## ========================================================================
 ## ========================================================================
@@ -0,0 +1,359 @@
+import collections
+import datetime
+import json
+import logging
+import struct
+from typing import Dict, Optional, Tuple
+
+from .histogram import Histogram
+from .timering import TimeRing, epoch_offset
+
+## ========================================================================
+
+def _log():
+    return logging.getLogger( __name__ )
+
+## ========================================================================
+
+WIRE_JSON = 'json'
+WIRE_BINARY = 'binary'
+
+##
+# Binary datagrams start with MAGIC followed by a one byte version.
+# JSON datagrams always start with '{' (possibly after whitespace) so
+# the two can be told apart from the first bytes alone.
+#
+# Version 2 adds a message header (a small dictionary of fields such
+# as the message kind and sequence number) right after the fixed
+# header.  In JSON the header goes into the reserved ENVELOPE_KEY and
+# the stats under 'stats'.
+#
+# Version 3 adds each key's rate and ewma (see timering.TimeRing).
+# Timestamps are epoch seconds on the wire in both formats and local
+# monotonic seconds once decoded.  JSON without an envelope, which
+# receivers predating it read too, keeps 'timehist' as str(datetime)
+# for them and carries the epoch seconds under 'times'.
+#
+# Version 4 adds the value distribution of keys which have one (see
+# histogram.Histogram), as its non-empty buckets only.
+MAGIC = b'JTF'
+VERSION = 4
+SUPPORTED_VERSIONS = ( 1, 2, 3, 4 )
+ENVELOPE_KEY = '__jotify__'
+
+##
+# Message kinds: a keyframe carries the full state of the sender, a
+# delta only the keys modified since the sender's previous message.
+KIND_KEYFRAME = 'key'
+KIND_DELTA = 'delta'
+
+_HEADER = struct.Struct( '<3sBI' )    # magic, version, number of keys
+_MESSAGE_HEADER = struct.Struct( '<H' ) # json message header length
+_KEY = struct.Struct( '<H' )          # utf-8 key length
+_ENTRY_V1 = struct.Struct( '<dBddH' ) # count, flags, min, max, hist length
+_ENTRY = struct.Struct( '<dBddHdd' )  # ... followed by rate, ewma
+_VALUES = struct.Struct( '<ddddH' )   # n, sum, min, max, bucket count
+
+_HAS_MIN = 0x1
+_HAS_MAX = 0x2
+_FINISHED = 0x4
+_HAS_VALUES = 0x8
+
+## ========================================================================
+
+def detect( rep: bytes ) -> str:
+    """
+    Returns the wire format (WIRE_JSON or WIRE_BINARY) of a datagram.
+    """
+    if bytes( rep[ :len(MAGIC) ] ) == MAGIC:
+        return WIRE_BINARY
+    return WIRE_JSON
+
+## ========================================================================
+
+def encode( stats: Dict,
+            wire_format: str = WIRE_JSON,
+            header: Optional[Dict] = None ) -> bytes:
+    if wire_format == WIRE_BINARY:
+        return encode_binary( stats, header )
+    if wire_format == WIRE_JSON:
+        return encode_json( stats, header )
+    raise ValueError( "Unknown wire format '{0}'".format( wire_format ) )
+
+
+def decode( rep: bytes ) -> Dict:
+    """
+    Decodes a datagram of either wire format into a stats dictionary.
+    """
+    return decode_message( rep )[1]
+
+
+def decode_message( rep: bytes ) -> Tuple[Dict,Dict]:
+    """
+    Decodes a datagram of either wire format into its message header
+    (empty for datagrams without one) and stats dictionary.
+    """
+    if detect( rep ) == WIRE_BINARY:
+        return decode_binary( rep )
+    return decode_json( rep )
+
+## ========================================================================
+
+def encode_json( stats: Dict, header: Optional[Dict] = None ) -> bytes:
+    offset = epoch_offset()
+    pod = { key : _pod_entry( entry, offset, plain = not header )
+            for key, entry in stats.items() }
+    if header:
+        obj = { ENVELOPE_KEY : header, 'stats' : pod }
+    else:
+        obj = pod
+    rep = json.dumps( obj ).encode( 'utf-8' )
+    if len(rep) % 2 == 0:
+        return rep + b" "
+    return rep
+
+
+def decode_json( rep: bytes ) -> Tuple[Dict,Dict]:
+    obj = json.loads( bytes( rep ).decode('utf-8').strip() )
+    header = {}
+    if ENVELOPE_KEY in obj:
+        header, obj = obj[ ENVELOPE_KEY ], obj[ 'stats' ]
+    offset = epoch_offset()
+    stats = {}
+    for key, entry in obj.items():
+        times = entry.get( 'times' )
+        if times is None:
+            times = entry.get( 'timehist', () )
+        times = [ _monotonic( t, offset ) for t in times ]
+        stats[ key ] = {
+            'count' : entry.get( 'count', 0.0 ),
+            'min' : entry.get( 'min' ),
+            'max' : entry.get( 'max' ),
+            'timehist' : TimeRing.from_values( len(times),
+                                               times,
+                                               entry.get( 'rate', 0.0 ),
+                                               entry.get( 'ewma', 0.0 ) ) }
+        if entry.get( 'finished' ):
+            stats[ key ][ 'finished' ] = True
+        values = entry.get( 'values' )
+        if values:
+            stats[ key ][ 'values' ] = Histogram.from_sparse(
+                values[ 'buckets' ], values[ 'counts' ],
+                values[ 'n' ], values[ 'sum' ], values[ 'min' ], values[ 'max' ] )
+    return header, stats
+
+
+def _pod_entry( entry: Dict, offset: float, plain: bool = False ) -> Dict:
+    """
+    The JSON form of a stats entry; plain for JSON without an envelope.
+    """
+    pod = podify( { k : v for k, v in entry.items()
+                    if k not in ( 'timehist', 'values' ) } )
+    values = entry.get( 'values' )
+    if isinstance( values, Histogram ) and values.n:
+        indices, counts = values.sparse()
+        pod[ 'values' ] = { 'n' : values.n,
+                            'sum' : values.sum,
+                            'min' : values.min,
+                            'max' : values.max,
+                            'buckets' : indices,
+                            'counts' : counts }
+    ring = entry.get( 'timehist' )
+    if isinstance( ring, TimeRing ):
+        times = ring.epoch_times( offset )
+        if plain:
+            pod[ 'timehist' ] = [ str( datetime.datetime.fromtimestamp( t ) )
+                                  for t in times ]
+            pod[ 'times' ] = times
+        else:
+            pod[ 'timehist' ] = times
+        pod[ 'rate' ] = ring.rate
+        pod[ 'ewma' ] = ring.ewma
+    elif ring is not None:
+        pod[ 'timehist' ] = podify( ring )
+    return pod
+
+## ========================================================================
+
+def encode_binary( stats: Dict, header: Optional[Dict] = None ) -> bytes:
+    """
+    Packs the stats as
+      header : magic, version, number of keys,
+               message header length, message header as json
+      per key: key length, utf-8 key, count, min/max flags, min, max,
+               number of timestamps, rate, ewma,
+               timestamps as float epoch seconds,
+               and if flagged the value distribution: n, sum, min,
+               max, number of buckets, bucket indices, bucket counts
+    all little-endian.
+    """
+    offset = epoch_offset()
+    message_header = json.dumps(
+        header or {}, separators=(',',':') ).encode( 'utf-8' )
+    parts = [ _HEADER.pack( MAGIC, VERSION, len(stats) ),
+              _MESSAGE_HEADER.pack( len(message_header) ),
+              message_header ]
+    for key, entry in stats.items():
+        name = key.encode( 'utf-8' )
+        flags = 0
+        lo = entry.get( 'min' )
+        hi = entry.get( 'max' )
+        if lo is not None:
+            flags |= _HAS_MIN
+        if hi is not None:
+            flags |= _HAS_MAX
+        if entry.get( 'finished' ):
+            flags |= _FINISHED
+        values = entry.get( 'values' )
+        if isinstance( values, Histogram ) and values.n:
+            flags |= _HAS_VALUES
+        ring = entry.get( 'timehist' )
+        if isinstance( ring, TimeRing ):
+            times = ring.epoch_times( offset )
+            rate, ewma = ring.rate, ring.ewma
+        else:
+            times = [ _epoch( t ) for t in ( ring or () ) ]
+            rate, ewma = 0.0, 0.0
+        parts.append( _KEY.pack( len(name) ) )
+        parts.append( name )
+        parts.append( _ENTRY.pack( float( entry.get( 'count', 0.0 ) ),
+                                   flags,
+                                   float( lo ) if lo is not None else 0.0,
+                                   float( hi ) if hi is not None else 0.0,
+                                   len(times),
+                                   rate,
+                                   ewma ) )
+        if times:
+            parts.append( struct.pack( '<{0}d'.format( len(times) ),
+                                       *times ) )
+        if flags & _HAS_VALUES:
+            indices, counts = values.sparse()
+            parts.append( _VALUES.pack( values.n, values.sum,
+                                        values.min, values.max,
+                                        len(indices) ) )
+            parts.append( struct.pack( '<{0}H{0}I'.format( len(indices) ),
+                                       *indices,
+                                       *[ min( int( c ), 0xFFFFFFFF )
+                                          for c in counts ] ) )
+    return b''.join( parts )
+
+
+def decode_binary( rep: bytes ) -> Tuple[Dict,Dict]:
+    """
+    Inverse of encode_binary, returning the message header and stats;
+    each key's history is returned as a TimeRing.  Raises ValueError
+    for unknown versions or truncated datagrams.
+    """
+    epoch = epoch_offset()
+    view = memoryview( rep )
+    try:
+        magic, version, n = _HEADER.unpack_from( view, 0 )
+        if magic != MAGIC:
+            raise ValueError( "Not a binary jotify datagram" )
+        if version not in SUPPORTED_VERSIONS:
+            raise ValueError(
+                "Unsupported binary wire version {0}".format( version ) )
+        offset = _HEADER.size
+        header = {}
+        if version >= 2:
+            ( header_n, ) = _MESSAGE_HEADER.unpack_from( view, offset )
+            offset += _MESSAGE_HEADER.size
+            if header_n:
+                header = json.loads(
+                    bytes( view[ offset:offset + header_n ] ).decode('utf-8') )
+            offset += header_n
+        stats = {}
+        for _ in range( n ):
+            ( key_n, ) = _KEY.unpack_from( view, offset )
+            offset += _KEY.size
+            key = bytes( view[ offset:offset + key_n ] ).decode( 'utf-8' )
+            offset += key_n
+            if version >= 3:
+                count, flags, lo, hi, hist_n, rate, ewma = _ENTRY.unpack_from(
+                    view, offset )
+                offset += _ENTRY.size
+            else:
+                count, flags, lo, hi, hist_n = _ENTRY_V1.unpack_from( view, offset )
+                offset += _ENTRY_V1.size
+                rate, ewma = 0.0, 0.0
+            times = struct.unpack_from( '<{0}d'.format( hist_n ),
+                                        view, offset )
+            offset += 8 * hist_n
+            stats[ key ] = {
+                'count' : count,
+                'min' : lo if flags & _HAS_MIN else None,
+                'max' : hi if flags & _HAS_MAX else None,
+                'timehist' : TimeRing.from_values(
+                    hist_n, [ t - epoch for t in times ], rate, ewma ) }
+            if flags & _FINISHED:
+                stats[ key ][ 'finished' ] = True
+            if flags & _HAS_VALUES:
+                values_n, total, lo, hi, buckets_n = _VALUES.unpack_from(
+                    view, offset )
+                offset += _VALUES.size
+                buckets = struct.unpack_from(
+                    '<{0}H{0}I'.format( buckets_n ), view, offset )
+                offset += 6 * buckets_n
+                stats[ key ][ 'values' ] = Histogram.from_sparse(
+                    buckets[ :buckets_n ], buckets[ buckets_n: ],
+                    values_n, total, lo, hi )
+        return header, stats
+    except struct.error as e:
+        raise ValueError( "Truncated binary jotify datagram: {0}".format( e ) )
+    finally:
+        view.release()
+
+## ========================================================================
+
+def podify( x ):
+    if x is None:
+        return x
+    if isinstance( x, ( str, int, float ) ):
+        return x
+    if isinstance( x, TimeRing ):
+        return x.epoch_times()
+    if isinstance( x, collections.deque ):
+        return podify( list( x ) )
+    if isinstance( x, (list,tuple) ):
+        return list(map(podify,x))
+    if isinstance( x, dict ):
+        return dict(map(podify,x.items()))
+    return str( x )
+
+## ========================================================================
+
+def _monotonic( t, offset: float ) -> float:
+    """
+    Converts a received timestamp (epoch seconds, or str(datetime)
+    from older senders) to local monotonic seconds.
+    """
+    return _epoch( t ) - offset
+
+
+def _epoch( t ) -> float:
+    if isinstance( t, datetime.datetime ):
+        return t.timestamp()
+    if isinstance( t, ( int, float ) ):
+        return float( t )
+    return parse_time( t ).timestamp()
+
+
+def parse_time( t ) -> datetime.datetime:
+    """
+    Timestamps from older senders arrive as str(datetime).
+    """
+    if isinstance( t, datetime.datetime ):
+        return t
+    if isinstance( t, ( int, float ) ):
+        return datetime.datetime.fromtimestamp( t )
+    try:
+        return datetime.datetime.fromisoformat( t )
+    except ( AttributeError, ValueError ):
+        import dateutil.parser
+        return dateutil.parser.parse( t )
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
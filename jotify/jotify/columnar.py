@@ -0,0 +1,253 @@
+import logging
+import time
+from typing import Dict, List, Optional
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .state import State
+
+## ========================================================================
+
+def _log():
+    return logging.getLogger( __name__ )
+
+## ========================================================================
+
+class ColumnarSnapshot( object ):
+    """
+    The result of one batched statistics pass over a ColumnarStore.
+
+    keys[i] names row i of every column:
+      counts   : count summed over senders
+      totals   : expected number of items (summed schema ranges), nan
+                 unless every sender of the key has a schema
+      percent  : 100 * counts / totals, nan without a total
+      rates    : windowed items/s summed over senders
+      ewma     : smoothed items/s summed over senders
+      eta      : seconds to reach the total at the smoothed rate, nan
+                 when unknown
+      last     : monotonic time of the most recent update
+      age      : seconds since the most recent update
+      stale    : age above the store's stale_seconds
+      times    : (keys x max_hist) ring of recent update times, with
+                 ring_start/ring_size locating each row's entries
+    The arrays are copies and safe to keep.
+    """
+
+    def __init__( self, **columns ) -> None:
+        self.__dict__.update( columns )
+
+
+    def __len__( self ) -> int:
+        return len(self.keys)
+
+
+    def row( self, key: str ) -> Dict:
+        i = self.key_ids[ key ]
+        return { 'count' : float( self.counts[i] ),
+                 'total' : float( self.totals[i] ),
+                 'percent' : float( self.percent[i] ),
+                 'rate' : float( self.rates[i] ),
+                 'ewma' : float( self.ewma[i] ),
+                 'eta' : float( self.eta[i] ),
+                 'age' : float( self.age[i] ),
+                 'stale' : bool( self.stale[i] ) }
+
+## ========================================================================
+
+class ColumnarStore( object ):
+    """
+    Per-key statistics aggregated over senders, held in NumPy columns
+    indexed through a key-id table.
+
+    apply() folds a sender's received entries into the columns by
+    replacing that sender's previous contribution, so only the keys a
+    datagram carries are touched.  snapshot() computes percent
+    complete, ETA, age and staleness for every key in one vectorized
+    pass.  Keys no sender contributes to any more are left out, and
+    their rows are reclaimed once they make up half of the store.
+    Not thread-safe; callers serialize access.
+    """
+
+    def __init__( self,
+                  max_hist: int = 10,
+                  stale_seconds: float = 30.0,
+                  capacity: int = 1024 ) -> None:
+        if np is None:
+            raise ImportError( "ColumnarStore requires numpy" )
+        self.max_hist = max_hist
+        self.stale_seconds = stale_seconds
+        self.key_ids = {} # type: Dict[str,int]
+        self.keys = [] # type: List[str]
+        self._contributions = {} # type: Dict[str,Dict[int,tuple]]
+        self._allocate( max( 1, capacity ) )
+
+
+    def apply( self, sender_id: str, state: State ) -> None:
+        contributions = self._contributions.setdefault( sender_id, {} )
+        with state.lock:
+            for key, entry in state.stats.items():
+                kid = self._key_id( key )
+                ring = entry[ 'timehist' ]
+                lo, hi = entry.get( 'min' ), entry.get( 'max' )
+                new = ( entry[ 'count' ],
+                        hi - lo + 1 if lo is not None and hi is not None else None,
+                        ring.rate,
+                        ring.ewma )
+                old = contributions.get( kid )
+                if old is not None:
+                    self._contribute( kid, old, -1 )
+                else:
+                    self.senders[ kid ] += 1
+                self._contribute( kid, new, +1 )
+                contributions[ kid ] = new
+                last = ring.last
+                if last is not None and last > self.last[ kid ]:
+                    self._push_time( kid, last )
+
+
+    def remove_sender( self, sender_id: str ) -> None:
+        """
+        Takes the contributions of an expired sender out of the totals.
+        """
+        for kid, old in self._contributions.pop( sender_id, {} ).items():
+            self._contribute( kid, old, -1 )
+            self.senders[ kid ] -= 1
+
+
+    def retain( self, sender_id: str, keys ) -> None:
+        """
+        Takes out the contributions of a sender to keys not in keys
+        (those it removed, or which expired).
+        """
+        contributions = self._contributions.get( sender_id )
+        if not contributions or len(contributions) <= len(keys):
+            return
+        for kid in [ kid for kid in contributions if self.keys[ kid ] not in keys ]:
+            self._contribute( kid, contributions.pop( kid ), -1 )
+            self.senders[ kid ] -= 1
+
+
+    def snapshot( self, now: Optional[float] = None ) -> ColumnarSnapshot:
+        if now is None:
+            now = time.monotonic()
+        n = len(self.keys)
+        live = self.senders[ :n ] > 0
+        if 2 * np.count_nonzero( live ) <= n and n > 0:
+            self._compact( live )
+            n = len(self.keys)
+            live = self.senders[ :n ] > 0
+        rows = np.flatnonzero( live )
+        keys = [ self.keys[ i ] for i in rows ]
+        counts = self.counts[ rows ]
+        has_total = self.schemas[ rows ] == self.senders[ rows ]
+        totals = np.where( has_total, self.spans[ rows ], np.nan )
+        rates = self.rates[ rows ]
+        ewma = self.ewma[ rows ]
+        last = self.last[ rows ]
+        with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+            percent = 100.0 * counts / totals
+            speed = np.where( ewma > 0, ewma, rates )
+            eta = np.where( speed > 0,
+                            np.maximum( totals - counts, 0.0 ) / speed,
+                            np.nan )
+        age = now - last
+        return ColumnarSnapshot(
+            keys = keys,
+            key_ids = { key : i for i, key in enumerate( keys ) },
+            counts = counts,
+            totals = totals,
+            percent = percent,
+            rates = rates,
+            ewma = ewma,
+            eta = eta,
+            last = last,
+            age = age,
+            stale = age > self.stale_seconds,
+            times = self.times[ rows ],
+            ring_start = self.ring_start[ rows ],
+            ring_size = self.ring_size[ rows ] )
+
+
+    def _compact( self, live ) -> None:
+        """
+        Drops the rows of keys without contributions and renumbers the
+        others.
+        """
+        rows = np.flatnonzero( live )
+        renumber = { int( old ) : new for new, old in enumerate( rows ) }
+        _log().debug( "compacting {0} of {1} key rows".format(
+            len(self.keys) - len(rows), len(self.keys) ) )
+        capacity = len(self.counts)
+        for name in ( 'counts', 'spans', 'schemas', 'senders', 'rates',
+                      'ewma', 'last', 'times', 'ring_start', 'ring_size' ):
+            setattr( self, name, getattr( self, name )[ rows ] )
+        self._allocate( capacity )
+        self.keys = [ self.keys[ i ] for i in rows ]
+        self.key_ids = { key : i for i, key in enumerate( self.keys ) }
+        self._contributions = {
+            sender_id : { renumber[ kid ] : values
+                          for kid, values in contributions.items() }
+            for sender_id, contributions in self._contributions.items() }
+
+
+    def _contribute( self, kid: int, values: tuple, sign: int ) -> None:
+        count, span, rate, ewma = values
+        self.counts[ kid ] += sign * count
+        if span is not None:
+            self.spans[ kid ] += sign * span
+            self.schemas[ kid ] += sign
+        self.rates[ kid ] += sign * rate
+        self.ewma[ kid ] += sign * ewma
+
+
+    def _push_time( self, kid: int, t: float ) -> None:
+        size = self.ring_size[ kid ]
+        start = self.ring_start[ kid ]
+        if size < self.max_hist:
+            self.times[ kid, ( start + size ) % self.max_hist ] = t
+            self.ring_size[ kid ] = size + 1
+        else:
+            self.times[ kid, start ] = t
+            self.ring_start[ kid ] = ( start + 1 ) % self.max_hist
+        self.last[ kid ] = t
+
+
+    def _key_id( self, key: str ) -> int:
+        kid = self.key_ids.get( key )
+        if kid is None:
+            kid = len(self.keys)
+            if kid >= len(self.counts):
+                self._allocate( 2 * len(self.counts) )
+            self.key_ids[ key ] = kid
+            self.keys.append( key )
+        return kid
+
+
+    def _allocate( self, capacity: int ) -> None:
+        def grow( old, fill, dtype, shape = () ):
+            new = np.full( ( capacity, ) + shape, fill, dtype = dtype )
+            if old is not None:
+                new[ :len(old) ] = old
+            return new
+        get = lambda name: getattr( self, name, None )
+        self.counts = grow( get( 'counts' ), 0.0, np.float64 )
+        self.spans = grow( get( 'spans' ), 0.0, np.float64 )
+        self.schemas = grow( get( 'schemas' ), 0, np.int64 )
+        self.senders = grow( get( 'senders' ), 0, np.int64 )
+        self.rates = grow( get( 'rates' ), 0.0, np.float64 )
+        self.ewma = grow( get( 'ewma' ), 0.0, np.float64 )
+        self.last = grow( get( 'last' ), -np.inf, np.float64 )
+        self.times = grow( get( 'times' ), np.nan, np.float64,
+                           ( self.max_hist, ) )
+        self.ring_start = grow( get( 'ring_start' ), 0, np.int64 )
+        self.ring_size = grow( get( 'ring_size' ), 0, np.int64 )
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
@@ -0,0 +1,189 @@
+import collections
+import logging
+import struct
+import time
+from typing import Any, List, Optional
+
+## ========================================================================
+
+def _log():
+    return logging.getLogger( __name__ )
+
+## ========================================================================
+
+##
+# Messages larger than one datagram are split into chunks, each
+# prefixed with a chunk header.  Chunks start with CHUNK_MAGIC, which
+# neither wire format (see codec) starts with, so a receiver can tell a
+# chunk from a whole message by its first bytes.  Messages that fit
+# into a single datagram are sent as-is.
+CHUNK_MAGIC = b'JTC'
+CHUNK_VERSION = 1
+
+# magic, version, message id, chunk index, chunk count,
+# total message length, offset of this chunk in the message
+_CHUNK = struct.Struct( '<3sBIHHII' )
+
+CHUNK_HEADER_SIZE = _CHUNK.size
+MAX_CHUNKS = 0xFFFF
+
+##
+# Largest UDP payload; a receive buffer of this size never truncates.
+MAX_DATAGRAM_SIZE = 65535
+
+## ========================================================================
+
+def is_chunk( datagram: bytes ) -> bool:
+    return bytes( datagram[ :len(CHUNK_MAGIC) ] ) == CHUNK_MAGIC
+
+
+def fragments( rep: bytes,
+               max_datagram_size: int,
+               message_id: int ) -> List[bytes]:
+    """
+    Splits rep into datagrams of at most max_datagram_size bytes.
+    A rep which already fits is returned unchanged as the only
+    element.
+    """
+    if len(rep) <= max_datagram_size:
+        return [ rep ]
+    chunk_n = max_datagram_size - CHUNK_HEADER_SIZE
+    if chunk_n <= 0:
+        raise ValueError( "max_datagram_size {0} leaves no room for data".format(
+            max_datagram_size ) )
+    count = ( len(rep) + chunk_n - 1 ) // chunk_n
+    if count > MAX_CHUNKS:
+        raise ValueError( "Message of {0} bytes needs more than {1} chunks".format(
+            len(rep), MAX_CHUNKS ) )
+    view = memoryview( rep )
+    chunks = []
+    for index in range( count ):
+        offset = index * chunk_n
+        chunks.append( _CHUNK.pack( CHUNK_MAGIC,
+                                    CHUNK_VERSION,
+                                    message_id & 0xFFFFFFFF,
+                                    index,
+                                    count,
+                                    len(rep),
+                                    offset )
+                       + view[ offset:offset + chunk_n ] )
+    view.release()
+    return chunks
+
+## ========================================================================
+
+class _Partial( object ):
+
+    def __init__( self, total: int, count: int, started: float ) -> None:
+        self.buff = bytearray( total )
+        self.count = count
+        self.started = started
+        self.received = set()
+
+## ========================================================================
+
+class Reassembler( object ):
+    """
+    Collects chunks into whole messages.
+
+    Each message's buffer is allocated once at its final size when its
+    first chunk arrives, and chunks are copied straight into place.
+    Partial messages are dropped after timeout_seconds, messages larger
+    than max_message_bytes are refused, and the oldest partial
+    messages are evicted to keep the total under max_pending_bytes.
+    dropped counts the chunks and messages dropped, oversize the
+    messages refused for their size.
+    """
+
+    def __init__( self,
+                  max_message_bytes: int,
+                  max_pending_bytes: int,
+                  timeout_seconds: float = 5.0 ) -> None:
+        self.max_message_bytes = max_message_bytes
+        self.max_pending_bytes = max_pending_bytes
+        self.timeout_seconds = timeout_seconds
+        self.pending = collections.OrderedDict()
+        self.pending_bytes = 0
+        self.dropped = 0
+        self.oversize = 0
+
+
+    def add( self,
+             source: Any,
+             datagram: bytes ) -> Optional[bytearray]:
+        """
+        Adds a chunk received from source (e.g. the sender address).
+        Returns the whole message once its last chunk arrives, None
+        otherwise.
+        """
+        now = time.monotonic()
+        self._expire( now )
+        try:
+            ( magic, version, message_id, index, count, total, offset
+            ) = _CHUNK.unpack_from( datagram, 0 )
+        except struct.error:
+            _log().warning( "  dropping truncated chunk" )
+            self.dropped += 1
+            return None
+        if version != CHUNK_VERSION:
+            _log().warning( "  dropping chunk of unknown version {0}".format(
+                version ) )
+            self.dropped += 1
+            return None
+        payload = datagram[ CHUNK_HEADER_SIZE: ]
+        if index >= count or offset + len(payload) > total:
+            _log().warning( "  dropping malformed chunk" )
+            self.dropped += 1
+            return None
+
+        key = ( source, message_id )
+        partial = self.pending.get( key )
+        if partial is None:
+            if total > self.max_message_bytes or total > self.max_pending_bytes:
+                _log().warning(
+                    "  dropping message of {0} bytes (maximum is {1})".format(
+                        total, self.max_message_bytes ) )
+                self.dropped += 1
+                self.oversize += 1
+                return None
+            while self.pending and self.pending_bytes + total > self.max_pending_bytes:
+                self._evict_oldest()
+            partial = _Partial( total, count, now )
+            self.pending[ key ] = partial
+            self.pending_bytes += total
+        elif partial.count != count or len(partial.buff) != total:
+            _log().warning( "  dropping chunk inconsistent with its message" )
+            self.dropped += 1
+            return None
+
+        if index in partial.received:
+            return None
+        partial.buff[ offset:offset + len(payload) ] = payload
+        partial.received.add( index )
+        if len(partial.received) < partial.count:
+            return None
+        del self.pending[ key ]
+        self.pending_bytes -= total
+        return partial.buff
+
+
+    def _expire( self, now: float ) -> None:
+        while self.pending:
+            partial = next( iter( self.pending.values() ) )
+            if now - partial.started < self.timeout_seconds:
+                break
+            _log().info( "  reassembly timed out after {0}/{1} chunks".format(
+                len(partial.received), partial.count ) )
+            self._evict_oldest()
+
+
+    def _evict_oldest( self ) -> None:
+        _, partial = self.pending.popitem( last = False )
+        self.pending_bytes -= len(partial.buff)
+        self.dropped += 1
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
@@ -0,0 +1,101 @@
+import logging
+from typing import Optional
+
+from .state_ui import UI
+
+from gi.repository import GLib
+
+## ========================================================================
+
+def _log():
+    return logging.getLogger( __name__ )
+
+## ========================================================================
+
+class GLibUI( UI ):
+    """
+    A UI which runs entirely on the GLib main loop (e.g. of a GTK
+    application), without threads of its own.
+
+    The transport's socket is watched with GLib.io_add_watch and
+    drained whenever it is readable, and syncs run from
+    GLib.timeout_add, so listeners are called on the main loop and may
+    touch widgets directly.  Transports without a socket (e.g.
+    transport.SharedMemoryTransport) are polled every
+    receive_sleep_seconds.  Takes the same arguments as UI; scheduler
+    is unused.  Nothing runs between datagrams and syncs, and syncs
+    only call the listeners when something changed.
+    """
+
+    def __init__( self, *args, **kwargs ) -> None:
+        super().__init__( *args, **kwargs )
+        self.watch_id = None # type: Optional[int]
+        self.sync_id = None # type: Optional[int]
+
+
+    def start(self) -> None:
+        _log().info( "start GLibUI called..." )
+        self.running = True
+        self.transport.open_receiver( 0.0 )
+        if self.transport.socket is not None:
+            self.transport.socket.setblocking( False )
+            self.watch_id = GLib.io_add_watch(
+                self.transport.socket.fileno(),
+                GLib.PRIORITY_DEFAULT,
+                GLib.IO_IN,
+                self._on_readable )
+        else:
+            self.watch_id = GLib.timeout_add(
+                int( self.receive_sleep_seconds * 1000 ),
+                self._on_poll )
+        self.sync_id = GLib.timeout_add(
+            int( self.refresh_interval_seconds * 1000 ),
+            self._on_sync )
+        _log().info( "GLibUI started!" )
+
+
+    def pause(self) -> None:
+        _log().info( "paused GLibUI called..." )
+        self.running = False
+        for source_id in ( self.watch_id, self.sync_id ):
+            if source_id is not None:
+                GLib.source_remove( source_id )
+        self.watch_id = None
+        self.sync_id = None
+        self.transport.close()
+        if self.recorder is not None:
+            self.recorder.flush()
+        _log().info( "GLibUI paused!" )
+
+
+    def _sync_soon(self) -> None:
+        GLib.idle_add( self._on_sync_once )
+
+
+    def _on_readable( self, fd: int, condition: int ) -> bool:
+        self._drain()
+        return self.running
+
+
+    def _on_poll(self) -> bool:
+        self._drain()
+        return self.running
+
+
+    def _on_sync(self) -> bool:
+        try:
+            self._sync_state()
+        except Exception:
+            _log().exception( "error syncing: " )
+        return self.running
+
+
+    def _on_sync_once(self) -> bool:
+        self._on_sync()
+        return False
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
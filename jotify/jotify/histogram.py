@@ -0,0 +1,178 @@
+import array
+import math
+from typing import Dict, Iterable, List, Optional, Tuple
+
+## ========================================================================
+
+##
+# Bucket i holds the values in [MIN_VALUE * GAMMA^i, MIN_VALUE * GAMMA^(i+1)),
+# so quantiles are within GAMMA - 1 (relative) of the true value.
+# Values up to MIN_VALUE (including zero and negative ones) go into the
+# first bucket and values past the range into the last one; the 1024
+# buckets span 1e-9 to about 2.6e8, e.g. nanoseconds to years.
+BUCKETS = 1024
+GAMMA = 1.04
+MIN_VALUE = 1e-9
+
+_LOG_GAMMA = math.log( GAMMA )
+_LOG_MIN = math.log( MIN_VALUE )
+
+## ========================================================================
+
+class Histogram( object ):
+    """
+    The distribution of the values recorded for one key (e.g. the
+    processing time of each item), in BUCKETS log-spaced buckets.
+
+    record() is O(1) and the size is fixed whatever the number of
+    values.  Histograms of the same key from several senders (or
+    threads) add up bucket by bucket (see merge), and quantile()
+    answers percentile queries on the result.  The exact number, sum,
+    minimum and maximum of the values are kept alongside.
+    """
+
+    __slots__ = ( 'counts', 'n', 'sum', 'min', 'max' )
+
+    def __init__( self ) -> None:
+        self.counts = array.array( 'd', bytes( 8 * BUCKETS ) )
+        self.n = 0.0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+
+    def record( self, value: float ) -> None:
+        self.counts[ bucket( value ) ] += 1
+        self.n += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+
+    def merge( self,
+               other: 'Histogram',
+               since: Optional['Histogram'] = None ) -> None:
+        """
+        Adds the values of other, or only those recorded into other
+        after it was copied as since.
+        """
+        counts = self.counts
+        if since is None:
+            for i, c in enumerate( other.counts ):
+                if c:
+                    counts[ i ] += c
+            self.n += other.n
+            self.sum += other.sum
+        else:
+            for i, ( c, c0 ) in enumerate( zip( other.counts, since.counts ) ):
+                if c != c0:
+                    counts[ i ] += c - c0
+            self.n += other.n - since.n
+            self.sum += other.sum - since.sum
+        self.min = min( self.min, other.min )
+        self.max = max( self.max, other.max )
+
+
+    def quantile( self, q: float ) -> Optional[float]:
+        """
+        The value below which a fraction q (0 to 1) of the values fall,
+        None if there are none.
+        """
+        if self.n <= 0:
+            return None
+        rank = q * self.n
+        seen = 0.0
+        for i, c in enumerate( self.counts ):
+            if not c:
+                continue
+            seen += c
+            if seen >= rank:
+                return min( self.max, max( self.min, bucket_value( i ) ) )
+        return self.max
+
+
+    @property
+    def mean( self ) -> Optional[float]:
+        return self.sum / self.n if self.n > 0 else None
+
+
+    def __len__( self ) -> int:
+        return int( self.n )
+
+
+    def __deepcopy__( self, memo ) -> 'Histogram':
+        return self.copy()
+
+
+    def copy( self ) -> 'Histogram':
+        h = Histogram.__new__( Histogram )
+        h.counts = array.array( 'd', self.counts )
+        h.n = self.n
+        h.sum = self.sum
+        h.min = self.min
+        h.max = self.max
+        return h
+
+
+    def sparse( self ) -> Tuple[List[int],List[float]]:
+        """
+        The indices and counts of the non-empty buckets, for sending.
+        """
+        indices = [ i for i, c in enumerate( self.counts ) if c ]
+        return indices, [ self.counts[ i ] for i in indices ]
+
+
+    @classmethod
+    def from_sparse( cls,
+                     indices: Iterable[int],
+                     counts: Iterable[float],
+                     n: float,
+                     sum: float,
+                     min: float,
+                     max: float ) -> 'Histogram':
+        """
+        Inverse of sparse, along with the exact n, sum, min and max.
+        """
+        h = cls()
+        for i, c in zip( indices, counts ):
+            if 0 <= i < BUCKETS:
+                h.counts[ i ] += c
+        h.n = n
+        h.sum = sum
+        h.min = min
+        h.max = max
+        return h
+
+## ========================================================================
+
+def bucket( value: float ) -> int:
+    if value <= MIN_VALUE:
+        return 0
+    i = int( ( math.log( value ) - _LOG_MIN ) / _LOG_GAMMA )
+    return i if i < BUCKETS else BUCKETS - 1
+
+
+def bucket_value( i: int ) -> float:
+    """
+    The value a bucket stands for: the midpoint of its bounds.
+    """
+    return MIN_VALUE * GAMMA ** i * ( 1.0 + GAMMA ) / 2.0
+
+
+def percentile( entry: Dict, p: float ) -> Optional[float]:
+    """
+    The p-th percentile (0 to 100) of the values recorded for a key
+    (see State.record), None when it has none.
+    """
+    values = entry.get( 'values' )
+    if not isinstance( values, Histogram ):
+        return None
+    return values.quantile( p / 100.0 )
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
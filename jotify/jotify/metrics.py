@@ -0,0 +1,154 @@
+import contextlib
+import logging
+import threading
+import time
+from typing import Dict, Iterator, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .state import State
+
+## ========================================================================
+
+def _log():
+    return logging.getLogger( __name__ )
+
+## ========================================================================
+
+##
+# Keys under which metrics are published in a state (see Metrics.publish);
+# user keys should not start with it.
+METRICS_PREFIX = '__jotify__.'
+
+## ========================================================================
+
+class _Timing( object ):
+
+    def __init__( self ) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+## ========================================================================
+
+class Metrics( object ):
+    """
+    Counters, gauges and timings of jotify's own work, e.g. how long a
+    BatchSender takes to serialize its state and how many bytes it
+    sends, or how many datagrams a UI receives and drops.
+
+    count(), gauge() and time() are cheap and thread-safe; snapshot()
+    returns every metric as a flat name -> value dict, a timing t
+    giving t.count, t.total_seconds, t.mean_seconds and t.max_seconds.
+    """
+
+    def __init__( self ) -> None:
+        self.lock = threading.Lock()
+        self._counters = {} # type: Dict[str,float]
+        self._gauges = {} # type: Dict[str,float]
+        self._timings = {} # type: Dict[str,_Timing]
+
+
+    def count( self, name: str, n: float = 1 ) -> None:
+        with self.lock:
+            self._counters[ name ] = self._counters.get( name, 0 ) + n
+
+
+    def gauge( self, name: str, value: float ) -> None:
+        with self.lock:
+            self._gauges[ name ] = value
+
+
+    def time( self, name: str, seconds: float ) -> None:
+        with self.lock:
+            timing = self._timings.get( name )
+            if timing is None:
+                timing = self._timings[ name ] = _Timing()
+            timing.count += 1
+            timing.total += seconds
+            if seconds > timing.max:
+                timing.max = seconds
+
+
+    @contextlib.contextmanager
+    def timed( self, name: str ) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.time( name, time.perf_counter() - started )
+
+
+    def snapshot( self ) -> Dict[str,float]:
+        with self.lock:
+            result = dict( self._counters )
+            result.update( self._gauges )
+            for name, timing in self._timings.items():
+                result[ name + '.count' ] = timing.count
+                result[ name + '.total_seconds' ] = timing.total
+                result[ name + '.mean_seconds' ] = timing.total / timing.count
+                result[ name + '.max_seconds' ] = timing.max
+        return result
+
+
+    def reset( self ) -> None:
+        with self.lock:
+            self._counters = {}
+            self._gauges = {}
+            self._timings = {}
+
+
+    def publish( self,
+                 state: 'State',
+                 prefix: str = METRICS_PREFIX ) -> None:
+        """
+        Sets every metric as a key of state, named prefix + name.
+        """
+        for name, value in self.snapshot().items():
+            state.set( prefix + name, value )
+
+## ========================================================================
+
+class TimedLock( object ):
+    """
+    A lock recording how long it is waited for and held, as the
+    timings name.wait and name.hold of metrics.
+    """
+
+    def __init__( self, metrics: Metrics, name: str ) -> None:
+        self.metrics = metrics
+        self.name = name
+        self._lock = threading.Lock()
+        self._acquired = 0.0
+
+
+    def acquire( self, blocking: bool = True, timeout: float = -1 ) -> bool:
+        started = time.perf_counter()
+        acquired = self._lock.acquire( blocking, timeout )
+        if acquired:
+            self._acquired = time.perf_counter()
+            self.metrics.time( self.name + '.wait', self._acquired - started )
+        return acquired
+
+
+    def release( self ) -> None:
+        held = time.perf_counter() - self._acquired
+        self._lock.release()
+        self.metrics.time( self.name + '.hold', held )
+
+
+    def locked( self ) -> bool:
+        return self._lock.locked()
+
+
+    def __enter__( self ) -> bool:
+        return self.acquire()
+
+
+    def __exit__( self, *exc ) -> None:
+        self.release()
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
@@ -1,9 +1,16 @@
-import inspect
+import contextlib
 import logging
-import pathlib
-from typing import Iterable, Any, Optional
+import os
+import sys
+import time
+from typing import Dict, Iterable, Iterator, Any, Optional, Tuple, AsyncIterable, AsyncIterator, Awaitable, TYPE_CHECKING
 
-from .batch_sender import BatchSender, DEFAULT_BATCH_SENDER
+from .batch_sender import BatchSender, default_batch_sender
+from .histogram import Histogram
+
+if TYPE_CHECKING:
+    import concurrent.futures
+    from .state import State
 
 
 ## ========================================================================
@@ -16,50 +23,260 @@ def _log():
 def track(
         x: Iterable[Any],
         name: Optional[str] = None,
-        sender: BatchSender = DEFAULT_BATCH_SENDER ) -> Iterable[Any]:
+        sender: Optional[BatchSender] = None,
+        flush_every: Optional[int] = None,
+        flush_interval: Optional[float] = None,
+        total: Optional[int] = None,
+        timed: bool = False ) -> Iterable[Any]:
+    """
+    Yields the elements of x while counting them in sender.state,
+    by default the state of the (lazily started) DEFAULT_BATCH_SENDER.
+    The key's schema covers total items, by default len(x) when x has
+    a length.
+
+    By default every element updates the state.  Giving flush_every
+    (items) and/or flush_interval (seconds) switches to batched mode:
+    elements are counted in a local integer which is pushed into the
+    state once either threshold is reached, and whatever is left is
+    pushed when the generator finishes or is closed.  The state then
+    lags the true count by fewer than flush_every items, or by the
+    items seen during the last flush_interval seconds.
+
+    Once the generator finishes or is closed the key is marked as
+    finished (see State.finish), so a sender with a finished TTL
+    eventually stops sending it.
+
+    With timed=True the seconds the caller spends on each element
+    (from its yield to the request of the next one) are recorded as
+    values of the key (see State.record), for percentiles of the
+    per-item time; batched mode pushes them along with the counts.
+    """
+    if sender is None:
+        sender = default_batch_sender()
+    if name is None:
+        name = _guess_name()
+    # resolved once: the default sender's state is a property
+    state = sender.state
+    _try_set_schema( x, name, state, total )
+    state.set( name, 0 )
+    if flush_every is None and flush_interval is None:
+        try:
+            for element in x:
+                state.add( name, 1 )
+                if timed:
+                    started = time.perf_counter()
+                    yield element
+                    state.record( name, time.perf_counter() - started )
+                else:
+                    yield element
+        finally:
+            state.finish( name )
+        return
+
+    every = flush_every if flush_every is not None else 0
+    pending = 0
+    values = Histogram() if timed else None
+    last_flush = time.monotonic()
+    try:
+        for element in x:
+            pending += 1
+            if ( every and pending >= every ) or (
+                    flush_interval is not None
+                    and time.monotonic() - last_flush >= flush_interval ):
+                state.add( name, pending )
+                pending = 0
+                if values is not None and values.n:
+                    state.merge_values( name, values )
+                    values = Histogram()
+                last_flush = time.monotonic()
+            if values is not None:
+                started = time.perf_counter()
+                yield element
+                values.record( time.perf_counter() - started )
+            else:
+                yield element
+    finally:
+        if pending:
+            state.add( name, pending )
+        if values is not None and values.n:
+            state.merge_values( name, values )
+        state.finish( name )
+
+
+def track_value(
+        name: str,
+        value: float,
+        sender: Optional[BatchSender] = None ) -> None:
+    """
+    Records one value (e.g. a latency or a size) into the distribution
+    of a key, whose percentiles receivers can query (see
+    State.percentile).
+    """
+    if sender is None:
+        sender = default_batch_sender()
+    sender.state.record( name, value )
+
+
+def timing(
+        name: Optional[str] = None,
+        sender: Optional[BatchSender] = None ):
+    """
+    Records the seconds spent in a with block as a value of the key
+    (see track_value).
+    """
+    if name is None:
+        # named here, from the caller's frame rather than contextlib's
+        name = _guess_name()
+    return _timing( name, sender )
+
+
+@contextlib.contextmanager
+def _timing(
+        name: str,
+        sender: Optional[BatchSender] ) -> Iterator[None]:
+    if sender is None:
+        sender = default_batch_sender()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        sender.state.record( name, time.perf_counter() - started )
+
+
+def track_futures(
+        fs: Iterable['concurrent.futures.Future'],
+        name: Optional[str] = None,
+        sender: Optional[BatchSender] = None,
+        timeout: Optional[float] = None ) -> Iterable['concurrent.futures.Future']:
+    """
+    Yields the futures of fs as they complete (see
+    concurrent.futures.as_completed), counting completions in a key
+    whose schema covers all of fs.
+    """
+    # imported here: importing this module stays cheap
+    import concurrent.futures
+    fs = list( fs )
     if name is None:
         name = _guess_name()
-    _try_set_schema( x, name, sender )
-    sender.state.set( name, 0 )
-    for i, element in enumerate(x):
-        sender.state.add( name, 1 )
-        yield element
-        
+    return track( concurrent.futures.as_completed( fs, timeout ),
+                  name, sender, total = len(fs) )
 
 ## ========================================================================
 
+async def track_async(
+        x: AsyncIterable[Any],
+        name: Optional[str] = None,
+        sender: Optional[BatchSender] = None,
+        total: Optional[int] = None ) -> AsyncIterator[Any]:
+    """
+    Like track, for `async for` over an async iterable.
+
+    Never waits for the state's lock, so a sender busy serializing
+    cannot stall the event loop: elements are counted in the loop
+    thread's own accumulator (see State.counter), and the schema,
+    reset and finish of the key are deferred (see State.defer).  The
+    sender picks all of it up at its next send.
+    """
+    if sender is None:
+        sender = default_batch_sender()
+    if name is None:
+        name = _guess_name()
+    state = sender.state
+    if total is None:
+        try:
+            total = len(x)
+        except TypeError:
+            pass
+    if total is not None:
+        state.defer( 'schema', name, 0, total - 1 )
+    state.defer( 'set', name, 0 )
+    counter = state.counter( name )
+    try:
+        async for element in x:
+            counter[0] += 1
+            counter[1] = time.monotonic()
+            yield element
+    finally:
+        state.defer( 'finish', name )
+
+
+def track_as_completed(
+        aws: Iterable[Awaitable[Any]],
+        name: Optional[str] = None,
+        sender: Optional[BatchSender] = None,
+        timeout: Optional[float] = None ) -> AsyncIterator[Any]:
+    """
+    Yields the results of the awaitables (futures, tasks or
+    coroutines) of aws in completion order (see asyncio.as_completed),
+    counting completions as track_async does; an awaitable raising
+    raises here.
+    """
+    aws = list( aws )
+    if name is None:
+        name = _guess_name()
+
+    import asyncio
+
+    async def results():
+        for next_done in asyncio.as_completed( aws, timeout = timeout ):
+            yield await next_done
+
+    return track_async( results(), name, sender, total = len(aws) )
+
+## ========================================================================
+
+_GUESSED_NAMES = {} # type: Dict[Tuple[Any,int],str]
+_FILENAME_STEMS = {} # type: Dict[str,str]
+
 def _guess_name() -> Optional[str]:
-    stack = inspect.stack()
-    name = None
-    stack_up_index = 2
+    """
+    Names a tracker after the first calling frame outside of this
+    module as "filename.function.lineno".
+
+    Walks the raw frames (no source lines are loaded, unlike
+    inspect.stack) and memoizes the name per call-site code object
+    and line number.
+    """
+    frame = sys._getframe( 1 )
     try:
-        while name is None and len(stack) > stack_up_index:
-            caller_info = stack[ stack_up_index ]
-            stack_up_index += 1
-            if caller_info.filename is None or caller_info.filename == '':
-                continue
-            filename = pathlib.Path( caller_info.filename ).stem
-            if filename == 'progress':
-                continue
-            if caller_info.function is not None and len(filename) > 1:
+        while frame is not None:
+            code = frame.f_code
+            key = ( code, frame.f_lineno )
+            name = _GUESSED_NAMES.get( key )
+            if name is not None:
+                return name
+            filename = _filename_stem( code.co_filename )
+            if filename != 'progress' and len(filename) > 1:
                 name = "{filename}.{function}.{lineno}".format(
                     filename = filename,
-                    function = caller_info.function,
-                    lineno = caller_info.lineno )
+                    function = code.co_name,
+                    lineno = frame.f_lineno )
+                _GUESSED_NAMES[ key ] = name
+                return name
+            frame = frame.f_back
     finally:
-        del stack
-    return name
+        del frame
+    return None
+
+
+def _filename_stem( filename: Optional[str] ) -> str:
+    stem = _FILENAME_STEMS.get( filename )
+    if stem is None:
+        stem = os.path.splitext( os.path.basename( filename ) )[0] if filename else ''
+        _FILENAME_STEMS[ filename ] = stem
+    return stem
 
 ## ========================================================================
 
 def _try_set_schema( x: Iterable[Any],
                      name: str,
-                     sender: BatchSender ) -> None:
+                     state: 'State',
+                     total: Optional[int] = None ) -> None:
     """
     """
     try:
-        n = len(x)
-        sender.state.schema( name, 0, n-1 )
+        n = len(x) if total is None else total
+        state.schema( name, 0, n-1 )
     except:
         pass
     
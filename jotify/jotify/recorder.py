@@ -0,0 +1,698 @@
+import argparse
+import atexit
+import collections
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from .aggregate import SenderAggregator
+from .state import State
+from .timering import TimeRing
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+## ========================================================================
+
+def _log():
+    return logging.getLogger( __name__ )
+
+## ========================================================================
+
+MAGIC = b'JTR'
+VERSION = 1
+
+##
+# magic, version, record size
+_HEADER = struct.Struct( '<3sBI8x' )
+
+##
+# receive time (epoch), sender id, key id, count, min, max, rate, ewma,
+# flags
+_RECORD = struct.Struct( '<dIIdddddI4x' )
+
+_HAS_MIN = 1
+_HAS_MAX = 2
+_FINISHED = 4
+_REMOVED = 8
+
+##
+# records scanned per block by queries, bounding their memory use
+_BLOCK_RECORDS = 1 << 20
+
+##
+# A checkpoint (record count, number of pairs) followed by, for every
+# ( sender, key ) which was not removed, ( sender id, key id, index of
+# its last record ), written every _CHECKPOINT_RECORDS records.
+_CHECKPOINT = struct.Struct( '<QI4x' )
+_CHECKPOINT_PAIR = struct.Struct( '<IIQ' )
+_CHECKPOINT_RECORDS = 1 << 16
+
+## ========================================================================
+
+class Recorder( object ):
+    """
+    Appends the states a UI receives to an on-disk log (see
+    state_ui.UI's recorder argument), for analysis and replay after
+    the fact (see Recording and replay).
+
+    The log at path holds fixed size records, one per key update and
+    in receive time order, so the records themselves are the time
+    index: a time range is found by bisection.  Key and sender names
+    are kept once, in path + '.names'.  Entries identical to the last
+    recorded one of the same sender and key are skipped, so keyframes
+    only cost the keys which changed.  An existing log is appended to.
+
+    Every _CHECKPOINT_RECORDS records, the index of the last record of
+    every ( sender, key ) is appended to path + '.checkpoints', so that
+    the state at any time (see Recording.latest) is found without
+    scanning the log back to its start.  A checkpoint takes 16 bytes
+    per ( sender, key ), against 3.5MB of records between two.
+    """
+
+    def __init__( self,
+                  path: str,
+                  flush_interval_seconds: float = 1.0 ) -> None:
+        self.path = path
+        self.flush_interval_seconds = flush_interval_seconds
+        self.lock = threading.Lock()
+        self._key_ids = {} # type: Dict[str,int]
+        self._sender_ids = {} # type: Dict[str,int]
+        self._last = {} # type: Dict[Tuple[int,int],tuple]
+        self._last_index = {} # type: Dict[Tuple[int,int],int]
+        self._last_time = 0.0
+        self._count = 0
+        self._checkpoint_at = 0
+        checkpoints_size = 0
+        if os.path.exists( path ) and os.path.getsize( path ) > 0:
+            recording = Recording( path )
+            self._key_ids = { k : i for i, k in enumerate( recording.key_names ) }
+            self._sender_ids = { s : i for i, s in enumerate( recording.sender_names ) }
+            self._count = len(recording)
+            if self._count:
+                self._last_time = recording.time_at( self._count - 1 )
+            self._last_index = {
+                pair : i for pair, i in recording._latest_indices( self._count ).items()
+                if not recording._row( i )[8] & _REMOVED }
+            checkpoint = recording._checkpoint_before( self._count )
+            if checkpoint is not None:
+                self._checkpoint_at = checkpoint[0]
+            # checkpoints past the records kept would point at records
+            # about to be overwritten
+            checkpoints_size = recording._checkpoints_end( self._count )
+            recording.close()
+            self._data = open( path, 'r+b' )
+            # drop a record torn by a crash
+            self._data.truncate( _HEADER.size + self._count * _RECORD.size )
+            self._data.seek( 0, os.SEEK_END )
+        else:
+            self._data = open( path, 'wb' )
+            self._data.write( _HEADER.pack( MAGIC, VERSION, _RECORD.size ) )
+        self._checkpoints = open( path + '.checkpoints', 'ab' )
+        self._checkpoints.truncate( checkpoints_size )
+        self._names = open( path + '.names', 'a', encoding = 'utf-8' )
+        self._last_flush = time.monotonic()
+        atexit.register( self.close )
+
+
+    def record( self,
+                sender_id: str,
+                header: Dict,
+                state: State,
+                now: Optional[float] = None ) -> None:
+        """
+        Appends the entries of a received state (and the keys its
+        header removes) at receive time now (epoch seconds).
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            if self._data is None:
+                return
+            # the log must stay sorted even if the clock steps back
+            now = self._last_time = max( now, self._last_time )
+            sender = self._id( self._sender_ids, 's', sender_id )
+            rows = []
+            with state.lock:
+                for key, entry in state.stats.items():
+                    kid = self._id( self._key_ids, 'k', key )
+                    lo, hi = entry.get( 'min' ), entry.get( 'max' )
+                    ring = entry[ 'timehist' ]
+                    flags = ( _HAS_MIN if lo is not None else 0 ) \
+                            | ( _HAS_MAX if hi is not None else 0 ) \
+                            | ( _FINISHED if entry.get( 'finished' ) else 0 )
+                    values = ( entry[ 'count' ],
+                               lo if lo is not None else 0.0,
+                               hi if hi is not None else 0.0,
+                               flags )
+                    if self._last.get( ( sender, kid ) ) == values:
+                        continue
+                    self._last[ ( sender, kid ) ] = values
+                    self._last_index[ ( sender, kid ) ] = self._count + len(rows)
+                    rows.append( _RECORD.pack( now, sender, kid, values[0],
+                                               values[1], values[2],
+                                               ring.rate, ring.ewma, flags ) )
+            for key in header.get( 'removed', () ):
+                kid = self._id( self._key_ids, 'k', key )
+                self._last.pop( ( sender, kid ), None )
+                self._last_index.pop( ( sender, kid ), None )
+                rows.append( _RECORD.pack( now, sender, kid, 0.0, 0.0, 0.0,
+                                           0.0, 0.0, _REMOVED ) )
+            self._data.write( b''.join( rows ) )
+            self._count += len(rows)
+            if self._count - self._checkpoint_at >= _CHECKPOINT_RECORDS:
+                self._checkpoint()
+            if time.monotonic() - self._last_flush >= self.flush_interval_seconds:
+                self._flush()
+
+
+    def flush( self ) -> None:
+        with self.lock:
+            if self._data is not None:
+                self._flush()
+
+
+    def close( self ) -> None:
+        with self.lock:
+            if self._data is None:
+                return
+            self._flush()
+            self._data.close()
+            self._checkpoints.close()
+            self._names.close()
+            self._data = None
+
+
+    def _flush( self ) -> None:
+        # names first, so that readers never see an unnamed id, and
+        # checkpoints last (readers ignore those past the records)
+        self._names.flush()
+        self._data.flush()
+        self._checkpoints.flush()
+        self._last_flush = time.monotonic()
+
+
+    def _checkpoint( self ) -> None:
+        pairs = self._last_index
+        self._checkpoints.write(
+            _CHECKPOINT.pack( self._count, len(pairs) )
+            + b''.join( _CHECKPOINT_PAIR.pack( sender, kid, i )
+                        for ( sender, kid ), i in pairs.items() ) )
+        self._checkpoint_at = self._count
+
+
+    def _id( self, ids: Dict[str,int], kind: str, name: str ) -> int:
+        i = ids.get( name )
+        if i is None:
+            i = ids[ name ] = len(ids)
+            self._names.write( json.dumps( [ kind, i, name ] ) + "\n" )
+        return i
+
+## ========================================================================
+
+class Recording( object ):
+    """
+    Read access to a Recorder log, memory mapped so that queries only
+    touch the pages of the time range they ask for.  refresh() picks
+    up records appended since the log was opened.
+    """
+
+    def __init__( self, path: str ) -> None:
+        self.path = path
+        self.key_names = [] # type: List[str]
+        self.sender_names = [] # type: List[str]
+        self._key_index = {} # type: Dict[str,int]
+        self._names_offset = 0
+        # ( record count, file offset, number of pairs ) of each checkpoint
+        self._checkpoint_index = [] # type: List[Tuple[int,int,int]]
+        self._checkpoints_offset = 0
+        self._file = open( path, 'rb' )
+        magic, version, record_size = _HEADER.unpack( self._file.read( _HEADER.size ) )
+        if magic != MAGIC or version != VERSION or record_size != _RECORD.size:
+            raise ValueError( "not a jotify recording: {0}".format( path ) )
+        self.map = None # type: Optional[mmap.mmap]
+        self.size = 0
+        self.refresh()
+
+
+    def refresh( self ) -> None:
+        self._read_names()
+        self._read_checkpoints()
+        file_size = os.fstat( self._file.fileno() ).st_size
+        n = ( file_size - _HEADER.size ) // _RECORD.size
+        if n == self.size and self.map is not None:
+            return
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap( self._file.fileno(), 0, access = mmap.ACCESS_READ ) \
+                   if file_size else None
+        self.size = n
+
+
+    def close( self ) -> None:
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self._file.close()
+
+
+    def __len__( self ) -> int:
+        return self.size
+
+
+    def time_at( self, i: int ) -> float:
+        return struct.unpack_from( '<d', self.map, _HEADER.size + i * _RECORD.size )[0]
+
+
+    def index( self, t: float ) -> int:
+        """
+        The index of the first record received at or after t.
+        """
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = ( lo + hi ) // 2
+            if self.time_at( mid ) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+    def time_range( self ) -> Tuple[Optional[float],Optional[float]]:
+        if not self.size:
+            return None, None
+        return self.time_at( 0 ), self.time_at( self.size - 1 )
+
+
+    def records( self,
+                 start: Optional[float] = None,
+                 end: Optional[float] = None,
+                 key: Optional[str] = None ) -> Iterator[tuple]:
+        """
+        Yields ( time, sender, key, count, min, max, rate, ewma,
+        finished, removed ) for the records received in [start,end),
+        optionally of one key only, with sender and key names.
+        """
+        kid = None
+        if key is not None:
+            kid = self._key_index.get( key )
+            if kid is None:
+                return
+        first = 0 if start is None else self.index( start )
+        last = self.size if end is None else self.index( end )
+        for block_start in range( first, last, _BLOCK_RECORDS ):
+            block_end = min( last, block_start + _BLOCK_RECORDS )
+            for row in self._block( block_start, block_end, kid ):
+                yield self._named( row )
+
+
+    def latest( self,
+                before: float,
+                key: Optional[str] = None ) -> Dict[Tuple[str,str],tuple]:
+        """
+        The last record (as records() yields them) of every ( sender,
+        key ) received before time before, optionally of one key only;
+        what the totals at before are made of.  Records are skipped
+        while unchanged, so this starts from the last checkpoint before
+        before (see Recorder) and scans the at most
+        _CHECKPOINT_RECORDS records from there; the cost does not grow
+        with the size of the log, but with the number of ( sender,
+        key ) in the checkpoint.  Keys removed before the checkpoint
+        are left out rather than returned as removed.
+        """
+        kid = None
+        if key is not None:
+            kid = self._key_index.get( key )
+            if kid is None:
+                return {}
+        result = {}
+        for i in sorted( self._latest_indices( self.index( before ), kid ).values() ):
+            record = self._named( self._row( i ) )
+            result[ ( record[1], record[2] ) ] = record
+        return result
+
+
+    def series( self,
+                key: str,
+                start: Optional[float] = None,
+                end: Optional[float] = None ) -> List[Tuple[float,float]]:
+        """
+        The ( time, count ) points of one key over [start,end), the
+        count summed over its senders.  With start, the totals start
+        from the senders' last counts before it (see latest), as a
+        first point at start.
+        """
+        latest = {} # type: Dict[str,float]
+        points = []
+        if start is not None:
+            for ( sender, _ ), record in self.latest( start, key ).items():
+                if not record[9]:
+                    latest[ sender ] = record[3]
+            if latest:
+                points.append( ( start, sum( latest.values() ) ) )
+        for t, sender, _, count, _, _, _, _, _, removed in \
+                self.records( start, end, key ):
+            if removed:
+                latest.pop( sender, None )
+            else:
+                latest[ sender ] = count
+            points.append( ( t, sum( latest.values() ) ) )
+        return points
+
+
+    def _named( self, row: tuple ) -> tuple:
+        t, sender, k, count, lo, hi, rate, ewma, flags = row
+        return ( t,
+                 self.sender_names[ sender ],
+                 self.key_names[ k ],
+                 count,
+                 lo if flags & _HAS_MIN else None,
+                 hi if flags & _HAS_MAX else None,
+                 rate,
+                 ewma,
+                 bool( flags & _FINISHED ),
+                 bool( flags & _REMOVED ) )
+
+
+    def _row( self, i: int ) -> tuple:
+        return _RECORD.unpack_from( self.map, _HEADER.size + i * _RECORD.size )[ :9 ]
+
+
+    def _latest_indices( self,
+                         end: int,
+                         kid: Optional[int] = None ) -> Dict[Tuple[int,int],int]:
+        """
+        The index of the last record of each ( sender id, key id ) among
+        records [0,end), from the last checkpoint at or before end and
+        the records after it.
+        """
+        found = {} # type: Dict[Tuple[int,int],int]
+        first = 0
+        checkpoint = self._checkpoint_before( end )
+        if checkpoint is not None:
+            first, offset, n = checkpoint
+            found = self._checkpoint_pairs( offset, n, kid )
+        for block_start in range( first, end, _BLOCK_RECORDS ):
+            found.update( self._last_indices(
+                block_start, min( end, block_start + _BLOCK_RECORDS ), kid ) )
+        return found
+
+
+    def _last_indices( self,
+                       first: int,
+                       last: int,
+                       kid: Optional[int] ) -> Dict[Tuple[int,int],int]:
+        """
+        The index of the last record of each ( sender id, key id ) among
+        records [first,last).
+        """
+        if np is not None:
+            rows = np.frombuffer( self.map, dtype = _DTYPE,
+                                  count = last - first,
+                                  offset = _HEADER.size + first * _RECORD.size )
+            if kid is not None:
+                positions = np.flatnonzero( rows[ 'key' ] == kid )
+            else:
+                positions = np.arange( len(rows) )
+            senders = rows[ 'sender' ][ positions ].astype( np.uint64 )
+            keys = rows[ 'key' ][ positions ].astype( np.uint64 )
+            pairs = ( senders << np.uint64( 32 ) ) | keys
+            _, reversed_index = np.unique( pairs[ ::-1 ], return_index = True )
+            last_positions = positions[ len(positions) - 1 - reversed_index ]
+            return dict( zip( zip( rows[ 'sender' ][ last_positions ].tolist(),
+                                   rows[ 'key' ][ last_positions ].tolist() ),
+                              ( first + last_positions ).tolist() ) )
+        offset = _HEADER.size + first * _RECORD.size
+        found = {}
+        for i, row in enumerate( _RECORD.iter_unpack(
+                self.map[ offset : _HEADER.size + last * _RECORD.size ] ), first ):
+            if kid is None or row[2] == kid:
+                found[ ( row[1], row[2] ) ] = i
+        return found
+
+
+    def _checkpoint_before( self, end: int ) -> Optional[Tuple[int,int,int]]:
+        """
+        The last checkpoint at or before record end, if any.
+        """
+        for checkpoint in reversed( self._checkpoint_index ):
+            if checkpoint[0] <= end:
+                return checkpoint
+        return None
+
+
+    def _checkpoints_end( self, end: int ) -> int:
+        """
+        The size of the checkpoints file up to the first checkpoint
+        past record end.
+        """
+        for at, offset, _ in self._checkpoint_index:
+            if at > end:
+                return offset
+        return self._checkpoints_offset
+
+
+    def _checkpoint_pairs( self,
+                           offset: int,
+                           n: int,
+                           kid: Optional[int] ) -> Dict[Tuple[int,int],int]:
+        with open( self.path + '.checkpoints', 'rb' ) as f:
+            f.seek( offset + _CHECKPOINT.size )
+            data = f.read( n * _CHECKPOINT_PAIR.size )
+        return { ( sender, k ) : i
+                 for sender, k, i in _CHECKPOINT_PAIR.iter_unpack( data )
+                 if kid is None or k == kid }
+
+
+    def _block( self, first: int, last: int, kid: Optional[int] ) -> Iterator[tuple]:
+        offset = _HEADER.size + first * _RECORD.size
+        if np is not None:
+            rows = np.frombuffer( self.map, dtype = _DTYPE,
+                                  count = last - first, offset = offset )
+            if kid is not None:
+                rows = rows[ rows[ 'key' ] == kid ]
+            # converted right away, so no view of the map outlives the
+            # block (the map could not be closed)
+            return [ row[ :9 ] for row in rows.tolist() ]
+        rows = _RECORD.iter_unpack( self.map[ offset : _HEADER.size + last * _RECORD.size ] )
+        if kid is not None:
+            return ( row for row in rows if row[2] == kid )
+        return rows
+
+
+    def _read_checkpoints( self ) -> None:
+        try:
+            with open( self.path + '.checkpoints', 'rb' ) as f:
+                f.seek( self._checkpoints_offset )
+                data = f.read()
+        except FileNotFoundError:
+            return
+        position = 0
+        while position + _CHECKPOINT.size <= len(data):
+            at, n = _CHECKPOINT.unpack_from( data, position )
+            size = _CHECKPOINT.size + n * _CHECKPOINT_PAIR.size
+            if position + size > len(data):
+                # being written, read it next time
+                break
+            self._checkpoint_index.append(
+                ( at, self._checkpoints_offset + position, n ) )
+            position += size
+        self._checkpoints_offset += position
+
+
+    def _read_names( self ) -> None:
+        try:
+            with open( self.path + '.names', 'r', encoding = 'utf-8' ) as f:
+                f.seek( self._names_offset )
+                for line in iter( f.readline, '' ):
+                    if not line.endswith( "\n" ):
+                        # being written, read it next time
+                        break
+                    kind, i, name = json.loads( line )
+                    names = self.key_names if kind == 'k' else self.sender_names
+                    names.extend( [ None ] * ( i + 1 - len(names) ) )
+                    names[ i ] = name
+                    if kind == 'k':
+                        self._key_index[ name ] = i
+                    self._names_offset = f.tell()
+        except FileNotFoundError:
+            pass
+
+
+if np is not None:
+    _DTYPE = np.dtype( [ ( 't', '<f8' ), ( 'sender', '<u4' ), ( 'key', '<u4' ),
+                         ( 'count', '<f8' ), ( 'min', '<f8' ), ( 'max', '<f8' ),
+                         ( 'rate', '<f8' ), ( 'ewma', '<f8' ), ( 'flags', '<u4' ),
+                         ( 'pad', 'V4' ) ] )
+
+## ========================================================================
+
+def replay( recording: Recording,
+            listeners: List[Callable[[State],None]],
+            speed: float = 10.0,
+            start: Optional[float] = None,
+            end: Optional[float] = None,
+            refresh_interval_seconds: float = 1.0,
+            max_hist: int = 10 ) -> None:
+    """
+    Feeds a recording to listeners as a UI would have: the per-sender
+    states are aggregated and handed to the listeners every
+    refresh_interval_seconds of recorded time, when they changed.
+    Runs speed times faster than real time (math.inf for as fast as
+    possible).  Recorded times are mapped onto time.monotonic(), so
+    ages and rates look as they did, sped up.  With start, the senders
+    first get the state they had at start (see Recording.latest).
+    """
+    first_time, _ = recording.time_range()
+    if first_time is None:
+        return
+    origin = first_time if start is None else max( start, first_time )
+    wall_origin = time.monotonic()
+    senders = SenderAggregator( ttl_seconds = math.inf, max_hist = max_hist )
+    rings = collections.defaultdict( collections.deque ) # type: Dict[tuple,collections.deque]
+    synced_version = None
+    next_sync = origin
+    applied = False
+
+    def mapped( t: float ) -> float:
+        return wall_origin + ( t - origin ) / speed
+
+    def sync( until: float ) -> None:
+        nonlocal synced_version, next_sync
+        while next_sync <= until:
+            delay = mapped( next_sync ) - time.monotonic()
+            if delay > 0:
+                time.sleep( delay )
+            snapshot = senders.aggregate()
+            if applied and senders.version != synced_version:
+                synced_version = senders.version
+                for c in listeners:
+                    c( snapshot )
+            next_sync += refresh_interval_seconds
+
+    def entry( t, sender, key, count, lo, hi, rate, ewma, finished ) -> Dict:
+        times = rings[ ( sender, key ) ]
+        times.append( mapped( t ) )
+        if len(times) > max_hist:
+            times.popleft()
+        result = { 'count' : count,
+                   'min' : lo,
+                   'max' : hi,
+                   'timehist' : TimeRing.from_values( max_hist, times, rate, ewma ) }
+        if finished:
+            result[ 'finished' ] = True
+        return result
+
+    pending = None # type: Optional[Tuple[float,str,State,List[str]]]
+    def apply() -> None:
+        nonlocal applied
+        t, sender, s, removed = pending
+        senders.apply( sender, { 'removed' : removed }, s, now = mapped( t ) )
+        applied = True
+
+    if start is not None:
+        seeds = {} # type: Dict[str,State]
+        for ( sender, key ), record in sorted( recording.latest( start ).items(),
+                                               key = lambda item: item[1][0] ):
+            if not record[9]:
+                seeds.setdefault( sender, State( max_hist ) ).stats[ key ] = \
+                    entry( *record[ :9 ] )
+        for sender, s in seeds.items():
+            senders.apply( sender, {}, s, now = mapped( origin ) )
+            applied = True
+
+    for t, sender, key, count, lo, hi, rate, ewma, finished, removed in \
+            recording.records( start, end ):
+        if pending is None or pending[0] != t or pending[1] != sender:
+            if pending is not None:
+                apply()
+            sync( t )
+            pending = ( t, sender, State( max_hist ), [] )
+        if removed:
+            pending[3].append( key )
+            continue
+        pending[2].stats[ key ] = entry( t, sender, key, count, lo, hi,
+                                         rate, ewma, finished )
+    if pending is not None:
+        apply()
+        sync( pending[0] + refresh_interval_seconds )
+
+## ========================================================================
+
+def main( argv = None ) -> None:
+    """
+    python -m jotify.recorder keys FILE
+    python -m jotify.recorder series FILE KEY [--start T] [--end T]
+    python -m jotify.recorder replay FILE [--speed 10] [--port 10002]
+    """
+    parser = argparse.ArgumentParser(
+        description = "Queries and replays jotify recordings "
+                      "(see state_ui.UI's recorder)." )
+    commands = parser.add_subparsers( dest = 'command' )
+    keys = commands.add_parser( 'keys', help = "list the recorded keys" )
+    keys.add_argument( 'file' )
+    series = commands.add_parser( 'series',
+                                  help = "print one key's counts as csv" )
+    series.add_argument( 'file' )
+    series.add_argument( 'key' )
+    for p in ( series, ):
+        p.add_argument( '--start', type = float, default = None,
+                        help = "epoch seconds" )
+        p.add_argument( '--end', type = float, default = None,
+                        help = "epoch seconds" )
+    play = commands.add_parser(
+        'replay', help = "republish a recording, e.g. for textui --port" )
+    play.add_argument( 'file' )
+    play.add_argument( '--speed', type = float, default = 10.0 )
+    play.add_argument( '--port', type = int, default = 10002 )
+    play.add_argument( '--start', type = float, default = None )
+    play.add_argument( '--end', type = float, default = None )
+    args = parser.parse_args( argv )
+    if args.command is None:
+        parser.error( "a command is required" )
+
+    recording = Recording( args.file )
+    if args.command == 'keys':
+        first, last = recording.time_range()
+        print( "# {0} records from {1} to {2}".format( len(recording), first, last ) )
+        for key in sorted( k for k in recording.key_names if k is not None ):
+            print( key )
+    elif args.command == 'series':
+        out = sys.stdout
+        out.write( "time,count\n" )
+        for t, count in recording.series( args.key, args.start, args.end ):
+            out.write( "{0!r},{1!r}\n".format( t, count ) )
+    elif args.command == 'replay':
+        from .batch_sender import BatchSender
+        sender = BatchSender( 1.0, multicast_port = args.port,
+                              wire_format = 'binary' )
+        sender.start()
+        try:
+            replay( recording,
+                    [ sender.state.replace ],
+                    speed = args.speed,
+                    start = args.start,
+                    end = args.end )
+            sender.flush()
+        finally:
+            sender.pause()
+    recording.close()
+
+
+if __name__ == "__main__":
+    main()
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
@@ -0,0 +1,213 @@
+import argparse
+import copy
+import logging
+import time
+from typing import Dict, Iterable, List, Optional
+
+from . import codec
+from .aggregate import _aggregate_entries
+from .batch_sender import BatchSender
+from .metrics import METRICS_PREFIX
+from .state import State
+from .state_ui import UI
+from .transport import MulticastTransport, Transport, UnixDatagramTransport
+
+## ========================================================================
+
+def _log():
+    return logging.getLogger( __name__ )
+
+## ========================================================================
+
+ROLLUP_SUFFIX = '.*'
+
+##
+# Where a relay publishes its own metrics; those of an upstream relay
+# are moved under RELAY_METRICS_PREFIX + 'upstream.'.
+RELAY_METRICS_PREFIX = METRICS_PREFIX + 'relay.'
+_UPSTREAM_METRICS_PREFIX = RELAY_METRICS_PREFIX + 'upstream.'
+
+## ========================================================================
+
+class Relay( object ):
+    """
+    Fans in the states of many senders and republishes them as one.
+
+    A UI receives from the input transport, keeping each sender apart
+    and dropping stale or duplicate messages (see
+    aggregate.SenderAggregator), and whenever the per-key totals
+    change they become the state of a BatchSender publishing on the
+    output transport at send_interval_seconds.  Receivers of the
+    output (textui, the widget, or another Relay) then parse a single
+    stream, whatever the number of senders.
+
+    rollup_depths adds, for each depth d, a key "p.*" aggregating every
+    key whose first d dot separated parts are p (e.g. depth 1 rolls
+    "train.epoch.12" up into "train.*").  With rollups_only the
+    original keys are left out.
+
+    With publish_metrics, the metrics of the relay's UI and sender
+    (see metrics) are published along with the keys, under
+    RELAY_METRICS_PREFIX; the metrics keys of upstream senders are
+    forwarded untouched.
+    """
+
+    def __init__( self,
+                  send_interval_seconds: float = 1.0,
+                  input_transport: Optional[Transport] = None,
+                  output_transport: Optional[Transport] = None,
+                  rollup_depths: Iterable[int] = (),
+                  rollups_only: bool = False,
+                  wire_format: str = codec.WIRE_BINARY,
+                  keyframe_every: int = 10,
+                  publish_metrics: bool = False,
+                  **ui_kwargs ) -> None:
+        """
+        The transports default to multicast, receiving on port 10000
+        and sending on 10001.  ui_kwargs are passed on to the UI (e.g.
+        sender_ttl_seconds, or the key limits).
+        """
+        if input_transport is None:
+            input_transport = MulticastTransport( multicast_port = 10000 )
+        if output_transport is None:
+            output_transport = MulticastTransport( multicast_port = 10001 )
+        if getattr( input_transport, 'address', None ) is not None \
+           and getattr( input_transport, 'address', None ) \
+               == getattr( output_transport, 'address', None ):
+            raise ValueError( "a relay must not publish where it receives" )
+        self.rollup_depths = sorted( set( rollup_depths ) )
+        self.rollups_only = rollups_only
+        self.ui = UI( send_interval_seconds,
+                      transport = input_transport,
+                      **ui_kwargs )
+        self.sender = BatchSender( send_interval_seconds,
+                                   wire_format = wire_format,
+                                   keyframe_every = keyframe_every,
+                                   transport = output_transport,
+                                   publish_metrics = publish_metrics )
+        self.sender.metrics_prefix = RELAY_METRICS_PREFIX
+        self.sender.metrics_sources.append( self.ui.metrics )
+        self.ui.add_state_listener( self._publish )
+
+
+    def start( self ) -> None:
+        self.sender.start()
+        self.ui.start()
+
+
+    def pause( self ) -> None:
+        self.ui.pause()
+        self.sender.pause()
+
+
+    def _publish( self, snapshot: State ) -> None:
+        relayed = State( snapshot.max_hist )
+        if not self.rollups_only:
+            for key, entry in snapshot.stats.items():
+                if key.startswith( METRICS_PREFIX ):
+                    if key.startswith( RELAY_METRICS_PREFIX ):
+                        key = _UPSTREAM_METRICS_PREFIX \
+                              + key[ len(RELAY_METRICS_PREFIX): ]
+                    # the sender writes metrics keys in place: keep it
+                    # off the snapshot's entries
+                    entry = copy.deepcopy( entry )
+                relayed.stats[ key ] = entry
+        relayed.stats.update( rollups( snapshot.stats,
+                                       self.rollup_depths,
+                                       snapshot.max_hist ) )
+        # only the keys which changed since the previous snapshot are
+        # marked for the next delta; the relay's own metrics stay
+        self.sender.state.replace( relayed, keep = _own_metric )
+
+
+def _own_metric( key: str ) -> bool:
+    """
+    Whether key is one of the relay's own metrics (see publish_metrics).
+    """
+    return key.startswith( RELAY_METRICS_PREFIX ) \
+        and not key.startswith( _UPSTREAM_METRICS_PREFIX )
+
+## ========================================================================
+
+def rollups( stats: Dict[str,Dict],
+             depths: Iterable[int],
+             max_hist: int = 10 ) -> Dict[str,Dict]:
+    """
+    Aggregates the entries of stats by key prefix, for each depth (in
+    dot separated parts) in depths; see Relay.
+    """
+    result = {} # type: Dict[str,Dict]
+    for depth in depths:
+        groups = {} # type: Dict[str,List[Dict]]
+        for key, entry in stats.items():
+            if key.endswith( ROLLUP_SUFFIX ) or key.startswith( METRICS_PREFIX ):
+                continue
+            parts = key.split( '.' )
+            if len(parts) <= depth:
+                continue
+            groups.setdefault( '.'.join( parts[ :depth ] ), [] ).append( entry )
+        for prefix, entries in groups.items():
+            result[ prefix + ROLLUP_SUFFIX ] = _aggregate_entries( entries, max_hist )
+    return result
+
+## ========================================================================
+
+def main( argv = None ) -> None:
+    """
+    python -m jotify.relay [--input-port 10000] [--output-port 10001]
+                           [--interval 1] [--rollup-depth 1 ...]
+    """
+    parser = argparse.ArgumentParser(
+        description = "Relays (and rolls up) jotify states from one "
+                      "multicast group or unix socket to another." )
+    parser.add_argument( '--input-ip', default = '224.0.0.1' )
+    parser.add_argument( '--input-port', type = int, default = 10000 )
+    parser.add_argument( '--input-socket', default = None,
+                         help = "receive on this unix datagram socket instead" )
+    parser.add_argument( '--output-ip', default = '224.0.0.1' )
+    parser.add_argument( '--output-port', type = int, default = 10001 )
+    parser.add_argument( '--output-socket', default = None,
+                         help = "send to this unix datagram socket instead" )
+    parser.add_argument( '--interval', type = float, default = 1.0 )
+    parser.add_argument( '--rollup-depth', type = int, action = 'append',
+                         default = [] )
+    parser.add_argument( '--rollups-only', action = 'store_true' )
+    parser.add_argument( '--sender-ttl', type = float, default = 60.0 )
+    parser.add_argument( '--max-keys', type = int, default = None )
+    parser.add_argument( '--publish-metrics', action = 'store_true',
+                         help = "publish the relay's own metrics as keys" )
+    args = parser.parse_args( argv )
+    logging.basicConfig( level = logging.INFO )
+
+    input_transport = UnixDatagramTransport( args.input_socket ) \
+                      if args.input_socket else \
+                      MulticastTransport( args.input_ip, args.input_port )
+    output_transport = UnixDatagramTransport( args.output_socket ) \
+                       if args.output_socket else \
+                       MulticastTransport( args.output_ip, args.output_port )
+    relay = Relay( args.interval,
+                   input_transport,
+                   output_transport,
+                   rollup_depths = args.rollup_depth,
+                   rollups_only = args.rollups_only,
+                   publish_metrics = args.publish_metrics,
+                   sender_ttl_seconds = args.sender_ttl,
+                   max_keys = args.max_keys )
+    relay.start()
+    try:
+        while True:
+            time.sleep( 3600 )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.pause()
+
+
+if __name__ == "__main__":
+    main()
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
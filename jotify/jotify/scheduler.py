@@ -0,0 +1,237 @@
+import atexit
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+## ========================================================================
+
+def _log():
+    return logging.getLogger( __name__ )
+
+## ========================================================================
+
+class Task( object ):
+    """
+    A periodic callback registered with a Scheduler.
+    """
+
+    def __init__( self,
+                  scheduler: 'Scheduler',
+                  interval_seconds: float,
+                  callback: Callable[[],None],
+                  flush_at_exit: bool ) -> None:
+        self.scheduler = scheduler
+        self.interval_seconds = interval_seconds
+        self.callback = callback
+        self.flush_at_exit = flush_at_exit
+        self.next_run = None # type: Optional[float]
+        self.cancelled = False
+
+
+    def run_now( self ) -> None:
+        """
+        Wakes the scheduler to run this task immediately; the following
+        run is then one interval later.
+        """
+        self.scheduler._reschedule( self, time.monotonic() )
+
+
+    def run_at( self, when: float ) -> None:
+        """
+        Runs this task at monotonic time when, if that is earlier than
+        its next run (a run never gets postponed).
+        """
+        self.scheduler._reschedule_earlier( self, when )
+
+
+    def cancel( self ) -> None:
+        self.scheduler.cancel( self )
+
+## ========================================================================
+
+class Scheduler( object ):
+    """
+    Runs periodic tasks from a single daemon thread.
+
+    Times are taken from the monotonic clock and the thread waits on a
+    condition variable, so scheduling, rescheduling and cancelling a
+    task wake it immediately.  Tasks registered with flush_at_exit are
+    run one final time when the interpreter exits.
+
+    The thread does not survive a fork: a forked child starts a thread
+    of its own when it schedules a task, and the tasks of the parent
+    are dropped (they do not run in the child, as their threads did
+    not before the scheduler was shared).
+    """
+
+    def __init__( self ) -> None:
+        self._counter = itertools.count()
+        self._exit_registered = False
+        self._reset()
+
+
+    def _reset( self ) -> None:
+        self._pid = os.getpid()
+        self._cond = threading.Condition()
+        self._heap = []
+        self._tasks = [] # type: List[Task]
+        self._running_task = None # type: Optional[Task]
+        self._thread = None # type: Optional[threading.Thread]
+        self._stopping = False
+
+
+    def _check_fork( self ) -> None:
+        """
+        Starts over in a forked child, where the thread (and maybe the
+        lock it held) of the parent are gone.
+        """
+        if self._pid != os.getpid():
+            _log().info( "scheduler forked, dropping the parent's tasks" )
+            self._reset()
+
+
+    def schedule( self,
+                  interval_seconds: float,
+                  callback: Callable[[],None],
+                  flush_at_exit: bool = False ) -> Task:
+        """
+        Runs callback every interval_seconds, the first time one
+        interval from now.
+        """
+        self._check_fork()
+        task = Task( self, interval_seconds, callback, flush_at_exit )
+        with self._cond:
+            self._tasks.append( task )
+            self._ensure_thread()
+        self._reschedule( task, time.monotonic() + interval_seconds )
+        return task
+
+
+    def cancel( self, task: Task ) -> None:
+        """
+        Cancels a task.  If the task is running on the scheduler
+        thread, waits for it to finish so that it is guaranteed not to
+        run once this returns.
+        """
+        self._check_fork()
+        with self._cond:
+            task.cancelled = True
+            if task in self._tasks:
+                self._tasks.remove( task )
+            if threading.current_thread() is not self._thread:
+                while self._running_task is task:
+                    self._cond.wait()
+            self._cond.notify_all()
+
+
+    def shutdown( self ) -> None:
+        """
+        Stops the scheduler thread and runs the final flush of every
+        flush_at_exit task.
+        """
+        self._check_fork()
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+            while self._running_task is not None:
+                self._cond.wait()
+            tasks = [ t for t in self._tasks if t.flush_at_exit ]
+        for task in tasks:
+            try:
+                task.callback()
+            except Exception:
+                _log().exception( "error in final flush: " )
+
+
+    def _reschedule( self, task: Task, when: float ) -> None:
+        self._check_fork()
+        with self._cond:
+            if task.cancelled:
+                return
+            task.next_run = when
+            heapq.heappush( self._heap, ( when, next( self._counter ), task ) )
+            self._cond.notify_all()
+
+
+    def _reschedule_earlier( self, task: Task, when: float ) -> None:
+        self._check_fork()
+        with self._cond:
+            if self._running_task is task or task.next_run is None \
+               or when < task.next_run:
+                self._reschedule( task, when )
+
+
+    def _ensure_thread( self ) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread( target = self._loop,
+                                         name = 'jotify-scheduler',
+                                         daemon = True )
+        self._thread.start()
+        if not self._exit_registered:
+            self._exit_registered = True
+            atexit.register( self.shutdown )
+
+
+    def _loop( self ) -> None:
+        while True:
+            with self._cond:
+                task = None
+                while task is None:
+                    if self._stopping:
+                        return
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    when, _, head = self._heap[0]
+                    if head.cancelled or head.next_run != when:
+                        # superseded by a later reschedule
+                        heapq.heappop( self._heap )
+                        continue
+                    now = time.monotonic()
+                    if when > now:
+                        self._cond.wait( when - now )
+                        continue
+                    heapq.heappop( self._heap )
+                    task = head
+                self._running_task = task
+
+            try:
+                task.callback()
+            except Exception:
+                _log().exception( "error running scheduled task: " )
+
+            with self._cond:
+                self._running_task = None
+                if task.next_run == when:
+                    # not rescheduled by run_now() while running
+                    self._reschedule(
+                        task,
+                        max( when + task.interval_seconds, time.monotonic() ) )
+                self._cond.notify_all()
+
+## ========================================================================
+
+_DEFAULT_SCHEDULER = None
+_DEFAULT_SCHEDULER_LOCK = threading.Lock()
+
+def default_scheduler() -> Scheduler:
+    """
+    The scheduler shared by every sender and receiver of the process
+    which was not given one explicitly.
+    """
+    global _DEFAULT_SCHEDULER
+    with _DEFAULT_SCHEDULER_LOCK:
+        if _DEFAULT_SCHEDULER is None:
+            _DEFAULT_SCHEDULER = Scheduler()
+        return _DEFAULT_SCHEDULER
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
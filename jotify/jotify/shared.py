@@ -0,0 +1,515 @@
+import array
+import atexit
+import fcntl
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from typing import Dict, Optional
+
+from . import histogram
+from .histogram import Histogram
+from .state import State
+
+## ========================================================================
+
+def _log():
+    return logging.getLogger( __name__ )
+
+## ========================================================================
+
+MAGIC = b'JTS'
+VERSION = 2
+
+##
+# magic, version, number of slots, number of slots handed out, number of
+# value slots, number of value slots handed out
+_HEADER = struct.Struct( '<3sBIIII4x' )
+_USED_OFFSET = 8
+_VALUES_USED_OFFSET = 16
+
+##
+# flags, name length, owning pid, count, span, name
+_SLOT = struct.Struct( '<BxHIdd232s' )
+_COUNT_OFFSET = 8
+_SPAN_OFFSET = 16
+MAX_NAME_BYTES = 232
+
+##
+# flags, name length, owning pid, then the n, sum, min and max of the
+# values, the name, and the histogram.BUCKETS bucket counts
+_VALUE_SLOT = struct.Struct( '<BxHIdddd232s' )
+_VALUE_STATS = struct.Struct( '<dddd' )
+_VALUE_STATS_OFFSET = 8
+_VALUE_SLOT_SIZE = _VALUE_SLOT.size + 8 * histogram.BUCKETS
+
+_USED = 1
+_FINISHED = 2
+_HAS_SCHEMA = 4
+
+## ========================================================================
+
+class SharedCounters( object ):
+    """
+    A block of named counters in a shared memory mapping, through
+    which the worker processes of a pool report their progress.
+
+    Every (process, thread, key) gets a slot of its own the first time
+    it counts, under a file lock; from then on add() is a plain write
+    of the slot's count, without locks or sockets.  The process which
+    created the block folds the slots of every worker into a State
+    (see fold_into, and BatchSender's shared_counters), so each key is
+    published with the throughput of the whole pool.
+
+    Workers count cumulatively: set() only resets a key the first time
+    a worker sees it, so successive tasks tracking the same key add
+    up, and their schemas add up to the pool wide number of items.
+
+    Values recorded by workers (see record, State.record) go into
+    value slots of their own, one histogram.Histogram per (process,
+    thread, key), which fold_into merges into the key's distribution.
+    Values of keys past the value_slots first ones are dropped, with
+    a warning.
+
+    Instances pickle as the path of the mapping, so they can be handed
+    to spawned workers (e.g. as the initargs of attach); forked workers
+    share the mapping directly.
+    """
+
+    def __init__( self,
+                  slots: int = 4096,
+                  path: Optional[str] = None,
+                  value_slots: int = 256 ) -> None:
+        """
+        Creates a new block of slots counters and value_slots value
+        histograms (8KB each), backed by a file at path (by default a
+        temporary file, in /dev/shm when available) which is removed
+        at exit of the creating process.
+        """
+        if path is None:
+            directory = '/dev/shm' if os.path.isdir( '/dev/shm' ) else None
+            fd, path = tempfile.mkstemp( prefix = 'jotify-', dir = directory )
+        else:
+            fd = os.open( path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600 )
+        size = _HEADER.size + slots * _SLOT.size + value_slots * _VALUE_SLOT_SIZE
+        try:
+            os.ftruncate( fd, size )
+            os.write( fd, _HEADER.pack( MAGIC, VERSION, slots, 0, value_slots, 0 ) )
+        finally:
+            os.close( fd )
+        self._owner_pid = os.getpid()
+        self._folded = {} # type: Dict[str,tuple]
+        self._folded_values = {} # type: Dict[str,Histogram]
+        self._open( path )
+        # only the file goes at exit: the mapping stays valid for the
+        # final send of the sender publishing the counters
+        atexit.register( self._unlink )
+
+
+    def __getstate__( self ) -> Dict:
+        return { 'path' : self.path }
+
+
+    def __setstate__( self, d: Dict ) -> None:
+        self._owner_pid = None
+        self._folded = {}
+        self._folded_values = {}
+        self._open( d[ 'path' ] )
+
+
+    def schema( self,
+                id: str,
+                min: Optional[float],
+                max: Optional[float] ) -> None:
+        """
+        Adds the number of items of [min,max] to the expected total of
+        the key.
+        """
+        if min is None or max is None:
+            return
+        slot = self._slot( id )
+        if slot is None:
+            return
+        offset = self._offset( slot )
+        span = struct.unpack_from( '<d', self.map, offset + _SPAN_OFFSET )[0]
+        struct.pack_into( '<d', self.map, offset + _SPAN_OFFSET,
+                          span + max - min + 1 )
+        self._set_flags( slot, _HAS_SCHEMA, 0 )
+
+
+    def add( self,
+             id: str,
+             count: float = 1 ) -> None:
+        slot = self._slot( id )
+        if slot is None:
+            return
+        local = self._local.counts
+        local[ slot ] += count
+        struct.pack_into( '<d', self.map,
+                          self._offset( slot ) + _COUNT_OFFSET,
+                          local[ slot ] )
+
+
+    def set( self,
+             id: str,
+             count: float ) -> None:
+        """
+        Starts counting the key at count in this worker; later calls
+        only mark the key as running again, so counts accumulate
+        across tasks.
+        """
+        if self._slot_of( id ) is None:
+            slot = self._slot( id )
+            if slot is not None and count:
+                self.add( id, count )
+        else:
+            self._set_flags( self._slot_of( id ), 0, _FINISHED )
+
+
+    def finish( self, id: str ) -> None:
+        slot = self._slot_of( id )
+        if slot is not None:
+            self._set_flags( slot, _FINISHED, 0 )
+
+
+    def counter( self, id: str ) -> '_SlotCounter':
+        """
+        A [count, last_time] accumulator for id like State.counter,
+        whose count is written through to this worker's slot.
+        """
+        return _SlotCounter( self, id )
+
+
+    def defer( self, method: str, *args ) -> None:
+        """
+        Like State.defer; slot writes never wait for a lock, so the
+        call is made right away.
+        """
+        if method not in ( 'schema', 'set', 'finish' ):
+            raise ValueError( "cannot defer {0}".format( method ) )
+        getattr( self, method )( *args )
+
+
+    def record( self, id: str, value: float ) -> None:
+        """
+        Records one value into this worker's histogram of id, see
+        State.record.
+        """
+        slot = self._value_slot( id )
+        if slot is None:
+            return
+        h = self._local.values[ slot ]
+        h.record( value )
+        self._write_values( slot, h, ( histogram.bucket( value ), ) )
+
+
+    def merge_values( self, id: str, values: Histogram ) -> None:
+        slot = self._value_slot( id )
+        if slot is None:
+            return
+        h = self._local.values[ slot ]
+        h.merge( values )
+        self._write_values( slot, h, values.sparse()[0] )
+
+
+    def read( self ) -> Dict[str,Dict]:
+        """
+        The per-key totals over all slots: count, min/max of the
+        combined schema (None unless every slot of the key has one)
+        and whether every slot of the key finished.
+        """
+        used = struct.unpack_from( '<I', self.map, _USED_OFFSET )[0]
+        totals = {} # type: Dict[str,Dict]
+        for slot in range( min( used, self.slots ) ):
+            flags, length, _, count, span, name = _SLOT.unpack_from(
+                self.map, self._offset( slot ) )
+            if not flags & _USED:
+                continue
+            key = name[ :length ].decode( 'utf-8', 'replace' )
+            total = totals.get( key )
+            if total is None:
+                total = totals[ key ] = { 'count' : 0.0,
+                                          'span' : 0.0,
+                                          'schema' : True,
+                                          'finished' : True }
+            total[ 'count' ] += count
+            total[ 'span' ] += span
+            total[ 'schema' ] &= bool( flags & _HAS_SCHEMA )
+            total[ 'finished' ] &= bool( flags & _FINISHED )
+        return { key : { 'count' : t[ 'count' ],
+                         'min' : 0 if t[ 'schema' ] else None,
+                         'max' : t[ 'span' ] - 1 if t[ 'schema' ] else None,
+                         'finished' : t[ 'finished' ] }
+                 for key, t in totals.items() }
+
+
+    def read_values( self ) -> Dict[str,Histogram]:
+        """
+        The per-key distributions of the values recorded over all value
+        slots.
+        """
+        used = struct.unpack_from( '<I', self.map, _VALUES_USED_OFFSET )[0]
+        totals = {} # type: Dict[str,Histogram]
+        for slot in range( min( used, self.value_slots ) ):
+            offset = self._value_offset( slot )
+            flags, length, _, n, total_sum, lo, hi, name = _VALUE_SLOT.unpack_from(
+                self.map, offset )
+            if not flags & _USED or not n:
+                continue
+            h = Histogram()
+            h.counts = array.array( 'd', self.map[ offset + _VALUE_SLOT.size :
+                                                   offset + _VALUE_SLOT_SIZE ] )
+            h.n, h.sum, h.min, h.max = n, total_sum, lo, hi
+            key = name[ :length ].decode( 'utf-8', 'replace' )
+            total = totals.get( key )
+            if total is None:
+                totals[ key ] = h
+            else:
+                total.merge( h )
+        return totals
+
+
+    def fold_into( self, state: State ) -> None:
+        """
+        Writes the totals of the keys which changed since the previous
+        fold into state, and merges the values recorded since into its
+        distributions.
+        """
+        for key, total in self.read().items():
+            values = ( total[ 'count' ], total[ 'min' ], total[ 'max' ],
+                       total[ 'finished' ] )
+            previous = self._folded.get( key )
+            if values == previous:
+                continue
+            self._folded[ key ] = values
+            if previous is None or previous[1:3] != values[1:3]:
+                state.schema( key, total[ 'min' ], total[ 'max' ] )
+            if previous is None or previous[0] != values[0]:
+                state.set( key, total[ 'count' ] )
+            if total[ 'finished' ]:
+                state.finish( key )
+        for key, values in self.read_values().items():
+            previous = self._folded_values.get( key )
+            if previous is not None and previous.n == values.n:
+                continue
+            self._folded_values[ key ] = values
+            recorded = values
+            if previous is not None:
+                recorded = Histogram()
+                recorded.merge( values, since = previous )
+            state.merge_values( key, recorded )
+
+
+    def close( self ) -> None:
+        """
+        Unmaps the block, and removes its file if this process created
+        it.
+        """
+        if self.map is None:
+            return
+        self.map.close()
+        self.map = None
+        os.close( self._fd )
+        self._unlink()
+
+
+    def _unlink( self ) -> None:
+        if self._owner_pid == os.getpid():
+            try:
+                os.unlink( self.path )
+            except OSError:
+                pass
+
+
+    def _open( self, path: str ) -> None:
+        self.path = path
+        self._fd = os.open( path, os.O_RDWR )
+        magic, version, self.slots, _, self.value_slots, _ = _HEADER.unpack(
+            os.read( self._fd, _HEADER.size ) )
+        if magic != MAGIC or version != VERSION:
+            raise ValueError( "not a jotify counter block: {0}".format( path ) )
+        self.map = mmap.mmap( self._fd, _HEADER.size + self.slots * _SLOT.size
+                              + self.value_slots * _VALUE_SLOT_SIZE )
+        self._alloc_lock = threading.Lock()
+        self._local = threading.local()
+        self._full = False
+        self._values_full = False
+
+
+    def _slot_of( self, id: str ) -> Optional[int]:
+        local = self._local
+        if getattr( local, 'pid', None ) != os.getpid():
+            # a new thread, or a forked child which must not write the
+            # slots of its parent
+            local.pid = os.getpid()
+            local.slots = {} # type: Dict[str,int]
+            local.counts = {} # type: Dict[int,float]
+            local.value_slots = {} # type: Dict[str,int]
+            local.values = {} # type: Dict[int,Histogram]
+        return local.slots.get( id )
+
+
+    def _slot( self, id: str ) -> Optional[int]:
+        slot = self._slot_of( id )
+        if slot is None:
+            slot = self._allocate( id )
+            if slot is not None:
+                self._local.slots[ id ] = slot
+                self._local.counts[ slot ] = 0.0
+        return slot
+
+
+    def _value_slot( self, id: str ) -> Optional[int]:
+        self._slot_of( id )
+        local = self._local
+        slot = local.value_slots.get( id )
+        if slot is None:
+            slot = self._allocate( id, values = True )
+            if slot is not None:
+                local.value_slots[ id ] = slot
+                local.values[ slot ] = Histogram()
+        return slot
+
+
+    def _allocate( self, id: str, values: bool = False ) -> Optional[int]:
+        name = id.encode( 'utf-8' )
+        if len(name) > MAX_NAME_BYTES:
+            _log().warning( "key longer than {0} bytes truncated: {1}".format(
+                MAX_NAME_BYTES, id ) )
+            name = name[ :MAX_NAME_BYTES ]
+        used_offset = _VALUES_USED_OFFSET if values else _USED_OFFSET
+        slots = self.value_slots if values else self.slots
+        with self._alloc_lock:
+            fcntl.flock( self._fd, fcntl.LOCK_EX )
+            try:
+                used = struct.unpack_from( '<I', self.map, used_offset )[0]
+                if used >= slots:
+                    if values and not self._values_full:
+                        self._values_full = True
+                        _log().warning( "all {0} shared value slots in use, "
+                                        "dropping the values of {1}".format( slots, id ) )
+                    elif not values and not self._full:
+                        self._full = True
+                        _log().warning( "all {0} shared counter slots in use, "
+                                        "not counting {1}".format( slots, id ) )
+                    return None
+                # the flags are written last, so readers never see a
+                # half written slot
+                if values:
+                    offset = self._value_offset( used )
+                    _VALUE_SLOT.pack_into( self.map, offset, 0, len(name), os.getpid(),
+                                           0.0, 0.0, math.inf, -math.inf, name )
+                else:
+                    offset = self._offset( used )
+                    _SLOT.pack_into( self.map, offset,
+                                     0, len(name), os.getpid(), 0.0, 0.0, name )
+                self.map[ offset ] = _USED
+                struct.pack_into( '<I', self.map, used_offset, used + 1 )
+                return used
+            finally:
+                fcntl.flock( self._fd, fcntl.LOCK_UN )
+
+
+    def _write_values( self,
+                       slot: int,
+                       h: Histogram,
+                       buckets ) -> None:
+        """
+        Writes the given buckets of this worker's histogram h to its
+        value slot, then its n, sum, min and max.
+        """
+        offset = self._value_offset( slot )
+        counts_offset = offset + _VALUE_SLOT.size
+        for i in buckets:
+            struct.pack_into( '<d', self.map, counts_offset + 8 * i, h.counts[ i ] )
+        _VALUE_STATS.pack_into( self.map, offset + _VALUE_STATS_OFFSET,
+                                h.n, h.sum, h.min, h.max )
+
+
+    def _set_flags( self, slot: int, add: int, clear: int ) -> None:
+        offset = self._offset( slot )
+        self.map[ offset ] = ( self.map[ offset ] | add ) & ~clear
+
+
+    def _offset( self, slot: int ) -> int:
+        return _HEADER.size + slot * _SLOT.size
+
+
+    def _value_offset( self, slot: int ) -> int:
+        return _HEADER.size + self.slots * _SLOT.size + slot * _VALUE_SLOT_SIZE
+
+## ========================================================================
+
+class _SlotCounter( object ):
+    """
+    See SharedCounters.counter.
+    """
+
+    def __init__( self, counters: SharedCounters, id: str ) -> None:
+        self.counters = counters
+        self.id = id
+        self.count = 0.0
+        self.last = None # type: Optional[float]
+
+
+    def __getitem__( self, i: int ):
+        return ( self.count, self.last )[ i ]
+
+
+    def __setitem__( self, i: int, value ) -> None:
+        if i == 0:
+            self.counters.add( self.id, value - self.count )
+            self.count = value
+        elif i == 1:
+            self.last = value
+        else:
+            raise IndexError( "counter index out of range" )
+
+## ========================================================================
+
+class SharedSender( object ):
+    """
+    What track() uses as its sender inside a pool worker: the counters
+    take the place of the sender's state, and sending is left to the
+    process which created them.
+    """
+
+    def __init__( self, counters: SharedCounters ) -> None:
+        self.counters = counters
+        self.state = counters
+
+
+    def flush( self ) -> None:
+        pass
+
+## ========================================================================
+
+_ATTACHED = None # type: Optional[SharedSender]
+
+def attach( counters: SharedCounters ) -> None:
+    """
+    Makes track() in this process count into counters by default.
+    Meant as a pool initializer, e.g.
+
+      counters = default_batch_sender().share_counters()
+      ProcessPoolExecutor( initializer = shared.attach,
+                           initargs = ( counters, ) )
+
+    Forked workers of a process whose default sender shares counters
+    are attached automatically.
+    """
+    global _ATTACHED
+    _ATTACHED = SharedSender( counters )
+
+
+def attached_sender() -> Optional[SharedSender]:
+    return _ATTACHED
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
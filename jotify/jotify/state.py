@@ -1,20 +1,102 @@
 import collections
 import copy
-import datetime
-import json
 import logging
 import threading
-from typing import Dict, Optional
+import time
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from . import codec
+from .codec import podify
+from .histogram import Histogram, percentile
+from .metrics import Metrics, TimedLock
+from .timering import TimeRing
+
+## ========================================================================
+
+def _log():
+    return logging.getLogger( __name__ )
+
+## ========================================================================
+
+##
+# Key priorities, see State.set_priority.
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+
+## ========================================================================
+
+class _Shard( object ):
+    """
+    Per-thread accumulators of a State (see State.counter and
+    State.histogram).
+
+    Only the owning thread ever writes to the entries; the folding
+    thread only reads them (under the State lock) and remembers how
+    much of each running total it has already folded into stats.
+    """
+
+    def __init__( self, thread: threading.Thread ) -> None:
+        self.thread = thread
+        self.entries = {}
+        self.folded = {}
+        self.values = {} # type: Dict[str,Histogram]
+        self.folded_values = {} # type: Dict[str,Histogram]
 
 ## ========================================================================
 
 class State( object ):
 
     def __init__(self,
-                 max_hist: int = 10 ):
-        self.lock = threading.Lock()
-        self.stats = {}
+                 max_hist: int = 10,
+                 sharded: bool = False,
+                 max_keys: Optional[int] = None,
+                 key_ttl_seconds: Optional[float] = None,
+                 finished_ttl_seconds: Optional[float] = None,
+                 metrics: Optional[Metrics] = None ):
+        """
+        When sharded is True, add() accumulates into per-thread
+        counters without taking the lock, and those counters are
+        folded into stats whenever the state is read as a whole
+        (representation, clone, merge) or written by set().
+
+        max_keys bounds the number of keys, evicting the least recently
+        updated ones.  expire_keys() removes keys not updated for
+        key_ttl_seconds, and finished keys (see finish) once
+        finished_ttl_seconds have passed since they finished.  None
+        disables the corresponding limit.
+
+        counter(), histogram() and defer() update the state without
+        ever waiting for its lock, e.g. from an event loop thread (see
+        progress.track_async).
+
+        on_urgent, when set, is called with the key of every event
+        which should reach receivers right away: a key finishing, its
+        schema changing, urgent(), and any update of a PRIORITY_HIGH
+        key (see set_priority).  It is called without the lock held.
+
+        With metrics, the time spent waiting for and holding the lock
+        is recorded there as the timings state.lock.wait and
+        state.lock.hold.
+        """
+        self.lock = threading.Lock() if metrics is None \
+                    else TimedLock( metrics, 'state.lock' )
+        self.stats = collections.OrderedDict()
         self.max_hist = max_hist
+        self.sharded = sharded
+        self.max_keys = max_keys
+        self.key_ttl_seconds = key_ttl_seconds
+        self.finished_ttl_seconds = finished_ttl_seconds
+        self.dirty = set() # type: Set[str]
+        self.removed = set() # type: Set[str]
+        self._finished = {} # type: Dict[str,float]
+        self._local = threading.local()
+        self._shards = [] # type: List[_Shard]
+        self._new_shards = collections.deque() # type: Deque[_Shard]
+        self._deferred = collections.deque() # type: Deque[Tuple[str,tuple,Optional[Tuple[_Shard,float]]]]
+        self.priorities = {} # type: Dict[str,int]
+        self._high = set() # type: Set[str]
+        self.on_urgent = None # type: Optional[Callable[[str],None]]
 
 
     def schema( self,
@@ -22,80 +104,486 @@ class State( object ):
                 min: Optional[float],
                 max: Optional[float] ) -> None:
         with self.lock:
-            if id not in self.stats:
-                self.stats[ id ] = self._scaffold()
-            self.stats[ id ][ 'min' ] = min
-            self.stats[ id ][ 'max' ] = max
+            changed = self._schema( id, min, max )
+        if changed:
+            self._notify( id )
             
 
     def add( self,
              id: str,
              count: float ) -> None:
-        with self.lock:
-            if id not in self.stats:
-                self.stats[ id ] = self._scaffold()
-            self.stats[ id ]['count'] += count
-            self.stats[ id ]['timehist'].append( datetime.datetime.now() )
+        if self.sharded:
+            try:
+                entry = self._local.shard.entries[ id ]
+            except ( AttributeError, KeyError ):
+                entry = self.counter( id )
+            entry[0] += count
+            entry[1] = time.monotonic()
+        else:
+            with self.lock:
+                stat = self.stats.get( id )
+                if stat is None or self.max_keys is not None:
+                    stat = self._entry( id )
+                count = stat['count'] = stat['count'] + count
+                stat['timehist'].record( time.monotonic(), count )
+                self.dirty.add( id )
+        if self._high and id in self._high:
+            self._notify( id )
 
 
     def set( self,
              id: str,
              count: float ) -> None:
         with self.lock:
-            if id not in self.stats:
-                self.stats[ id ] = self._scaffold()
-            self.stats[ id ]['count'] = count
-            self.stats[ id ]['timehist'].append( datetime.datetime.now() )
-            
+            self._fold_shards()
+            self._set( id, count )
+        if self._high and id in self._high:
+            self._notify( id )
+
+
+    def finish( self, id: str ) -> None:
+        """
+        Marks a key as finished (e.g. its tracked iterable is
+        exhausted).  It is still sent, flagged as finished, until
+        finished_ttl_seconds have passed.
+        """
+        with self.lock:
+            self._fold_shards()
+            self._finish( id )
+        self._notify( id )
+
+
+    def modified( self ) -> bool:
+        """
+        Whether any key was modified or removed since the previous
+        representation.
+        """
+        with self.lock:
+            self._fold_shards()
+            return bool( self.dirty or self.removed )
+
+
+    def set_priority( self, id: str, priority: int ) -> None:
+        """
+        Sets the priority of a key (PRIORITY_NORMAL by default): every
+        update of a PRIORITY_HIGH key is urgent (see on_urgent), and a
+        sender may hold back the updates of PRIORITY_LOW keys to send
+        them coalesced (see BatchSender).
+        """
+        with self.lock:
+            if priority == PRIORITY_NORMAL:
+                self.priorities.pop( id, None )
+            else:
+                self.priorities[ id ] = priority
+            self._high = { k for k, p in self.priorities.items()
+                           if p >= PRIORITY_HIGH }
+
+
+    def low_priority_keys( self ) -> Set[str]:
+        """
+        The keys set to PRIORITY_LOW (or below).
+        """
+        with self.lock:
+            return { k for k, p in self.priorities.items()
+                     if p <= PRIORITY_LOW }
+
+
+    def urgent( self, id: str ) -> None:
+        """
+        Asks for the key to reach receivers right away (e.g. after an
+        error), whatever its priority.
+        """
+        with self.lock:
+            if id in self.stats:
+                self.dirty.add( id )
+        self._notify( id )
+
+
+    def counter( self, id: str ) -> List:
+        """
+        Returns the calling thread's [count, last_time] accumulator
+        for id.  The thread adds to count (and sets last_time to
+        time.monotonic()) without locking, and the totals are folded
+        into stats whenever the state is read as a whole, as in a
+        sharded state.  Never waits for the lock.
+        """
+        shard = self._shard()
+        entry = shard.entries.get( id )
+        if entry is None:
+            entry = [ 0.0, None ]
+            shard.entries[ id ] = entry
+        return entry
+
+
+    def histogram( self, id: str ) -> Histogram:
+        """
+        Returns the calling thread's histogram of the values of id,
+        which the thread records into without locking; like counter(),
+        it is folded into stats whenever the state is read as a whole.
+        Never waits for the lock.
+        """
+        shard = self._shard()
+        h = shard.values.get( id )
+        if h is None:
+            h = shard.values[ id ] = Histogram()
+        return h
+
+
+    def record( self,
+                id: str,
+                value: float ) -> None:
+        """
+        Records one value (e.g. the seconds an item took) into the
+        distribution of id, kept as a histogram.Histogram under the
+        entry's 'values'; see percentile.
+        """
+        if self.sharded:
+            self.histogram( id ).record( value )
+            return
+        with self.lock:
+            stat = self._entry( id )
+            h = stat.get( 'values' )
+            if h is None:
+                h = stat[ 'values' ] = Histogram()
+            h.record( value )
+            self.dirty.add( id )
+
+
+    def merge_values( self,
+                      id: str,
+                      values: Histogram ) -> None:
+        """
+        Adds a whole histogram of values (e.g. batched up by the
+        caller) to the distribution of id.
+        """
+        with self.lock:
+            stat = self._entry( id )
+            h = stat.get( 'values' )
+            if h is None:
+                h = stat[ 'values' ] = Histogram()
+            h.merge( values )
+            self.dirty.add( id )
 
 
-    def representation(self) -> bytes:
+    def percentile( self,
+                    id: str,
+                    p: float ) -> Optional[float]:
+        """
+        The p-th percentile (0 to 100) of the values recorded for id,
+        None if there are none.
+        """
         with self.lock:
-            rep = json.dumps( podify( self.stats ) ).encode( 'utf-8' )
-            if len(rep) % 2 == 0:
-                return rep + b" "
-            return rep
+            self._fold_shards()
+            stat = self.stats.get( id )
+            return None if stat is None else percentile( stat, p )
+
+
+    def _shard( self ) -> _Shard:
+        shard = getattr( self._local, 'shard', None )
+        if shard is None:
+            shard = _Shard( threading.current_thread() )
+            self._local.shard = shard
+            self._new_shards.append( shard )
+        return shard
+
+
+    def defer( self, method: str, *args ) -> None:
+        """
+        Queues a call of schema, set or finish, applied in order the
+        next time the state is folded (before the counters), instead
+        of waiting for the lock.
 
+        A deferred set overrides what the calling thread counted into
+        its counter() for the key before the call, as a set does in a
+        sharded state, but not what it counts after.
+        """
+        if method not in ( 'schema', 'set', 'finish' ):
+            raise ValueError( "cannot defer {0}".format( method ) )
+        mark = None
+        if method == 'set':
+            shard = getattr( self._local, 'shard', None )
+            entry = shard.entries.get( args[0] ) if shard is not None else None
+            if entry is not None:
+                mark = ( shard, entry[0] )
+        self._deferred.append( ( method, args, mark ) )
+        if method != 'set':
+            self._notify( args[0] )
 
-    def load( self, rep: bytes ) -> None:
+
+    def remove( self, id: str ) -> None:
+        with self.lock:
+            self._fold_shards()
+            self._remove( id )
+
+
+    def expire_keys( self, now: Optional[float] = None ) -> List[str]:
+        """
+        Removes finished and idle keys whose TTL has passed; returns
+        the removed keys.
+        """
+        if self.key_ttl_seconds is None and self.finished_ttl_seconds is None:
+            return []
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            self._fold_shards()
+            expired = []
+            if self.finished_ttl_seconds is not None:
+                expired.extend(
+                    id for id, t in self._finished.items()
+                    if now - t > self.finished_ttl_seconds )
+            if self.key_ttl_seconds is not None:
+                expired.extend(
+                    id for id, stat in self.stats.items()
+                    if stat[ 'timehist' ].last is not None
+                    and now - stat[ 'timehist' ].last > self.key_ttl_seconds
+                    and id not in self._finished )
+            for id in expired:
+                self._remove( id )
+            return expired
+
+
+    def representation( self,
+                        wire_format: str = codec.WIRE_JSON,
+                        header: Optional[Dict] = None,
+                        delta: bool = False,
+                        hold: Optional[Set[str]] = None ) -> bytes:
+        """
+        Serializes the stats in the given wire format (see codec).
+
+        With delta=True only the keys modified since the previous
+        representation are included, and the keys removed since then
+        are listed under 'removed' in the header.  Either way the sets
+        of modified and removed keys are reset, since the result covers
+        all of them (a full representation implies the removals).
+        Modified keys in hold are left out of a delta, and stay
+        modified for the next one.
+        """
+        with self.lock:
+            self._fold_shards()
+            held = set()
+            if delta:
+                if hold:
+                    held = self.dirty & hold
+                stats = { k : self.stats[k]
+                          for k in self.dirty
+                          if k in self.stats and k not in held }
+                if self.removed:
+                    header = dict( header or {} )
+                    header[ 'removed' ] = sorted( self.removed )
+            else:
+                stats = self.stats
+            self.dirty = held
+            self.removed = set()
+            return codec.encode( stats, wire_format, header )
+
+
+    def load( self, rep: bytes ) -> Dict:
+        """
+        Merges a representation into this state; the wire format is
+        detected from the datagram itself.  Returns the datagram's
+        message header (empty if it had none).
+        """
         new_state = State(self.max_hist)
-        new_state.stats = json.loads( rep.decode('utf-8').strip() )
+        header, new_state.stats = codec.decode_message( rep )
         self.merge( new_state )
+        return header
         
 
     def merge( self, state ) -> None:
         with self.lock:
+            self._fold_shards()
+            with state.lock:
+                state._fold_shards()
+                self._merge_stats( state.stats )
+
+
+    def replace( self,
+                 state,
+                 keep: Optional[Callable[[str],bool]] = None ) -> None:
+        """
+        Makes this state's keys exactly those of state (as when a
+        keyframe arrives), removing any key state does not have, except
+        those for which keep returns True.
+        """
+        with self.lock:
+            self._fold_shards()
             with state.lock:
-                self.stats.update( state.stats )
+                state._fold_shards()
+                for id in [ id for id in self.stats
+                            if id not in state.stats
+                            and ( keep is None or not keep( id ) ) ]:
+                    self._remove( id )
+                self._merge_stats( state.stats )
+
 
     def clone(self) -> 'State':
         with self.lock:
+            self._fold_shards()
             s = State( self.max_hist)
             s.stats = copy.deepcopy( self.stats )
             return s
 
 
+    def _schema( self,
+                 id: str,
+                 min: Optional[float],
+                 max: Optional[float] ) -> bool:
+        stat = self._entry( id )
+        changed = stat[ 'min' ] != min or stat[ 'max' ] != max
+        stat[ 'min' ] = min
+        stat[ 'max' ] = max
+        self.dirty.add( id )
+        return changed
+
+
+    def _set( self, id: str, count: float ) -> None:
+        stat = self._entry( id )
+        stat['count'] = count
+        stat['timehist'].record( time.monotonic(), count )
+        if stat.pop( 'finished', False ):
+            self._finished.pop( id, None )
+        self.dirty.add( id )
+
+
+    def _finish( self, id: str ) -> None:
+        if id not in self.stats:
+            return
+        self.stats[ id ][ 'finished' ] = True
+        self._finished[ id ] = time.monotonic()
+        self.dirty.add( id )
+
+
+    def _notify( self, id: str ) -> None:
+        on_urgent = self.on_urgent
+        if on_urgent is not None:
+            try:
+                on_urgent( id )
+            except Exception:
+                _log().exception( "error in on_urgent: " )
+
+
+    def _entry( self, id: str ) -> Dict:
+        """
+        Returns the stats entry of id, creating it if needed, and marks
+        it most recently used.  Must be called with self.lock held.
+        """
+        stat = self.stats.get( id )
+        if stat is None:
+            stat = self._scaffold()
+            self.stats[ id ] = stat
+            self._evict()
+        elif self.max_keys is not None:
+            self.stats.move_to_end( id )
+        return stat
+
+
+    def _merge_stats( self, stats: Dict ) -> None:
+        for id, stat in stats.items():
+            old = self.stats.get( id )
+            self.stats[ id ] = stat
+            if self.max_keys is not None:
+                self.stats.move_to_end( id )
+            if stat.get( 'finished' ):
+                self._finished.setdefault( id, time.monotonic() )
+            else:
+                self._finished.pop( id, None )
+            if old is None or _modified( old, stat ):
+                self.dirty.add( id )
+        self._evict()
+
+
+    def _evict( self ) -> None:
+        if self.max_keys is None:
+            return
+        while len(self.stats) > self.max_keys:
+            id = next( iter( self.stats ) )
+            _log().debug( "evicting least recently used key {0}".format( id ) )
+            self._remove( id )
+
+
+    def _remove( self, id: str ) -> None:
+        if self.stats.pop( id, None ) is None:
+            return
+        self._finished.pop( id, None )
+        self.dirty.discard( id )
+        self.removed.add( id )
+
+
     def _scaffold(self) -> Dict:
         return { 'count' : 0.0,
                  'min' : None,
                  'max' : None,
-                 'timehist' : collections.deque([],self.max_hist) }
-        
+                 'timehist' : TimeRing( self.max_hist ) }
+
+
+    def _fold_shards( self ) -> None:
+        """
+        Applies the deferred calls, then folds every shard's
+        not-yet-folded counts into stats.  Must be called with
+        self.lock held.
+        """
+        while self._deferred:
+            method, args, mark = self._deferred.popleft()
+            if mark is not None:
+                # the counts queued before the set are overridden by it
+                shard, total = mark
+                shard.folded[ args[0] ] = total
+            getattr( self, '_' + method )( *args )
+        while self._new_shards:
+            self._shards.append( self._new_shards.popleft() )
+        if not self._shards:
+            return
+        live = []
+        for shard in self._shards:
+            alive = shard.thread.is_alive()
+            # the owning thread may be adding entries: copy first
+            for id, entry in list( shard.entries.items() ):
+                total, last = entry[0], entry[1]
+                delta = total - shard.folded.get( id, 0.0 )
+                if delta == 0:
+                    continue
+                shard.folded[ id ] = total
+                stat = self._entry( id )
+                stat[ 'count' ] += delta
+                stat[ 'timehist' ].record( last, stat[ 'count' ] )
+                self.dirty.add( id )
+            for id, h in list( shard.values.items() ):
+                folded = shard.folded_values.get( id )
+                if folded is not None and h.n == folded.n:
+                    continue
+                h = h.copy()
+                stat = self._entry( id )
+                if 'values' not in stat:
+                    stat[ 'values' ] = Histogram()
+                stat[ 'values' ].merge( h, since = folded )
+                shard.folded_values[ id ] = h
+                self.dirty.add( id )
+            if alive:
+                live.append( shard )
+        self._shards = live
+
 
 ## ========================================================================
 
-def podify( x ):
-    if x is None:
-        return x
-    if isinstance( x, ( str, int, float ) ):
-        return x
-    if isinstance( x, collections.deque ):
-        return podify( list( x ) )
-    if isinstance( x, (list,tuple) ):
-        return list(map(podify,x))
-    if isinstance( x, dict ):
-        return dict(map(podify,x.items()))
-    return str( x )
+def _modified( old: Dict, new: Dict ) -> bool:
+    """
+    Whether a merged entry differs from the one it replaces (a
+    keyframe resends unchanged keys).  Received timestamps go through
+    the epoch and back, so they are compared to the millisecond.
+    """
+    old_last = old[ 'timehist' ].last
+    new_last = new[ 'timehist' ].last
+    old_values = old.get( 'values' )
+    new_values = new.get( 'values' )
+    return old[ 'count' ] != new[ 'count' ] \
+        or ( old_values is None ) != ( new_values is None ) \
+        or ( old_values is not None and old_values.n != new_values.n ) \
+        or old.get( 'min' ) != new.get( 'min' ) \
+        or old.get( 'max' ) != new.get( 'max' ) \
+        or old.get( 'finished' ) != new.get( 'finished' ) \
+        or ( old_last is None ) != ( new_last is None ) \
+        or ( old_last is not None and abs( old_last - new_last ) > 1e-3 )
 
 ## ========================================================================
 ## ========================================================================
@@ -1,12 +1,18 @@
 import datetime
-import json
 import logging
-import socket
-import struct
 import threading
-from typing import Callable, Any
+import time
+from typing import Callable, Any, Dict, Optional, Tuple, TYPE_CHECKING
 
+from . import fragment
+from .aggregate import SenderAggregator
+from .metrics import Metrics
+from .scheduler import Scheduler, Task, default_scheduler
 from .state import State
+from .transport import MulticastTransport, Transport
+
+if TYPE_CHECKING:
+    from .recorder import Recorder
 
 ## ========================================================================
 
@@ -25,23 +31,90 @@ class UI( object ):
                   bind_ip: str = '',
                   multicast_ip: str = '224.0.0.1',
                   multicast_port: int = 10000,
-                  max_buffer_size: int = 1024 * 16 ) -> None:
+                  max_buffer_size: int = 1024 * 1024 * 16,
+                  reassembly_timeout_seconds: float = 5.0,
+                  sender_ttl_seconds: float = 60.0,
+                  scheduler: Optional[Scheduler] = None,
+                  columnar: bool = False,
+                  max_keys: Optional[int] = None,
+                  key_ttl_seconds: Optional[float] = None,
+                  finished_ttl_seconds: Optional[float] = None,
+                  transport: Optional[Transport] = None,
+                  recorder: Optional['Recorder'] = None ) -> None:
         """
+        transport (see transport) is where states are received from;
+        by default a transport.MulticastTransport joining
+        multicast_ip:multicast_port on bind_ip.
+
+        max_buffer_size bounds the size of a single (reassembled)
+        state; partially received states use at most four times that
+        and are dropped after reassembly_timeout_seconds.
+
+        States are kept per sender (see aggregate.SenderAggregator) and
+        listeners receive the per-key totals across senders; senders
+        silent for sender_ttl_seconds are forgotten.  max_keys,
+        key_ttl_seconds and finished_ttl_seconds bound the keys kept
+        per sender (see State).
+
+        Syncs are run by scheduler, by default the one shared by the
+        whole process; only receiving has a thread of its own.
+        Listeners are only called when something changed since the
+        previous sync, and are given an immutable snapshot which shares
+        its unchanged keys with the previous one (see
+        SenderAggregator.aggregate); self.version identifies it.
+
+        With columnar=True (requires numpy) the totals are kept in a
+        columnar.ColumnarStore instead, and listeners receive its
+        ColumnarSnapshot (rates, percent complete, ETA and staleness of
+        every key computed in one batched pass) rather than a State.
+        It is recomputed at every sync, so ages keep moving while
+        senders are quiet, and a key turning stale (or fresh again)
+        counts as a change.
+
+        recorder (a recorder.Recorder) appends every state received to
+        an on-disk log, for querying and replay later on.
+
+        self.metrics (see metrics.Metrics) records the UI's own work:
+        receive.datagrams and receive.bytes, the receive.parse and
+        ui.listener (listener callback) timings, receive.errors and
+        receive.stale (messages dropped as out of order), and as of the
+        last sync the gauges receive.dropped_chunks, receive.oversize
+        (states over max_buffer_size), receive.missed and
+        receive.senders.
         """
+        self.metrics = Metrics()
         self.refresh_interval_seconds = refresh_interval_seconds
         self.receive_sleep_seconds = receive_sleep_seconds
         self.bind_ip = bind_ip
-        self.multicast_group = ( multicast_ip, multicast_port )
+        if transport is None:
+            transport = MulticastTransport( multicast_ip, multicast_port, bind_ip )
+        self.transport = transport
+        self.recorder = recorder
         self.max_buffer_size = max_buffer_size
         self.state = State()
-        self.incremental_state = State()
-        self.sync_thread = None
+        self.version = 0
+        self.synced_version = None # type: Optional[int]
+        self._columns_snapshot = None
+        self._stale_changes = 0
+        self.senders = SenderAggregator(
+            sender_ttl_seconds,
+            max_keys = max_keys,
+            key_ttl_seconds = key_ttl_seconds,
+            finished_ttl_seconds = finished_ttl_seconds )
+        self.columns = None
+        if columnar:
+            from .columnar import ColumnarStore
+            self.columns = ColumnarStore()
+        self.scheduler = scheduler
+        self.sync_task = None # type: Optional[Task]
         self.receive_thread = None
         self.running = False
-        self.socket = None
         self.state_listeners = []
         self.lock = threading.Lock()
-        self.buff = bytearray( 1024 )
+        self.reassembler = fragment.Reassembler(
+            max_buffer_size,
+            4 * max_buffer_size,
+            reassembly_timeout_seconds )
 
 
     def __del__(self) -> None:
@@ -51,37 +124,49 @@ class UI( object ):
     def pause(self) -> None:
         _log().info( "paused UI called..." )
         self.running = False
-        if self.sync_thread is not None:
-            self.sync_thread.join()
-            del self.sync_thread
-            self.sync_thread = None
-            _log().info( "  UI joined sync thread" )
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+            self.sync_task = None
+            _log().info( "  UI cancelled sync task" )
+        # wakes up a receive blocked in the transport
+        self.transport.wake()
         if self.receive_thread is not None:
             self.receive_thread.join()
             del self.receive_thread
             self.receive_thread = None
             _log().info( "  UI joined receive thread" )
-        if self.socket is not None:
-            self.socket.close()
-            _log().info( "  UI closed socket" )
+        self.transport.close()
+        _log().info( "  UI closed transport" )
+        if self.recorder is not None:
+            self.recorder.flush()
         _log().info( "UI paused!" )
 
 
     def start(self) -> None:
         _log().info( "start UI called..." )
         self.running = True
-        self.sync_thread = threading.Thread(
-            target=self._sync_loop,
-            args=(self.refresh_interval_seconds, self._sync_state) )
         self.receive_thread = threading.Thread(
             target=self._receive_loop,
             args=(self.receive_sleep_seconds, self._receive) )
-        self._open_socket()
-        self.sync_thread.start()
+        self.transport.open_receiver( self.receive_sleep_seconds )
         self.receive_thread.start()
+        if self.scheduler is None:
+            self.scheduler = default_scheduler()
+        self.sync_task = self.scheduler.schedule( self.refresh_interval_seconds,
+                                                  self._sync_state )
         _log().info( "UI started!" )
 
 
+    def refresh(self) -> None:
+        """
+        Syncs the listeners right away instead of at the next refresh
+        interval, even if nothing changed.
+        """
+        if self.running:
+            self.synced_version = None
+            self._sync_soon()
+
+
     def add_state_listener( self,
                             c: Callable[[State],None] ) -> None:
         self.state_listeners.append( c )
@@ -92,100 +177,152 @@ class UI( object ):
         self.state_listeners.remove( c )
 
         
-    def _open_socket(self) -> None:
-        server_address = ( self.bind_ip, self.multicast_group[1] )
-        self.socket = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
-        group = socket.inet_aton( self.multicast_group[0] )
-        mreq = struct.pack('4sL', group, socket.INADDR_ANY)
-        self.socket.setsockopt(
-            socket.IPPROTO_IP,
-            socket.IP_ADD_MEMBERSHIP,
-             mreq)
-        self.socket.setsockopt(
-            socket.SOL_SOCKET,
-            socket.SO_REUSEADDR,
-            1 )
-        self.socket.settimeout( self.receive_sleep_seconds )
-        self.socket.bind( server_address )
-        _log().info( "Opened socket for receiving" )
+    def _sync_soon(self) -> None:
+        """
+        Runs a sync as soon as possible; subclasses running on an
+        event loop schedule it there.
+        """
+        if self.sync_task is not None:
+            self.sync_task.run_now()
 
 
-    def _sync_state(self) -> None:
-        self.state.merge( self.incremental_state )
+    def _changed_snapshot(self) -> Any:
+        """
+        The snapshot listeners are to be given, or None when nothing
+        changed since the previous sync.
+        """
         with self.lock:
-            s = self.state.clone()
-            self.incremental_state = State()
+            s = self._snapshot()
+        if self.version == self.synced_version:
+            _log().debug( "state unchanged, not syncing" )
+            return None
+        self.synced_version = self.version
+        return s
+
+
+    def _sync_state(self) -> None:
+        s = self._changed_snapshot()
+        if s is None:
+            return
         _log().debug( "syncing state..." )
         for c in self.state_listeners:
+            started = time.perf_counter()
             c(s)
+            self.metrics.time( 'ui.listener', time.perf_counter() - started )
         _log().debug( "synced state..." )
 
-    def _sync_loop(self, interval_seconds, F) -> None:
+
+    def _ingest( self,
+                 sender_id: str,
+                 header: Dict,
+                 state: State ) -> None:
         """
+        Applies a received state; callers hold self.lock.
         """
-        start_time = datetime.datetime.now()
-        last_send_time = start_time
-        _log().info( "  sync loop start at {0}".format( start_time ) )
-        while self.running:
+        if not self.senders.apply( sender_id, header, state ):
+            self.metrics.count( 'receive.stale' )
+            return
+        if self.columns is not None:
+            self.columns.apply( sender_id, state )
+        if self.recorder is not None:
+            self.recorder.record( sender_id, header, state )
 
-            now = datetime.datetime.now()
-            if ( now - last_send_time ).total_seconds() >= interval_seconds:
-                try:
-                    last_send_time = now
-                    F()
-                except Exception:
-                    raise
 
-            # sleep
-            try:
-                dt = interval_seconds - ( now - last_send_time ).total_seconds()
-                if dt > 0:
-                    time.sleep( dt )
-            except Exception:
-                pass
+    def _snapshot( self ) -> Any:
+        """
+        Expires silent senders and returns what listeners are given,
+        an immutable snapshot whose version is self.version; callers
+        hold self.lock.
+        """
+        expired = self.senders.expire()
+        if self.columns is not None:
+            for sender_id in expired:
+                self.columns.remove_sender( sender_id )
+            if self.senders.changed_keys():
+                for sender_id, sender in self.senders.senders.items():
+                    self.columns.retain( sender_id, sender.state.stats )
+            previous = self._columns_snapshot
+            s = self._columns_snapshot = self.columns.snapshot()
+            if previous is not None and previous.keys == s.keys \
+               and ( previous.stale != s.stale ).any():
+                self._stale_changes += 1
+        else:
+            s = self.state = self.senders.aggregate()
+        self.version = self.senders.version + self._stale_changes
+        metrics = self.metrics
+        metrics.gauge( 'receive.dropped_chunks', self.reassembler.dropped )
+        metrics.gauge( 'receive.oversize', self.reassembler.oversize )
+        metrics.gauge( 'receive.missed', self.senders.missed )
+        metrics.gauge( 'receive.senders', len(self.senders.senders) )
+        return s
 
 
-    def _receive(self ) -> State:
+    def _receive(self ) -> Optional[Tuple[str,Dict,State]]:
         """
+        Receives one message.  Returns the sender id, message header
+        and decoded State, or None if nothing arrived or the datagram
+        was a chunk of a state which is not complete yet.
         """
-        have_data = False
-        try:
-            _log().debug( "  receive starting..." )
-            n = self.socket.recv_into( self.buff )
-            _log().debug( "  have data ({0})".format( n ) ) 
-            have_data = True
-            more_data = ( n >= len(self.buff) )
-            while more_data:
-
-                # increase the buffer size and keep receiving bytes.
-                # variable "n" holds information across the loop so
-                # that tracks where to keep filling the buffer,
-                # make sure it's not update in a wrong order
-                new_n = n * 2
-                if new_n > self.max_buffer_size:
-                    raise RuntimeError( "Maximum receive buffer size of '{0}' reached!".format( self.max_buffer_size ) )
-                _log().info( "  increasing receive buffer to {0}".format(
-                    new_n ) )
-                self.buff = self.buff + bytearray(n)
-
-                recv_n = self.socket.recv_into( self.buff[n:] )
-                more_data = ( recv_n + n >= new_n )
-                n = new_n
-
-            # ok, finally got some data in, decode and de-jsonify
-            _log().debug( "  received {0} bytes".format( n ) )
-            _log().debug( "  buff={0}".format( self.buff[:n] ) )
-            s = State()
-            s.load( self.buff[:n] )
-            _log().debug( "  decoded {0}".format( s ) )
-            return s
-                
-                
-        except socket.timeout:
-            if not have_data:
-                _log().debug( "  nothign to receive" )
+        _log().debug( "  receive starting..." )
+        received = self.transport.receive()
+        if received is None:
+            _log().debug( "  nothign to receive" )
+            return None
+        rep, address = received
+        _log().debug( "  received {0} bytes".format( len(rep) ) )
+        return self._decode( rep, address )
+
+
+    def _decode( self,
+                 rep: bytes,
+                 address: Any ) -> Optional[Tuple[str,Dict,State]]:
+        """
+        Decodes one datagram received from address, see _receive.
+        """
+        self.metrics.count( 'receive.datagrams' )
+        self.metrics.count( 'receive.bytes', len(rep) )
+        if fragment.is_chunk( rep ):
+            rep = self.reassembler.add( address, rep )
+            if rep is None:
                 return None
-            raise RuntimeError( "timeout *after* we had read some data!" )
+        s = State()
+        with self.metrics.timed( 'receive.parse' ):
+            header = s.load( rep )
+        _log().debug( "  decoded {0}".format( s ) )
+
+        # senders predating sender ids are told apart by address
+        sender_id = header.get( 'sender' )
+        if not sender_id:
+            sender_id = "{0}:{1}".format( *address[:2] ) \
+                        if isinstance( address, tuple ) else str( address )
+        return sender_id, header, s
+
+
+    def _datagram_received( self, data: bytes, address: Any ) -> None:
+        """
+        Decodes and ingests one datagram, for subclasses receiving on
+        an event loop rather than in _receive_loop.
+        """
+        try:
+            received = self._decode( data, address )
+            if received is not None:
+                with self.lock:
+                    self._ingest( *received )
+        except Exception:
+            self.metrics.count( 'receive.errors' )
+            _log().exception( "error receiving: " )
+
+
+    def _drain(self) -> None:
+        """
+        Receives every message the transport has ready, without
+        waiting (event loop subclasses open it with a zero timeout).
+        """
+        while self.running:
+            received = self.transport.receive()
+            if received is None:
+                return
+            self._datagram_received( *received )
 
         
     def _receive_loop(self, sleep_seconds, F) -> None:
@@ -196,10 +333,12 @@ class UI( object ):
         _log().debug( "  receive loop start at {0}".format( start_time ) )
         while self.running:
             try:
-                s = F()
-                if s is not None:
-                    self.incremental_state.merge( s )
+                received = F()
+                if received is not None:
+                    with self.lock:
+                        self._ingest( *received )
             except:
+                self.metrics.count( 'receive.errors' )
                 _log().exception( "error receiving: " )
                 continue
             
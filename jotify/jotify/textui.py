@@ -1,9 +1,17 @@
+import argparse
 import datetime
 import logging
+import os
+import select
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Set
 
+from .histogram import percentile
 from .state_ui import UI, State
+from .timering import eta_seconds
 
-import dateutil.parser
 import blessings
 
 ## ========================================================================
@@ -13,37 +21,190 @@ def _log():
 
 ## ========================================================================
 
-def _show_state( s: State,
-                 term ) -> None:
-    with term.fullscreen():
-        with term.location( 0, 0 ):
-            print( term.green( "Jotify Text UI \U0001F618" ) )
-            for k in sorted(s.stats.keys()):
-                last = None
-                td = None
-                try:
-                    if len(s.stats[k]['timehist']) > 0:
-                        last = s.stats[k]['timehist'][-1]
-                        last = dateutil.parser.parse(last)
-                    if last is not None:
-                        td = datetime.datetime.now() - last
-                    print( "{key} : {count}  ({td} ago)".format(
-                        key = k.ljust(80),
-                        count = str(s.stats[k]['count']).rjust(10),
-                        td = td ) )
-                except:
-                    _log().exception( "ERROR: " )
-                    print( term.red( "stats = {0}".format( s.stats ) ) )
-            
+class TextRenderer( object ):
+    """
+    Draws states on a terminal, one key per line, rewriting only the
+    lines which differ from the previous frame.
+
+    The sorted key order is kept until the set of keys changes, and
+    only the rows of the visible window (see scroll) are formatted.
+    Ages are shown to the second, so redrawing the same state every
+    second (tick) only rewrites the lines whose age moved.
+    render() and tick() may be called from different threads.
+    """
+
+    def __init__( self, term ) -> None:
+        self.term = term
+        self.offset = 0
+        self.state = None # type: Optional[State]
+        self._keys = [] # type: List[str]
+        self._key_set = set() # type: Set[str]
+        self._lines = {} # type: Dict[int,str]
+        self._size = None
+        self._lock = threading.Lock()
+
+
+    def render( self, s: State ) -> None:
+        with self._lock:
+            self.state = s
+            self._draw()
+
+
+    def tick( self ) -> None:
+        """
+        Redraws the last state, for the ages to move.
+        """
+        with self._lock:
+            if self.state is not None:
+                self._draw()
+
+
+    def scroll( self, rows: int ) -> None:
+        with self._lock:
+            self.offset += rows
+            if self.state is not None:
+                self._draw()
+
+
+    @property
+    def page_rows( self ) -> int:
+        return max( 1, ( self.term.height or 24 ) - 2 )
+
+
+    def _draw( self ) -> None:
+        term = self.term
+        stats = self.state.stats
+        if stats.keys() != self._key_set:
+            self._key_set = set( stats.keys() )
+            self._keys = sorted( self._key_set )
+        size = ( term.width, term.height )
+        if size != self._size:
+            # everything moved, start from a blank screen
+            self._size = size
+            self._lines = {}
+            self._write( term.clear )
+        rows = self.page_rows
+        self.offset = max( 0, min( self.offset, len(self._keys) - rows ) )
+        visible = self._keys[ self.offset : self.offset + rows ]
+        now = time.monotonic()
+        lines = { 0 : term.green( "Jotify Text UI \U0001F618" ) }
+        for i, key in enumerate( visible ):
+            lines[ i + 1 ] = _format_line( key, stats[ key ], now, term.width )
+        lines[ rows + 1 ] = "keys {0}-{1} of {2}  (j/k scroll, space/b page, q quit)".format(
+            self.offset + 1 if visible else 0,
+            self.offset + len(visible),
+            len(self._keys) )
+        out = []
+        for y in range( rows + 2 ):
+            line = lines.get( y, "" )
+            if self._lines.get( y ) != line:
+                out.append( term.move( y, 0 ) + line + term.clear_eol )
+                self._lines[ y ] = line
+        if out:
+            self._write( "".join( out ) )
+
+
+    def _write( self, text: str ) -> None:
+        sys.stdout.write( text )
+        sys.stdout.flush()
+
+## ========================================================================
+
+def _format_line( key: str,
+                  stat: Dict,
+                  now: float,
+                  width: Optional[int] ) -> str:
+    try:
+        last = stat[ 'timehist' ].last
+        age = None if last is None else \
+              datetime.timedelta( seconds = int( now - last ) )
+        eta = eta_seconds( stat )
+        p50 = percentile( stat, 50 )
+        line = "{key} : {count}  {rate:>10.1f}/s  ({age} ago){eta}{values}".format(
+            key = key.ljust(80),
+            count = str(stat['count']).rjust(10),
+            rate = stat['timehist'].ewma,
+            age = age,
+            eta = "" if eta is None else "  eta {0}".format(
+                datetime.timedelta( seconds = int(eta) ) ),
+            values = "" if p50 is None else "  p50 {0:.3g} p99 {1:.3g}".format(
+                p50, percentile( stat, 99 ) ) )
+    except:
+        _log().exception( "ERROR: " )
+        line = "{0} : stats = {1}".format( key, stat )
+    return line[ :width ] if width else line
+
+## ========================================================================
+
+def _read_keys( renderer: TextRenderer, stop: threading.Event ) -> None:
+    """
+    Scrolls the renderer on j/k (line) and space/b (page); q stops.
+    Checks stop at least every 0.2 seconds, so the terminal mode is
+    restored soon after.
+    """
+    import termios
+    import tty
+    fd = sys.stdin.fileno()
+    saved = termios.tcgetattr( fd )
+    try:
+        tty.setcbreak( fd )
+        while not stop.is_set():
+            readable, _, _ = select.select( [ fd ], [], [], 0.2 )
+            if not readable:
+                continue
+            c = os.read( fd, 1 )
+            if c in ( b'q', b'' ):
+                stop.set()
+            elif c == b'j':
+                renderer.scroll( 1 )
+            elif c == b'k':
+                renderer.scroll( -1 )
+            elif c == b' ':
+                renderer.scroll( renderer.page_rows )
+            elif c == b'b':
+                renderer.scroll( -renderer.page_rows )
+    finally:
+        termios.tcsetattr( fd, termios.TCSADRAIN, saved )
 
 ## ========================================================================
 
 
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser()
+    parser.add_argument( '--port', type = int, default = 10000,
+                         help = "multicast port, e.g. the output of a jotify.relay" )
+    parser.add_argument( '--refresh', type = float, default = 5.0 )
+    args = parser.parse_args()
+
     term = blessings.Terminal()
+    renderer = TextRenderer( term )
+    stop = threading.Event()
 
-    ui = UI( 5.0 )
-    ui.add_state_listener(lambda s: _show_state(s,term) )
-    ui.start()
-    
+    ui = UI( args.refresh, multicast_port = args.port )
+    ui.add_state_listener( renderer.render )
+    saved_tty = None
+    reader = None
+    if sys.stdin.isatty():
+        import termios
+        saved_tty = termios.tcgetattr( sys.stdin.fileno() )
+    with term.fullscreen(), term.hidden_cursor():
+        ui.start()
+        if saved_tty is not None:
+            reader = threading.Thread( target = _read_keys,
+                                       args = ( renderer, stop ),
+                                       daemon = True )
+            reader.start()
+        try:
+            while not stop.wait( 1.0 ):
+                renderer.tick()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop.set()
+            if reader is not None:
+                reader.join( 1.0 )
+            if saved_tty is not None:
+                # whatever the key reader got to, leave echo on
+                termios.tcsetattr( sys.stdin.fileno(), termios.TCSADRAIN, saved_tty )
+            ui.pause()
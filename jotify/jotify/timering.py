@@ -0,0 +1,238 @@
+import array
+import math
+import time
+from typing import Dict, Iterable, Iterator, List, Optional
+
+## ========================================================================
+
+##
+# Time constant (seconds) of the exponentially weighted rate.
+EWMA_TAU_SECONDS = 10.0
+
+## ========================================================================
+
+class TimeRing( object ):
+    """
+    The update history of one key: a fixed-size ring of monotonic
+    timestamps, along with the cumulative count at each of them.
+
+    Provides, computed lazily from the records not folded in yet
+    (so record() itself stays a couple of array writes):
+      rate : items per second over the window held by the ring
+      ewma : exponentially weighted items per second (time constant
+             EWMA_TAU_SECONDS), bias corrected so that it is usable
+             from the first few updates on
+    Records which left the ring before being folded in are folded as
+    one step, at the average rate over their span.
+
+    Iterating yields the timestamps oldest first, so the ring can be
+    used where the old deque of datetimes was.
+    """
+
+    __slots__ = ( 'capacity', 'times', 'counts', 'start', 'size',
+                  '_end', '_last_count', '_rate', '_ewma', '_ewma_raw', '_ewma_weight',
+                  '_folded_t', '_folded_count', '_pending' )
+
+    def __init__( self, capacity: int ) -> None:
+        self.capacity = max( 1, capacity )
+        self.times = array.array( 'd', bytes( 8 * self.capacity ) )
+        self.counts = array.array( 'd', bytes( 8 * self.capacity ) )
+        self.start = 0
+        self.size = 0
+        self.clear()
+
+
+    def record( self, t: float, count: float ) -> None:
+        """
+        Records that the cumulative count was count at monotonic time t.
+        A count lower than the previous one (the key was reset) starts
+        the history afresh.
+        """
+        if count < self._last_count:
+            self.clear()
+        self._last_count = count
+        index = self._end
+        self.times[ index ] = t
+        self.counts[ index ] = count
+        index += 1
+        if index == self.capacity:
+            index = 0
+        self._end = index
+        if self.size < self.capacity:
+            self.size += 1
+        else:
+            self.start = index
+        self._pending += 1
+
+
+    def clear( self ) -> None:
+        self.start = 0
+        self.size = 0
+        self._end = 0
+        self._last_count = -math.inf
+        self._rate = 0.0
+        self._ewma = 0.0
+        self._ewma_raw = 0.0
+        self._ewma_weight = 0.0
+        self._folded_t = None # type: Optional[float]
+        self._folded_count = 0.0
+        self._pending = 0
+
+
+    @property
+    def rate( self ) -> float:
+        if self._pending:
+            self._fold()
+        return self._rate
+
+
+    @property
+    def ewma( self ) -> float:
+        if self._pending:
+            self._fold()
+        return self._ewma
+
+
+    def _fold( self ) -> None:
+        """
+        Folds the records made since the previous fold into the rate
+        and ewma.
+        """
+        capacity = self.capacity
+        last_t, last_count = self._folded_t, self._folded_count
+        for i in range( self.size - min( self._pending, self.size ), self.size ):
+            index = ( self.start + i ) % capacity
+            t = self.times[ index ]
+            count = self.counts[ index ]
+            if last_t is not None:
+                dt = t - last_t
+                if dt > 0:
+                    alpha = 1.0 - math.exp( -dt / EWMA_TAU_SECONDS )
+                    self._ewma_raw += alpha * ( ( count - last_count ) / dt
+                                                - self._ewma_raw )
+                    self._ewma_weight += alpha * ( 1.0 - self._ewma_weight )
+                    self._ewma = self._ewma_raw / self._ewma_weight
+            last_t, last_count = t, count
+        self._folded_t, self._folded_count = last_t, last_count
+        self._pending = 0
+        if self.size > 1:
+            span = last_t - self.times[ self.start ]
+            if span > 0:
+                self._rate = ( last_count - self.counts[ self.start ] ) / span
+
+
+    @property
+    def last( self ) -> Optional[float]:
+        if not self.size:
+            return None
+        return self.times[ ( self.start + self.size - 1 ) % self.capacity ]
+
+
+    def __len__( self ) -> int:
+        return self.size
+
+
+    def __iter__( self ) -> Iterator[float]:
+        for i in range( self.size ):
+            yield self.times[ ( self.start + i ) % self.capacity ]
+
+
+    def __getitem__( self, i: int ) -> float:
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError( "TimeRing index out of range" )
+        return self.times[ ( self.start + i ) % self.capacity ]
+
+
+    def __deepcopy__( self, memo ) -> 'TimeRing':
+        return self.copy()
+
+
+    def copy( self ) -> 'TimeRing':
+        ring = TimeRing.__new__( TimeRing )
+        ring.capacity = self.capacity
+        ring.times = array.array( 'd', self.times )
+        ring.counts = array.array( 'd', self.counts )
+        ring.start = self.start
+        ring.size = self.size
+        ring._end = self._end
+        ring._last_count = self._last_count
+        ring._rate = self._rate
+        ring._ewma = self._ewma
+        ring._ewma_raw = self._ewma_raw
+        ring._ewma_weight = self._ewma_weight
+        ring._folded_t = self._folded_t
+        ring._folded_count = self._folded_count
+        ring._pending = self._pending
+        return ring
+
+
+    def epoch_times( self, offset: Optional[float] = None ) -> List[float]:
+        """
+        The timestamps as epoch seconds, for sending to other hosts.
+        """
+        if offset is None:
+            offset = epoch_offset()
+        return [ t + offset for t in self ]
+
+
+    @classmethod
+    def from_values( cls,
+                     capacity: int,
+                     times: Iterable[float],
+                     rate: float = 0.0,
+                     ewma: float = 0.0 ) -> 'TimeRing':
+        """
+        Builds a ring from monotonic timestamps (e.g. received ones)
+        with an already known rate and ewma.
+        """
+        ring = cls( capacity )
+        for t in times:
+            if ring.size < ring.capacity:
+                ring.times[ ring.size ] = t
+                ring.size += 1
+            else:
+                ring.times[ ring.start ] = t
+                ring.start = ( ring.start + 1 ) % ring.capacity
+        ring._end = ( ring.start + ring.size ) % ring.capacity
+        if ring.size:
+            ring._last_count = 0.0
+        ring._rate = rate
+        ring._ewma = ewma
+        ring._ewma_raw = ewma
+        ring._ewma_weight = 1.0 if ewma else 0.0
+        ring._folded_t = ring.last
+        return ring
+
+## ========================================================================
+
+def epoch_offset() -> float:
+    """
+    Seconds to add to a time.monotonic() value to get epoch seconds.
+    """
+    return time.time() - time.monotonic()
+
+
+def eta_seconds( entry: Dict ) -> Optional[float]:
+    """
+    Estimated seconds until a key's count reaches the end of its
+    schema, using the smoothed rate.  None when the schema or the rate
+    is unknown.
+    """
+    lo = entry.get( 'min' )
+    hi = entry.get( 'max' )
+    ring = entry.get( 'timehist' )
+    if lo is None or hi is None or not isinstance( ring, TimeRing ):
+        return None
+    rate = ring.ewma or ring.rate
+    if rate <= 0:
+        return None
+    remaining = ( hi - lo + 1 ) - entry[ 'count' ]
+    return max( 0.0, remaining ) / rate
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
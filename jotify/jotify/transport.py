@@ -0,0 +1,473 @@
+import errno
+import logging
+import mmap
+import os
+import random
+import select
+import socket
+import struct
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import fragment
+
+## ========================================================================
+
+def _log():
+    return logging.getLogger( __name__ )
+
+## ========================================================================
+
+RECEIVE_SOCKET_BUFFER_SIZE = 1024 * 1024 * 4
+
+## ========================================================================
+
+class Transport( object ):
+    """
+    How a BatchSender gets its serialized states to a UI.
+
+    A transport instance serves one side: a sender calls
+    open_sender(), send() and close(); a receiver calls
+    open_receiver(), receive() and close(), and wake() from another
+    thread to interrupt a receive().
+
+    Datagram transports (fragmented = True) carry messages of at most
+    max_datagram_size bytes, so larger states are sent as chunks (see
+    fragment); others carry whole states.  Transports built on a
+    socket expose it as self.socket, for receivers running on an event
+    loop.
+
+    Receivers tell senders which do not send their id apart by the
+    address messages come from; transports whose sender addresses are
+    not distinct (distinct_addresses = False) make BatchSender always
+    send its id.
+    """
+
+    fragmented = True
+    distinct_addresses = True
+    socket = None # type: Optional[socket.socket]
+
+    def open_sender( self ) -> None:
+        raise NotImplementedError()
+
+
+    def send( self, messages: List[bytes] ) -> Optional[int]:
+        """
+        Sends each message whole; returns the total bytes sent or None
+        on error.
+        """
+        raise NotImplementedError()
+
+
+    def open_receiver( self, timeout_seconds: float ) -> None:
+        raise NotImplementedError()
+
+
+    def receive( self ) -> Optional[Tuple[bytes,Any]]:
+        """
+        Waits up to the receiver's timeout for a message; returns it
+        along with the address it came from, or None.  The message is
+        only valid until the next receive().
+        """
+        raise NotImplementedError()
+
+
+    def wake( self ) -> None:
+        pass
+
+
+    def close( self ) -> None:
+        pass
+
+## ========================================================================
+
+class _SocketTransport( Transport ):
+    """
+    Receiving sockets are non-blocking: receivers wait on them (up to
+    the timeout) along with one end of a socket pair, which wake()
+    writes to, since a datagram socket cannot be shut down to
+    interrupt a recvfrom().
+    """
+
+    def __init__( self ) -> None:
+        self.socket = None
+        self.buff = bytearray( fragment.MAX_DATAGRAM_SIZE )
+        self._waker = None # type: Optional[Tuple[socket.socket,socket.socket]]
+        self._timeout_seconds = None # type: Optional[float]
+
+
+    def send( self, messages: List[bytes] ) -> Optional[int]:
+        sent_n = 0
+        try:
+            for message in messages:
+                sent_n += self.socket.sendto( message, self.address )
+            return sent_n
+        except:
+            _log().exception( "error sending socket data: " )
+            return None
+
+
+    def receive( self ) -> Optional[Tuple[bytes,Any]]:
+        try:
+            # a single call while datagrams keep arriving
+            n, address = self.socket.recvfrom_into( self.buff )
+        except BlockingIOError:
+            wait = [ self.socket ]
+            if self._waker is not None:
+                wait.append( self._waker[0] )
+            readable, _, _ = select.select( wait, [], [],
+                                            self._timeout_seconds )
+            if self.socket not in readable:
+                if self._waker is not None and self._waker[0] in readable:
+                    self._drain_waker()
+                return None
+            try:
+                n, address = self.socket.recvfrom_into( self.buff )
+            except BlockingIOError:
+                return None
+        if n == 0:
+            return None
+        # the buffer holds the largest possible datagram, so nothing
+        # was truncated; larger states arrive as chunks
+        return memoryview( self.buff )[ :n ], address
+
+
+    def wake( self ) -> None:
+        if self._waker is not None:
+            try:
+                self._waker[1].send( b'\0' )
+            except OSError:
+                pass
+
+
+    def close( self ) -> None:
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        if self._waker is not None:
+            for s in self._waker:
+                s.close()
+            self._waker = None
+
+
+    def _open_waker( self, timeout_seconds: float ) -> None:
+        self._timeout_seconds = timeout_seconds
+        self.socket.setblocking( False )
+        if self._waker is None:
+            self._waker = socket.socketpair()
+            for s in self._waker:
+                s.setblocking( False )
+
+
+    def _drain_waker( self ) -> None:
+        try:
+            while self._waker[0].recv( 64 ):
+                pass
+        except OSError:
+            pass
+
+
+    def _grow_receive_buffer( self ) -> None:
+        try:
+            # room for a burst of chunks from a large state
+            self.socket.setsockopt(
+                socket.SOL_SOCKET,
+                socket.SO_RCVBUF,
+                RECEIVE_SOCKET_BUFFER_SIZE )
+        except OSError:
+            _log().warning( "  unable to grow socket receive buffer" )
+
+## ========================================================================
+
+class MulticastTransport( _SocketTransport ):
+    """
+    UDP to an IPv4 multicast group with TTL 0, so that every receiver
+    on the host gets every state.  The default transport.
+    """
+
+    def __init__( self,
+                  multicast_ip: str = '224.0.0.1',
+                  multicast_port: int = 10000,
+                  bind_ip: str = '' ) -> None:
+        super().__init__()
+        self.address = ( multicast_ip, multicast_port )
+        self.bind_ip = bind_ip
+
+
+    def open_sender( self ) -> None:
+        self.socket = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        self.socket.setsockopt( socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                                struct.pack( 'b', 0 ) )
+        _log().info( "Opened multicast socket" )
+
+
+    def open_receiver( self, timeout_seconds: float ) -> None:
+        server_address = ( self.bind_ip, self.address[1] )
+        self.socket = socket.socket( socket.AF_INET, socket.SOCK_DGRAM )
+        group = socket.inet_aton( self.address[0] )
+        mreq = struct.pack('4sL', group, socket.INADDR_ANY)
+        self.socket.setsockopt(
+            socket.IPPROTO_IP,
+            socket.IP_ADD_MEMBERSHIP,
+             mreq)
+        self.socket.setsockopt(
+            socket.SOL_SOCKET,
+            socket.SO_REUSEADDR,
+            1 )
+        self._grow_receive_buffer()
+        self.socket.bind( server_address )
+        self._open_waker( timeout_seconds )
+        _log().info( "Opened socket for receiving" )
+
+## ========================================================================
+
+class UnixDatagramTransport( _SocketTransport ):
+    """
+    Unix domain datagrams to a socket bound at path by the receiver,
+    for senders on the same host; bypasses the IP stack and needs no
+    multicast loopback.  Many senders may share one receiver.  Sends
+    with no receiver bound are dropped silently.  Sender sockets are
+    unbound, so all arrive from the same (empty) address.
+    """
+
+    distinct_addresses = False
+
+    def __init__( self, path: str = '/tmp/jotify.sock' ) -> None:
+        super().__init__()
+        self.address = path
+        self._bound = False
+
+
+    def open_sender( self ) -> None:
+        self.socket = socket.socket( socket.AF_UNIX, socket.SOCK_DGRAM )
+        _log().info( "Opened unix datagram socket" )
+
+
+    def send( self, messages: List[bytes] ) -> Optional[int]:
+        sent_n = 0
+        try:
+            for message in messages:
+                sent_n += self.socket.sendto( message, self.address )
+            return sent_n
+        except OSError as e:
+            if e.errno in ( errno.ENOENT, errno.ECONNREFUSED ):
+                # nobody listening
+                return sent_n
+            _log().exception( "error sending socket data: " )
+            return None
+
+
+    def open_receiver( self, timeout_seconds: float ) -> None:
+        try:
+            os.unlink( self.address )
+        except OSError:
+            pass
+        self.socket = socket.socket( socket.AF_UNIX, socket.SOCK_DGRAM )
+        self._grow_receive_buffer()
+        self.socket.bind( self.address )
+        self._open_waker( timeout_seconds )
+        self._bound = True
+        _log().info( "Bound unix datagram socket {0}".format( self.address ) )
+
+
+    def close( self ) -> None:
+        super().close()
+        if self._bound:
+            self._bound = False
+            try:
+                os.unlink( self.address )
+            except OSError:
+                pass
+
+## ========================================================================
+
+SHM_MAGIC = b'JTM'
+SHM_VERSION = 1
+
+##
+# magic, version, writer pid, sequence (odd while writing), length
+_SHM_HEADER = struct.Struct( '<3sBIQI' )
+
+_SHM_SEQUENCE_OFFSET = 8
+
+class SharedMemoryTransport( Transport ):
+    """
+    Each sender keeps its latest serialized state in a memory mapped
+    file of its own in directory; the receiver maps the files and
+    picks up each state once, when its sequence number moves.
+
+    Nothing is queued: a receiver polling slower than the senders
+    publish only sees their latest states, which is all a UI needs,
+    and sending costs a memory copy.  Deltas missed that way leave
+    keys stale until the next keyframe, so senders should keep the
+    default keyframe_every of 1.  States larger than
+    capacity_bytes are dropped.  Files of dead senders are removed by
+    the receiver.
+    """
+
+    fragmented = False
+
+    def __init__( self,
+                  directory: Optional[str] = None,
+                  capacity_bytes: int = 1024 * 1024 * 16,
+                  poll_seconds: float = 0.05 ) -> None:
+        if directory is None:
+            base = '/dev/shm' if os.path.isdir( '/dev/shm' ) else '/tmp'
+            directory = os.path.join( base, 'jotify' )
+        self.directory = directory
+        self.capacity_bytes = capacity_bytes
+        self.poll_seconds = poll_seconds
+        self.map = None # type: Optional[mmap.mmap]
+        self.path = None # type: Optional[str]
+        self._readers = {} # type: Dict[str,Tuple[mmap.mmap,int]]
+        self._timeout_seconds = None # type: Optional[float]
+        self._awake = False
+
+
+    def open_sender( self ) -> None:
+        os.makedirs( self.directory, exist_ok = True )
+        self.path = os.path.join( self.directory, "{0}-{1:08x}.jtm".format(
+            os.getpid(), random.getrandbits( 32 ) ) )
+        fd = os.open( self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600 )
+        try:
+            os.ftruncate( fd, _SHM_HEADER.size + self.capacity_bytes )
+            self.map = mmap.mmap( fd, _SHM_HEADER.size + self.capacity_bytes )
+        finally:
+            os.close( fd )
+        _SHM_HEADER.pack_into( self.map, 0, SHM_MAGIC, SHM_VERSION,
+                               os.getpid(), 0, 0 )
+        _log().info( "Opened shared memory state {0}".format( self.path ) )
+
+
+    def send( self, messages: List[bytes] ) -> Optional[int]:
+        sent_n = 0
+        for message in messages:
+            if len(message) > self.capacity_bytes:
+                _log().warning( "state of {0} bytes exceeds shared memory capacity".format(
+                    len(message) ) )
+                return None
+            sequence = struct.unpack_from( '<Q', self.map, _SHM_SEQUENCE_OFFSET )[0]
+            struct.pack_into( '<Q', self.map, _SHM_SEQUENCE_OFFSET, sequence + 1 )
+            self.map[ _SHM_HEADER.size : _SHM_HEADER.size + len(message) ] = message
+            struct.pack_into( '<QI', self.map, _SHM_SEQUENCE_OFFSET,
+                              sequence + 2, len(message) )
+            sent_n += len(message)
+        return sent_n
+
+
+    def open_receiver( self, timeout_seconds: float ) -> None:
+        os.makedirs( self.directory, exist_ok = True )
+        self._timeout_seconds = timeout_seconds
+        self._awake = False
+
+
+    def receive( self ) -> Optional[Tuple[bytes,Any]]:
+        deadline = time.monotonic() + ( self._timeout_seconds or 0.0 )
+        while not self._awake:
+            received = self._poll()
+            if received is not None:
+                return received
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep( min( self.poll_seconds, remaining ) )
+        return None
+
+
+    def wake( self ) -> None:
+        self._awake = True
+
+
+    def close( self ) -> None:
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            try:
+                os.unlink( self.path )
+            except OSError:
+                pass
+        for m, _ in self._readers.values():
+            m.close()
+        self._readers = {}
+
+
+    def _poll( self ) -> Optional[Tuple[bytes,Any]]:
+        """
+        Returns the first state found which was not received yet.
+        """
+        try:
+            names = os.listdir( self.directory )
+        except OSError:
+            return None
+        for name in names:
+            if not name.endswith( '.jtm' ):
+                continue
+            path = os.path.join( self.directory, name )
+            reader = self._readers.get( path )
+            if reader is None:
+                reader = self._map( path )
+                if reader is None:
+                    continue
+            m, last_sequence = reader
+            _, _, pid, sequence, length = _SHM_HEADER.unpack_from( m, 0 )
+            if sequence == last_sequence or sequence % 2:
+                if sequence == last_sequence and not _alive( pid ):
+                    self._forget( path, remove = True )
+                continue
+            message = bytes( m[ _SHM_HEADER.size : _SHM_HEADER.size + length ] )
+            if struct.unpack_from( '<Q', m, _SHM_SEQUENCE_OFFSET )[0] != sequence:
+                # overwritten while copying, try again next poll
+                continue
+            self._readers[ path ] = ( m, sequence )
+            return message, path
+        for path in [ path for path in self._readers
+                      if os.path.basename( path ) not in names ]:
+            self._forget( path )
+        return None
+
+
+    def _map( self, path: str ) -> Optional[Tuple[mmap.mmap,int]]:
+        try:
+            fd = os.open( path, os.O_RDONLY )
+            try:
+                size = os.fstat( fd ).st_size
+                if size < _SHM_HEADER.size:
+                    return None
+                m = mmap.mmap( fd, size, access = mmap.ACCESS_READ )
+            finally:
+                os.close( fd )
+        except OSError:
+            return None
+        if _SHM_HEADER.unpack_from( m, 0 )[:2] != ( SHM_MAGIC, SHM_VERSION ):
+            m.close()
+            return None
+        reader = ( m, 0 )
+        self._readers[ path ] = reader
+        return reader
+
+
+    def _forget( self, path: str, remove: bool = False ) -> None:
+        m, _ = self._readers.pop( path )
+        m.close()
+        if remove:
+            _log().info( "  removing state of dead sender {0}".format( path ) )
+            try:
+                os.unlink( path )
+            except OSError:
+                pass
+
+
+def _alive( pid: int ) -> bool:
+    try:
+        os.kill( pid, 0 )
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
+## ========================================================================
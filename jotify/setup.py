@@ -59,4 +59,19 @@ setup(
     install_requires=[
     ],  # Optional
 
+    # Optional dependencies, e.g. `pip install jotify[columnar]` for the
+    # numpy backed statistics of state_ui.UI( ..., columnar=True ), or
+    # jotify[glib] for glib_ui.GLibUI.
+    extras_require={
+        'columnar': ['numpy'],
+        'glib': ['pygobject'],
+    },
+
+    # `jotify-relay` fans many senders into one stream, see jotify.relay
+    entry_points={
+        'console_scripts': [
+            'jotify-relay=jotify.relay:main',
+        ],
+    },
+
 )
@@ -0,0 +1,83 @@
+from jotify import codec
+from jotify.aggregate import SenderAggregator
+from jotify.state import State
+
+## ========================================================================
+
+def _state( **counts ) -> State:
+    state = State()
+    for key, n in counts.items():
+        state.add( key, n )
+    return state
+
+
+def _keyframe( seq: int ):
+    return { 'kind' : codec.KIND_KEYFRAME, 'seq' : seq }
+
+
+def _delta( seq: int, **extra ):
+    header = { 'kind' : codec.KIND_DELTA, 'seq' : seq }
+    header.update( extra )
+    return header
+
+## ========================================================================
+
+def test_totals_are_summed_across_senders():
+    senders = SenderAggregator()
+    senders.apply( 's1', _keyframe( 0 ), _state( a = 3, b = 1 ) )
+    senders.apply( 's2', _keyframe( 0 ), _state( a = 4 ) )
+    total = senders.aggregate()
+    assert total.stats[ 'a' ][ 'count' ] == 7
+    assert total.stats[ 'b' ][ 'count' ] == 1
+
+
+def test_stale_and_out_of_order_messages_are_dropped():
+    senders = SenderAggregator()
+    assert senders.apply( 's', _keyframe( 5 ), _state( a = 5 ) )
+    assert not senders.apply( 's', _delta( 5 ), _state( a = 9 ) )
+    assert not senders.apply( 's', _delta( 3 ), _state( a = 9 ) )
+    assert senders.dropped == 2
+    assert senders.aggregate().stats[ 'a' ][ 'count' ] == 5
+
+
+def test_missed_deltas_wait_for_a_keyframe():
+    senders = SenderAggregator()
+    senders.apply( 's', _keyframe( 0 ), _state( a = 1, b = 1 ) )
+    assert senders.apply( 's', _delta( 3 ), _state( a = 4 ) )
+    assert senders.missed == 2
+    assert senders.senders[ 's' ].awaiting_keyframe
+    # the keyframe replaces every key of the sender
+    senders.apply( 's', _keyframe( 4 ), _state( a = 5 ) )
+    assert not senders.senders[ 's' ].awaiting_keyframe
+    assert set( senders.aggregate().stats ) == { 'a' }
+
+
+def test_delta_removes_listed_keys():
+    senders = SenderAggregator()
+    senders.apply( 's', _keyframe( 0 ), _state( a = 1, b = 1 ) )
+    senders.apply( 's', _delta( 1, removed = [ 'b' ] ), _state( a = 2 ) )
+    total = senders.aggregate()
+    assert set( total.stats ) == { 'a' }
+    assert total.stats[ 'a' ][ 'count' ] == 2
+
+
+def test_snapshots_only_change_with_the_senders():
+    senders = SenderAggregator()
+    senders.apply( 's1', _keyframe( 0 ), _state( a = 1, b = 1 ) )
+    first = senders.aggregate()
+    version = senders.version
+    assert senders.aggregate() is first and senders.version == version
+    senders.apply( 's1', _delta( 1 ), _state( a = 2 ) )
+    second = senders.aggregate()
+    assert senders.version == version + 1
+    assert second.stats[ 'a' ][ 'count' ] == 2
+    # unchanged keys are shared with the previous snapshot
+    assert second.stats[ 'b' ] is first.stats[ 'b' ]
+
+
+def test_silent_senders_expire():
+    senders = SenderAggregator( ttl_seconds = 10.0 )
+    senders.apply( 's1', _keyframe( 0 ), _state( a = 1 ), now = 100.0 )
+    senders.apply( 's2', _keyframe( 0 ), _state( a = 2 ), now = 105.0 )
+    assert senders.expire( now = 112.0 ) == [ 's1' ]
+    assert senders.aggregate().stats[ 'a' ][ 'count' ] == 2
@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+from jotify import codec
+from jotify.state import State
+
+## ========================================================================
+
+def _state() -> State:
+    state = State()
+    state.schema( 'a', 0, 99 )
+    state.add( 'a', 3 )
+    state.add( 'a', 4 )
+    state.add( 'b', 1 )
+    state.finish( 'b' )
+    for value in ( 0.5, 1.0, 2.0 ):
+        state.record( 'c', value )
+    return state
+
+
+def _check_round_trip( original: State, loaded: State ) -> None:
+    assert set( loaded.stats ) == set( original.stats )
+    for key, entry in original.stats.items():
+        got = loaded.stats[ key ]
+        assert got[ 'count' ] == entry[ 'count' ]
+        assert got[ 'min' ] == entry[ 'min' ]
+        assert got[ 'max' ] == entry[ 'max' ]
+        assert bool( got.get( 'finished' ) ) == bool( entry.get( 'finished' ) )
+        assert list( got[ 'timehist' ] ) == pytest.approx(
+            list( entry[ 'timehist' ] ), abs = 1e-3 )
+        assert got[ 'timehist' ].rate == pytest.approx( entry[ 'timehist' ].rate )
+    values = loaded.stats[ 'c' ][ 'values' ]
+    assert ( values.n, values.sum, values.min, values.max ) == ( 3, 3.5, 0.5, 2.0 )
+
+
+@pytest.mark.parametrize( 'wire_format', [ codec.WIRE_JSON, codec.WIRE_BINARY ] )
+@pytest.mark.parametrize( 'header', [ None, { 'kind' : codec.KIND_KEYFRAME,
+                                               'seq' : 3,
+                                               'sender' : 'h/1/0' } ] )
+def test_round_trip( wire_format, header ):
+    original = _state()
+    rep = original.representation( wire_format, header = header )
+    assert codec.detect( rep ) == wire_format
+    loaded = State()
+    got_header = loaded.load( rep )
+    assert got_header == ( header or {} )
+    _check_round_trip( original, loaded )
+
+
+def test_plain_json_keeps_datetime_strings():
+    obj = json.loads( _state().representation( codec.WIRE_JSON ) )
+    assert all( isinstance( t, str ) for t in obj[ 'a' ][ 'timehist' ] )
+    assert all( isinstance( t, float ) for t in obj[ 'a' ][ 'times' ] )
+
+
+@pytest.mark.parametrize( 'wire_format', [ codec.WIRE_JSON, codec.WIRE_BINARY ] )
+def test_delta_carries_changes_and_removals( wire_format ):
+    state = _state()
+    header = { 'kind' : codec.KIND_DELTA, 'seq' : 1, 'sender' : 's' }
+    state.representation( wire_format, header = header )
+    state.add( 'a', 1 )
+    state.remove( 'b' )
+    delta = State()
+    got_header = delta.load( state.representation( wire_format,
+                                                   header = header,
+                                                   delta = True ) )
+    assert set( delta.stats ) == { 'a' }
+    assert delta.stats[ 'a' ][ 'count' ] == 8
+    assert got_header[ 'removed' ] == [ 'b' ]
+    # nothing changed since
+    empty = State()
+    empty.load( state.representation( wire_format, header = header, delta = True ) )
+    assert empty.stats == {}
+
+
+def test_delta_holds_back_keys():
+    state = _state()
+    state.representation()
+    state.add( 'a', 1 )
+    state.add( 'c', 1 )
+    held = State()
+    held.load( state.representation( delta = True, hold = { 'c' },
+                                     header = { 'kind' : codec.KIND_DELTA } ) )
+    assert set( held.stats ) == { 'a' }
+    assert state.dirty == { 'c' }
@@ -0,0 +1,63 @@
+import os
+import random
+
+from jotify import fragment
+from jotify.fragment import Reassembler
+
+## ========================================================================
+
+def test_fits_in_one_datagram():
+    assert fragment.fragments( b'abc', 100, 1 ) == [ b'abc' ]
+
+
+def test_reassembles_chunks_in_any_order():
+    rep = os.urandom( 10000 )
+    chunks = fragment.fragments( rep, 1000, 7 )
+    assert len(chunks) > 1
+    assert all( len(c) <= 1000 and fragment.is_chunk( c ) for c in chunks )
+    random.Random( 1 ).shuffle( chunks )
+    reassembler = Reassembler( 1 << 20, 4 << 20 )
+    results = [ reassembler.add( 'a', c ) for c in chunks ]
+    assert results[ :-1 ] == [ None ] * ( len(chunks) - 1 )
+    assert bytes( results[ -1 ] ) == rep
+    assert not reassembler.pending
+
+
+def test_sources_and_messages_are_kept_apart():
+    reps = { ( 'a', 1 ) : os.urandom( 3000 ),
+             ( 'b', 1 ) : os.urandom( 3000 ),
+             ( 'a', 2 ) : os.urandom( 3000 ) }
+    chunked = { key : fragment.fragments( rep, 1000, key[1] )
+                for key, rep in reps.items() }
+    reassembler = Reassembler( 1 << 20, 4 << 20 )
+    done = {}
+    for i in range( max( len(c) for c in chunked.values() ) ):
+        for ( source, message_id ), chunks in chunked.items():
+            if i < len(chunks):
+                result = reassembler.add( source, chunks[ i ] )
+                if result is not None:
+                    done[ ( source, message_id ) ] = bytes( result )
+    assert done == reps
+
+
+def test_partial_messages_time_out( monkeypatch ):
+    now = [ 1000.0 ]
+    monkeypatch.setattr( fragment.time, 'monotonic', lambda: now[0] )
+    chunks = fragment.fragments( os.urandom( 3000 ), 1000, 1 )
+    reassembler = Reassembler( 1 << 20, 4 << 20, timeout_seconds = 5.0 )
+    assert reassembler.add( 'a', chunks[0] ) is None
+    now[0] += 6.0
+    # a new message expires the stale one
+    assert reassembler.add( 'a', fragment.fragments( b'x' * 3000, 1000, 2 )[0] ) is None
+    assert list( reassembler.pending ) == [ ( 'a', 2 ) ]
+    assert reassembler.dropped == 1
+    # the rest of the timed out message cannot complete it
+    for c in chunks[ 1: ]:
+        assert reassembler.add( 'a', c ) is None
+
+
+def test_oversize_messages_are_refused():
+    chunks = fragment.fragments( os.urandom( 5000 ), 1000, 1 )
+    reassembler = Reassembler( 4000, 16000 )
+    assert all( reassembler.add( 'a', c ) is None for c in chunks )
+    assert reassembler.oversize == len(chunks)
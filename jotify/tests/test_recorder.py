@@ -0,0 +1,102 @@
+import math
+
+from jotify import recorder
+from jotify.recorder import Recorder, Recording, replay
+from jotify.state import State
+
+## ========================================================================
+
+def _state( **counts ) -> State:
+    state = State()
+    for key, n in counts.items():
+        state.add( key, n )
+    return state
+
+
+def _record( path: str ) -> None:
+    """
+    Two senders counting key a from t=1000 on, one update a second;
+    s2 stops at t=1004 and s1 removes b at t=1005.
+    """
+    rec = Recorder( path )
+    for i in range( 10 ):
+        t = 1000.0 + i
+        if i < 5:
+            rec.record( 's1', {}, _state( a = 10 * ( i + 1 ), b = 1 ), now = t )
+        else:
+            rec.record( 's1', {}, _state( a = 10 * ( i + 1 ) ), now = t )
+        if i < 5:
+            rec.record( 's2', {}, _state( a = i + 1 ), now = t )
+        if i == 5:
+            rec.record( 's1', { 'removed' : [ 'b' ] }, State(), now = t )
+    rec.close()
+
+## ========================================================================
+
+def test_records_and_time_range( tmp_path ):
+    path = str( tmp_path / 'log.jtr' )
+    _record( path )
+    recording = Recording( path )
+    assert recording.time_range() == ( 1000.0, 1009.0 )
+    rows = list( recording.records( 1002.0, 1003.0, key = 'a' ) )
+    assert [ ( r[1], r[3] ) for r in rows ] == [ ( 's1', 30.0 ), ( 's2', 3.0 ) ]
+    rows = list( recording.records( key = 'b' ) )
+    assert [ ( r[0], r[9] ) for r in rows ][ -1 ] == ( 1005.0, True )
+    recording.close()
+
+
+def test_series_starts_from_the_totals_at_start( tmp_path ):
+    path = str( tmp_path / 'log.jtr' )
+    _record( path )
+    recording = Recording( path )
+    points = recording.series( 'a', 1006.5, 1008.5 )
+    # s2's last count (5) still counts after it went quiet
+    assert points == [ ( 1006.5, 75.0 ), ( 1007.0, 85.0 ), ( 1008.0, 95.0 ) ]
+    assert recording.series( 'b', 1007.0 ) == []
+    recording.close()
+
+
+def test_latest_uses_checkpoints( tmp_path, monkeypatch ):
+    monkeypatch.setattr( recorder, '_CHECKPOINT_RECORDS', 4 )
+    path = str( tmp_path / 'log.jtr' )
+    _record( path )
+    recording = Recording( path )
+    assert len( recording._checkpoint_index ) > 1
+    for before in ( 1000.5, 1003.5, 1006.5, 1020.0 ):
+        expected = {}
+        for row in recording.records( None, before ):
+            expected[ ( row[1], row[2] ) ] = row
+        expected = { pair : row for pair, row in expected.items() if not row[9] }
+        got = { pair : row for pair, row in recording.latest( before ).items()
+                if not row[9] }
+        assert got == expected
+    recording.close()
+
+
+def test_reopened_log_keeps_checkpoints_consistent( tmp_path, monkeypatch ):
+    monkeypatch.setattr( recorder, '_CHECKPOINT_RECORDS', 4 )
+    path = str( tmp_path / 'log.jtr' )
+    _record( path )
+    rec = Recorder( path )
+    rec.record( 's3', {}, _state( a = 1000 ), now = 1010.0 )
+    for i in range( 5 ):
+        rec.record( 's1', {}, _state( a = 200 + i ), now = 1011.0 + i )
+    rec.close()
+    recording = Recording( path )
+    assert recording.series( 'a', 1015.5 ) == [ ( 1015.5, 1000 + 204 + 5 ) ]
+    recording.close()
+
+
+def test_replay_from_start( tmp_path ):
+    path = str( tmp_path / 'log.jtr' )
+    _record( path )
+    recording = Recording( path )
+    snapshots = []
+    replay( recording,
+            [ lambda s: snapshots.append( { k : e[ 'count' ] for k, e in s.stats.items() } ) ],
+            speed = math.inf,
+            start = 1006.5 )
+    # the first sync already has the totals at start
+    assert snapshots[0] == { 'a' : 75.0 }
+    assert snapshots[ -1 ] == { 'a' : 105.0 }
+    recording.close()
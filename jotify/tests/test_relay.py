@@ -0,0 +1,40 @@
+from jotify.relay import RELAY_METRICS_PREFIX, Relay, rollups
+from jotify.state import State
+from jotify.transport import MulticastTransport
+
+## ========================================================================
+
+def _relay( **kwargs ) -> Relay:
+    return Relay( 3600.0,
+                  input_transport = MulticastTransport( multicast_port = 10152 ),
+                  output_transport = MulticastTransport( multicast_port = 10153 ),
+                  **kwargs )
+
+
+def test_publish_keeps_own_metrics():
+    relay = _relay( publish_metrics = True )
+    state = relay.sender.state
+    upstream = State()
+    upstream.add( 'a', 1 )
+    upstream.add( RELAY_METRICS_PREFIX + 'send.bytes', 10 )
+    relay._publish( upstream )
+    relay.sender.metrics.count( 'send.bytes', 5 )
+    relay.sender.metrics.publish( state, relay.sender.metrics_prefix )
+    state.representation()
+    relay._publish( upstream )
+    assert state.removed == set()
+    assert state.stats[ RELAY_METRICS_PREFIX + 'send.bytes' ][ 'count' ] == 5
+    assert state.stats[ RELAY_METRICS_PREFIX + 'upstream.send.bytes' ][ 'count' ] == 10
+    relay._publish( State() )
+    assert state.removed == { 'a', RELAY_METRICS_PREFIX + 'upstream.send.bytes' }
+
+
+def test_rollups_sum_by_prefix():
+    stats = {}
+    for key, n in [ ( 'job.a', 2 ), ( 'job.b', 3 ), ( 'other', 1 ) ]:
+        s = State()
+        s.add( key, n )
+        stats.update( s.stats )
+    result = rollups( stats, [ 1 ] )
+    assert list( result ) == [ 'job.*' ]
+    assert result[ 'job.*' ][ 'count' ] == 5
@@ -0,0 +1,38 @@
+import os
+import select
+import threading
+
+from jotify.scheduler import Scheduler
+
+## ========================================================================
+
+def test_tasks_run_on_interval():
+    scheduler = Scheduler()
+    ran = threading.Event()
+    task = scheduler.schedule( 0.01, ran.set )
+    try:
+        assert ran.wait( 5.0 )
+    finally:
+        task.cancel()
+
+
+def test_forked_child_runs_its_own_tasks():
+    scheduler = Scheduler()
+    parent_task = scheduler.schedule( 3600.0, lambda: None )
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            ran = threading.Event()
+            scheduler.schedule( 0.01, ran.set )
+            os.write( write_fd, b'1' if ran.wait( 5.0 ) else b'0' )
+        finally:
+            os._exit( 0 )
+    try:
+        readable, _, _ = select.select( [ read_fd ], [], [], 10.0 )
+        assert readable and os.read( read_fd, 1 ) == b'1'
+    finally:
+        os.waitpid( pid, 0 )
+        os.close( read_fd )
+        os.close( write_fd )
+        parent_task.cancel()
@@ -0,0 +1,51 @@
+import multiprocessing
+
+from jotify import progress
+from jotify import shared
+from jotify.batch_sender import BatchSender
+from jotify.shared import SharedCounters
+from jotify.state import State
+
+## ========================================================================
+
+def _work( n: int ) -> None:
+    for _ in progress.track( range( n ), name = 'items', timed = True ):
+        pass
+    progress.track_value( 'sizes', float( n ) )
+
+
+def test_pool_workers_count_and_record_values():
+    sender = BatchSender( 3600.0 )
+    counters = sender.share_counters()
+    context = multiprocessing.get_context( 'spawn' )
+    with context.Pool( 2, initializer = shared.attach,
+                       initargs = ( counters, ) ) as pool:
+        pool.map( _work, [ 10, 20, 30 ] )
+    state = State()
+    counters.fold_into( state )
+    assert state.stats[ 'items' ][ 'count' ] == 60
+    assert state.stats[ 'items' ][ 'values' ].n == 60
+    sizes = state.stats[ 'sizes' ][ 'values' ]
+    assert sizes.n == 3 and sizes.min == 10 and sizes.max == 30
+    counters.close()
+
+
+def test_fold_merges_only_new_values():
+    counters = SharedCounters( 16, value_slots = 4 )
+    state = State()
+    counters.record( 'k', 1.0 )
+    counters.fold_into( state )
+    counters.record( 'k', 2.0 )
+    counters.fold_into( state )
+    counters.fold_into( state )
+    values = state.stats[ 'k' ][ 'values' ]
+    assert values.n == 2 and values.sum == 3.0
+    counters.close()
+
+
+def test_values_past_the_value_slots_are_dropped():
+    counters = SharedCounters( 16, value_slots = 1 )
+    counters.record( 'a', 1.0 )
+    counters.record( 'b', 1.0 )
+    assert set( counters.read_values() ) == { 'a' }
+    counters.close()
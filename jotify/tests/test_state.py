@@ -0,0 +1,65 @@
+import threading
+import time
+
+from jotify.state import State
+
+## ========================================================================
+
+def test_sharded_counts_are_exact_across_threads():
+    state = State( sharded = True )
+    n_threads, n_items = 8, 20000
+
+    def work():
+        for _ in range( n_items ):
+            state.add( 'k', 1 )
+
+    threads = [ threading.Thread( target = work ) for _ in range( n_threads ) ]
+    for t in threads:
+        t.start()
+    # reads while the threads count must not lose or double anything
+    for _ in range( 20 ):
+        state.representation()
+    for t in threads:
+        t.join()
+    assert state.clone().stats[ 'k' ][ 'count' ] == n_threads * n_items
+
+
+def test_sharded_set_overrides_earlier_counts():
+    state = State( sharded = True )
+    state.add( 'k', 5 )
+    state.set( 'k', 0 )
+    state.add( 'k', 2 )
+    assert state.clone().stats[ 'k' ][ 'count' ] == 2
+
+
+def test_deferred_set_applies_after_earlier_counts():
+    state = State()
+    counter = state.counter( 'k' )
+    counter[0] += 50
+    counter[1] = time.monotonic()
+    state.clone()
+    state.defer( 'set', 'k', 0 )
+    counter[0] += 7
+    counter[1] = time.monotonic()
+    assert state.clone().stats[ 'k' ][ 'count' ] == 7
+
+
+def test_max_keys_evicts_least_recently_updated():
+    state = State( max_keys = 2 )
+    state.add( 'a', 1 )
+    state.add( 'b', 1 )
+    state.add( 'a', 1 )
+    state.add( 'c', 1 )
+    assert set( state.stats ) == { 'a', 'c' }
+    assert state.removed == { 'b' }
+
+
+def test_finished_keys_expire():
+    state = State( finished_ttl_seconds = 10.0 )
+    state.add( 'a', 1 )
+    state.finish( 'a' )
+    state.add( 'b', 1 )
+    finished_at = state._finished[ 'a' ]
+    assert state.expire_keys( finished_at + 5.0 ) == []
+    assert state.expire_keys( finished_at + 11.0 ) == [ 'a' ]
+    assert set( state.stats ) == { 'b' }
@@ -0,0 +1,52 @@
+import os
+import time
+
+from jotify.batch_sender import BatchSender
+from jotify.state_ui import UI
+from jotify.transport import UnixDatagramTransport
+
+## ========================================================================
+
+def _wait_for( condition, timeout_seconds: float = 5.0 ) -> bool:
+    deadline = time.monotonic() + timeout_seconds
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep( 0.02 )
+    return condition()
+
+## ========================================================================
+
+def test_unix_datagram_senders_are_kept_apart( tmp_path ):
+    path = str( tmp_path / 'jotify.sock' )
+    ui = UI( 3600.0,
+             receive_sleep_seconds = 0.1,
+             transport = UnixDatagramTransport( path ) )
+    ui.start()
+    senders = [ BatchSender( 3600.0, transport = UnixDatagramTransport( path ) )
+                for _ in range( 2 ) ]
+    try:
+        for sender, n in zip( senders, [ 3, 4 ] ):
+            sender.start()
+            sender.state.add( 'k', n )
+            sender.flush()
+        assert _wait_for( lambda: len( ui.senders.senders ) == 2 )
+        with ui.lock:
+            total = ui.senders.aggregate()
+        assert total.stats[ 'k' ][ 'count' ] == 7
+    finally:
+        for sender in senders:
+            sender.pause()
+        ui.pause()
+    assert not os.path.exists( path )
+
+
+def test_pause_wakes_a_blocked_receive( tmp_path ):
+    ui = UI( 3600.0,
+             receive_sleep_seconds = 30.0,
+             transport = UnixDatagramTransport( str( tmp_path / 'jotify.sock' ) ) )
+    ui.start()
+    time.sleep( 0.1 )
+    started = time.monotonic()
+    ui.pause()
+    assert time.monotonic() - started < 1.0